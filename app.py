@@ -7,10 +7,16 @@ The actual application code is in the cicd_server package.
 
 import os
 import argparse
+import sys
 
 from cicd_server import app, db, socketio
 from cicd_server.services.build_service import mark_abandoned_builds
-from cicd_server.utils.migration import migrate_to_multiple_configs, migrate_step_times_format
+from cicd_server.services.config_stats import ensure_config_stats, rebuild_config_stats
+from cicd_server.services.log_search import backfill_log_index
+from cicd_server.services.worker import monitor_worker_builds
+from cicd_server.utils.migration import migrate_add_missing_columns, migrate_add_missing_indexes, \
+    migrate_to_multiple_configs, migrate_step_times_format, migrate_step_times_to_build_steps, \
+    migrate_add_log_search_index
 
 def str2bool(v):
     if isinstance(v, bool):
@@ -23,14 +29,22 @@ def str2bool(v):
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 # Import all modules to register routes and API endpoints
-from cicd_server.routes import auth, dashboard, user, build, config
-from cicd_server.api import build_api, webhook
+from cicd_server.routes import auth, dashboard, user, build, config, profiling, search
+from cicd_server.api import build_api, webhook, metrics, analytics_api, log_stream, log_search_api
 
 if __name__ == '__main__':
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='CICD Server Application')
     parser.add_argument('--port', type=int, help='Port to run the server on')
     parser.add_argument('--debug', type=str2bool, nargs='?', const=True, default=None, help='Run in debug mode (True/False)')
+    parser.add_argument('--allow-unsafe-werkzeug', type=str2bool, nargs='?', const=True, default=None,
+                        help='Allow the Werkzeug server to run without a terminal, e.g. in scripts (True/False)')
+    parser.add_argument('--build-execution', choices=['inline', 'worker'],
+                        help='Run builds in server threads (inline) or leave them to worker.py processes (worker)')
+    parser.add_argument('--resume-interrupted', type=str2bool, nargs='?', const=True, default=None,
+                        help='Resume builds interrupted by the last shutdown from their last resumable step (True/False)')
+    parser.add_argument('--rebuild-stats', action='store_true',
+                        help='Recompute the per-configuration statistics from the build history and exit')
     args = parser.parse_args()
 
     # Get port from command line argument, environment variable, or default to 5000
@@ -39,15 +53,46 @@ if __name__ == '__main__':
     # Get debug mode from command line argument, environment variable, or default to False
     debug = args.debug if args.debug is not None else os.environ.get('CICD_DEBUG', '').lower() == 'true'
 
+    # Get whether the Werkzeug server may run without a terminal from command line argument or environment variable
+    allow_unsafe_werkzeug = args.allow_unsafe_werkzeug if args.allow_unsafe_werkzeug is not None \
+        else os.environ.get('CICD_ALLOW_UNSAFE_WERKZEUG', '').lower() == 'true'
+
+    # Get the build execution mode from command line argument, environment variable, or default to inline
+    if args.build_execution:
+        app.config['BUILD_EXECUTION'] = args.build_execution
+
+    # Get whether interrupted builds are resumed from command line argument, environment variable, or default to False
+    if args.resume_interrupted is not None:
+        app.config['RESUME_INTERRUPTED_BUILDS'] = args.resume_interrupted
+
     with app.app_context():
         db.create_all()
 
     # Run migrations
+    migrate_add_missing_columns()
+    migrate_add_missing_indexes()
     migrate_to_multiple_configs()
     migrate_step_times_format()
+    migrate_step_times_to_build_steps()
+    migrate_add_log_search_index()
+
+    if args.rebuild_stats:
+        count = rebuild_config_stats()
+        print(f"Rebuilt statistics for {count} configurations")
+        sys.exit(0)
 
-    # Mark any pending or running builds as failed-permanently
+    # Create statistics for configurations that do not have them yet
+    ensure_config_stats()
+
+    # Resume or mark as failed-permanently any builds that were pending or running
     mark_abandoned_builds()
 
+    # Index the logs of builds from before log search existed, without delaying startup
+    socketio.start_background_task(backfill_log_index)
+
+    # Relay the progress of builds run by workers to connected clients
+    if app.config['BUILD_EXECUTION'] == 'worker':
+        socketio.start_background_task(monitor_worker_builds)
+
     print(f"Starting CICD Server on port {port} (Debug mode: {debug})")
-    socketio.run(app, debug=debug, port=port, host='0.0.0.0')
+    socketio.run(app, debug=debug, port=port, host='0.0.0.0', allow_unsafe_werkzeug=allow_unsafe_werkzeug)
@@ -0,0 +1,6 @@
+﻿"""
+Benchmarks Package
+
+This package contains load tests and benchmarks for the CICD Server application.
+Each module can be run with python -m benchmarks.<module>.
+"""
@@ -0,0 +1,191 @@
+﻿"""
+Build Output Benchmark
+
+Boots the server, runs a build whose step prints tens of megabytes of output as fast as it
+can, and measures the latency of the dashboard and build progress API while it runs,
+compared with an idle server. Each run is repeated with step output read in a separate
+process and in a server thread (CICD_STEP_OUTPUT_PROCESSES), to show how much of the web
+latency comes from reading build output in the server process.
+
+Usage:
+    python -m benchmarks.build_output --megabytes 100
+    python -m benchmarks.build_output --modes process --output build_output.json
+"""
+
+import argparse
+import json
+import shutil
+import threading
+import time
+
+from benchmarks.common import TempWorkspace, ServerProcess, HttpClient, use_database, create_admin, summarize, \
+    write_results, compare_results, load_baseline
+from benchmarks.load_test import python_command
+
+MODES = {'process': 'true', 'thread': 'false'}
+
+
+def setup_database(workspace, args):
+    """Create the schema, the admin user and the quiet and loud configurations."""
+    use_database(workspace.db_path)
+    from cicd_server import app, db
+    from cicd_server.models import User, Config
+
+    lines = args.megabytes * 1024 * 1024 // 100
+    loud_step = python_command(f"import sys; w = sys.stdout.write; [w('%099d' % i + chr(10)) for i in range({lines})]")
+    with app.app_context():
+        db.create_all()
+        create_admin(db, User)
+        db.session.add(Config(name='quiet', project_path=workspace.project_path, build_steps='echo quiet',
+                              api_token='quiet-token'))
+        db.session.add(Config(name='loud', project_path=workspace.project_path, build_steps=loud_step,
+                              api_token='loud-token'))
+        db.session.commit()
+        db.engine.dispose()
+
+
+def wait_for_build(client, build_id, timeout):
+    """Wait until a build has finished, returning its final status."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status, _, body, _ = client.get(f'/api/build_progress/{build_id}')
+        if status == 200:
+            build_status = json.loads(body).get('status')
+            if build_status not in ('queued', 'pending', 'running'):
+                return build_status
+        time.sleep(0.2)
+    raise RuntimeError(f'Build #{build_id} did not finish within {timeout} seconds')
+
+
+def trigger(client, token):
+    status, _, body, _ = client.post('/api/webhook', json_body={'branch': 'bench'}, headers={'X-API-Token': token})
+    if status != 200:
+        raise RuntimeError(f'Webhook returned {status}: {body[:200]}')
+    return json.loads(body)['build_id']
+
+
+def poll_endpoints(clients, paths, until=None, requests=None):
+    """
+    Request the given paths from several logged in clients, either until an event is set or
+    for a number of requests per client, returning {path: [latency, ...]}.
+    """
+    latencies = {path: [] for path in paths}
+    lock = threading.Lock()
+
+    def poll(client):
+        sent = 0
+        while (until is None or not until.is_set()) and (requests is None or sent < requests):
+            for path in paths:
+                status, _, _, latency = client.get(path)
+                if status != 200:
+                    raise RuntimeError(f'{path} returned {status}')
+                with lock:
+                    latencies[path].append(latency)
+            sent += 1
+
+    threads = [threading.Thread(target=poll, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def run_mode(mode, template_db, args):
+    with TempWorkspace(keep=args.keep) as workspace:
+        shutil.copyfile(template_db, workspace.db_path)
+        with ServerProcess(workspace.db_path, env={'CICD_STEP_OUTPUT_PROCESSES': MODES[mode]}) as server:
+            client = HttpClient(server.base_url)
+            client.login()
+
+            # Log in before the build starts, so logins are not part of the measurement
+            clients = [HttpClient(server.base_url) for _ in range(args.clients)]
+            for polling_client in clients:
+                polling_client.login()
+
+            # A finished build to poll while idle, which also starts the output pump
+            quiet_id = trigger(client, 'quiet-token')
+            wait_for_build(client, quiet_id, args.timeout)
+            idle = poll_endpoints(clients, ['/dashboard', f'/api/build_progress/{quiet_id}'],
+                                  requests=args.idle_requests)
+
+            loud_id = trigger(client, 'loud-token')
+            finished = threading.Event()
+            outcome = {}
+
+            def wait():
+                try:
+                    outcome['status'] = wait_for_build(client, loud_id, args.timeout)
+                finally:
+                    finished.set()
+
+            started = time.perf_counter()
+            waiter = threading.Thread(target=wait)
+            waiter.start()
+            loaded = poll_endpoints(clients, ['/dashboard', f'/api/build_progress/{loud_id}'], until=finished)
+            waiter.join()
+            build_seconds = time.perf_counter() - started
+
+    def by_endpoint(latencies):
+        return {'dashboard' if path == '/dashboard' else 'build_progress': summarize(values)
+                for path, values in latencies.items()}
+
+    return {
+        'build_status': outcome.get('status'),
+        'build_seconds': build_seconds,
+        'output_mb_per_second': args.megabytes / build_seconds,
+        'idle': by_endpoint(idle),
+        'during_build': by_endpoint(loaded),
+    }
+
+
+def format_latency(summary):
+    if not summary.get('count'):
+        return 'n/a (the build finished before any request)'
+    return f"n={summary['count']:5d} p50={summary['p50'] * 1000:8.1f}ms p99={summary['p99'] * 1000:8.1f}ms"
+
+
+def run(args):
+    results = {
+        'parameters': {'megabytes': args.megabytes, 'clients': args.clients},
+        'modes': {},
+    }
+    with TempWorkspace() as template:
+        # Every mode starts from a copy of the same database
+        setup_database(template, args)
+        for mode in args.modes:
+            print(f'Running a {args.megabytes} MB build with step output read in a {mode}...')
+            result = run_mode(mode, template.db_path, args)
+            results['modes'][mode] = result
+            print(f"  build {result['build_status']} in {result['build_seconds']:.1f}s "
+                  f"({result['output_mb_per_second']:.1f} MB/s)")
+            for phase in ('idle', 'during_build'):
+                for endpoint, summary in result[phase].items():
+                    print(f"  {phase:13s} {endpoint:15s} {format_latency(summary)}")
+
+    if args.output:
+        write_results(args.output, results)
+    baseline = load_baseline(args.baseline)
+    if baseline:
+        print('\nComparison with baseline:')
+        compare_results(results, baseline)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Web latency while a build prints a large amount of output')
+    parser.add_argument('--megabytes', type=int, default=50, help='Megabytes of output printed by the build')
+    parser.add_argument('--clients', type=int, default=4, help='Concurrent clients polling the server')
+    parser.add_argument('--idle-requests', type=int, default=25, help='Requests per client before the build')
+    parser.add_argument('--modes', nargs='*', choices=sorted(MODES), default=['thread', 'process'],
+                        help='Where step output is read')
+    parser.add_argument('--timeout', type=float, default=600, help='Seconds to wait for a build to finish')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    parser.add_argument('--baseline', help='Compare results with this JSON file')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary database and server log')
+    args = parser.parse_args(argv)
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
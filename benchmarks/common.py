@@ -0,0 +1,247 @@
+﻿"""
+Benchmark Helpers
+
+This module contains helpers shared by the benchmark scripts: booting the server
+against a temporary database, a small cookie-aware HTTP client, and result statistics.
+"""
+
+import http.cookiejar
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ADMIN_USERNAME = 'bench'
+ADMIN_PASSWORD = 'bench'
+
+
+def free_port():
+    """Get a free local TCP port."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def database_uri(db_path):
+    """Get the SQLAlchemy URI for a SQLite database file."""
+    return 'sqlite:///' + os.path.abspath(db_path).replace('\\', '/')
+
+
+def use_database(db_path):
+    """
+    Point the cicd_server package at a database file.
+
+    Must be called before cicd_server is imported, since the database URI is read at import time.
+    """
+    if 'cicd_server' in sys.modules:
+        raise RuntimeError('use_database() must be called before cicd_server is imported')
+    os.environ['CICD_DATABASE_URI'] = database_uri(db_path)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+
+
+def create_admin(db, User):
+    """Create the benchmark admin user if it doesn't exist."""
+    if not User.query.filter_by(username=ADMIN_USERNAME).first():
+        user = User(username=ADMIN_USERNAME, is_admin=True)
+        user.set_password(ADMIN_PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+
+
+class ServerProcess:
+    """Runs app.py in a child process against a given database file."""
+
+    def __init__(self, db_path, port=None, log_path=None, env=None):
+        self.db_path = db_path
+        self.env = env or {}  # Extra environment variables for the server
+        self.port = port or free_port()
+        self.log_path = log_path or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'server.log')
+        self.process = None
+        self._log_file = None
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    def start(self, timeout=30):
+        env = dict(os.environ)
+        env.update(self.env)
+        env['CICD_DATABASE_URI'] = database_uri(self.db_path)
+        env['PYTHONUNBUFFERED'] = '1'
+        self._log_file = open(self.log_path, 'w')
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(REPO_ROOT, 'app.py'), '--port', str(self.port),
+             '--debug', 'false', '--allow-unsafe-werkzeug', 'true'],
+            cwd=REPO_ROOT,
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=self._log_file,
+            stderr=subprocess.STDOUT
+        )
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'Server exited with code {self.process.returncode}, see {self.log_path}')
+            try:
+                urllib.request.urlopen(self.base_url + '/login', timeout=1)
+                return self
+            except urllib.error.HTTPError:
+                return self
+            except (urllib.error.URLError, ConnectionError, socket.timeout):
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError(f'Server did not start within {timeout} seconds, see {self.log_path}')
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self._log_file:
+            self._log_file.close()
+            self._log_file = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class TempWorkspace:
+    """A temporary directory holding the benchmark database, server log and build workspace."""
+
+    def __init__(self, keep=False):
+        self.keep = keep
+        self.path = tempfile.mkdtemp(prefix='cicd-bench-')
+        self.db_path = os.path.join(self.path, 'cicd.db')
+        self.project_path = os.path.join(self.path, 'project')
+        os.makedirs(self.project_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.keep:
+            print(f'Benchmark files kept in {self.path}')
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+class HttpClient:
+    """A minimal cookie-aware HTTP client that reports request latency."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, path, data=None, json_body=None, headers=None, timeout=60):
+        """
+        Send a request.
+
+        Returns:
+            tuple: (status code, response headers, body bytes, latency in seconds)
+        """
+        headers = dict(headers or {})
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        req = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        started = time.perf_counter()
+        try:
+            with self.opener.open(req, timeout=timeout) as response:
+                content = response.read()
+                return response.status, response.headers, content, time.perf_counter() - started
+        except urllib.error.HTTPError as e:
+            content = e.read()
+            return e.code, e.headers, content, time.perf_counter() - started
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def login(self, username=ADMIN_USERNAME, password=ADMIN_PASSWORD):
+        status, _, _, _ = self.post('/login', data={'username': username, 'password': password})
+        if status >= 400:
+            raise RuntimeError(f'Login failed with status {status}')
+
+
+def percentile(values, percent):
+    """Get a percentile of a list of numbers using linear interpolation."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * percent / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def summarize(values):
+    """Summarize a list of durations in seconds as count, mean and percentiles."""
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        'min': min(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values),
+    }
+
+
+def write_results(path, results):
+    """Write benchmark results to a JSON file."""
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(f'Results written to {path}')
+
+
+def compare_results(results, baseline, prefix=''):
+    """
+    Print the relative change of every numeric value compared to a baseline.
+
+    Args:
+        results (dict): The current results
+        baseline (dict): Results from a previous run with the same structure
+        prefix (str): Key prefix used when recursing into nested dictionaries
+    """
+    for key, value in sorted(results.items()):
+        name = f'{prefix}{key}'
+        base = baseline.get(key) if isinstance(baseline, dict) else None
+        if isinstance(value, dict):
+            compare_results(value, base or {}, name + '.')
+        elif isinstance(value, (int, float)) and isinstance(base, (int, float)) and not isinstance(value, bool):
+            change = ((value - base) / base * 100.0) if base else 0.0
+            print(f'{name:60s} {base:14.4f} -> {value:14.4f} ({change:+.1f}%)')
+
+
+def load_baseline(path):
+    """Load a baseline results file, or None if no path was given."""
+    if not path:
+        return None
+    with open(path) as f:
+        return json.load(f)
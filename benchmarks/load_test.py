@@ -0,0 +1,243 @@
+﻿"""
+Webhook Load Test
+
+Boots the server against a temporary SQLite database, creates configurations whose
+build steps are fast local commands, fires webhooks at a fixed rate and reports
+trigger latency, queue wait, end-to-end build latency, throughput and database growth.
+
+Usage:
+    python -m benchmarks.load_test --rate 2 --count 30
+    python -m benchmarks.load_test --output results.json --baseline baseline.json
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from benchmarks.common import TempWorkspace, ServerProcess, HttpClient, use_database, summarize, \
+    write_results, compare_results, load_baseline
+
+
+def python_command(code):
+    """Get a shell command that runs a line of Python with the current interpreter."""
+    return f'"{sys.executable}" -c "{code}"'
+
+
+def build_steps_for(kind, args):
+    """Get the build steps text for a configuration profile."""
+    if kind == 'sleep':
+        step = python_command(f"import time; time.sleep({args.step_sleep})")
+    elif kind == 'output':
+        step = python_command(f"import sys; [sys.stdout.write('x' * 99 + chr(10)) for _ in range({args.output_lines})]")
+    else:
+        step = 'echo step ${branch}'
+    return '\n'.join([step] * args.steps)
+
+
+def setup_database(workspace, args):
+    """Create the schema and the benchmark configurations, returning (name, token) pairs."""
+    use_database(workspace.db_path)
+    from cicd_server import app, db
+    from cicd_server.models import Config
+
+    kinds = ['sleep', 'echo', 'output']
+    configs = []
+    with app.app_context():
+        db.create_all()
+        for i in range(args.configs):
+            kind = kinds[i % len(kinds)]
+            config = Config(
+                name=f'load-{kind}-{i}',
+                project_path=workspace.project_path,
+                build_steps=build_steps_for(kind, args),
+                max_queue_length=args.max_queue,
+                api_token=f'load-token-{i}'
+            )
+            db.session.add(config)
+            configs.append((config.name, config.api_token))
+        db.session.commit()
+        db.engine.dispose()
+    return configs
+
+
+def fire_webhooks(client, configs, args):
+    """Send webhooks at a fixed rate, returning one record per trigger."""
+    records = []
+    records_lock = threading.Lock()
+    interval = 1.0 / args.rate
+
+    def send(i):
+        name, token = configs[i % len(configs)]
+        triggered_at = datetime.datetime.utcnow()
+        status, _, body, latency = client.post('/api/webhook', json_body={'branch': f'load-{i}'},
+                                               headers={'X-API-Token': token})
+        record = {'config': name, 'status': status, 'latency': latency, 'triggered_at': triggered_at}
+        if status == 200:
+            record['build_id'] = json.loads(body).get('build_id')
+        with records_lock:
+            records.append(record)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        start = time.perf_counter()
+        futures = []
+        for i in range(args.count):
+            # Keep a fixed schedule even if individual requests are slow
+            delay = start + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(send, i))
+        for future in futures:
+            future.result()
+    return records
+
+
+def parse_timestamp(value):
+    return datetime.datetime.fromisoformat(value) if value else None
+
+
+def wait_for_builds(db_path, build_ids, timeout):
+    """Wait until every triggered build has finished, returning {build_id: row}."""
+    deadline = time.time() + timeout
+    placeholders = ','.join('?' * len(build_ids))
+    while True:
+        conn = sqlite3.connect(db_path, timeout=30)
+        try:
+            rows = conn.execute(
+                f'SELECT id, status, started_at, completed_at FROM build WHERE id IN ({placeholders})',
+                list(build_ids)).fetchall()
+        finally:
+            conn.close()
+        unfinished = [r for r in rows if r[1] in ('queued', 'pending', 'running')]
+        if len(rows) == len(build_ids) and not unfinished:
+            return {r[0]: r for r in rows}
+        if time.time() > deadline:
+            print(f'Timed out with {len(unfinished)} builds still unfinished')
+            return {r[0]: r for r in rows}
+        time.sleep(0.5)
+
+
+def database_size(db_path):
+    """Get the size of a SQLite database including its journal files."""
+    return sum(os.path.getsize(p) for p in (db_path, db_path + '-wal', db_path + '-journal') if os.path.exists(p))
+
+
+def run(args):
+    with TempWorkspace(keep=args.keep) as workspace:
+        configs = setup_database(workspace, args)
+        initial_size = database_size(workspace.db_path)
+
+        with ServerProcess(workspace.db_path) as server:
+            client = HttpClient(server.base_url)
+            print(f'Server running at {server.base_url}, firing {args.count} webhooks at {args.rate}/s')
+
+            started = time.time()
+            records = fire_webhooks(client, configs, args)
+            build_ids = [r['build_id'] for r in records if r.get('build_id')]
+            rows = wait_for_builds(workspace.db_path, build_ids, args.drain_timeout) if build_ids else {}
+            finished = time.time()
+
+        triggered_at = {r['build_id']: r['triggered_at'] for r in records if r.get('build_id')}
+        queue_waits = []
+        end_to_end = []
+        statuses = {}
+        last_completed = None
+        for build_id, (_, status, started_at, completed_at) in rows.items():
+            statuses[status] = statuses.get(status, 0) + 1
+            started_at = parse_timestamp(started_at)
+            completed_at = parse_timestamp(completed_at)
+            if started_at:
+                queue_waits.append(max(0.0, (started_at - triggered_at[build_id]).total_seconds()))
+            if completed_at:
+                end_to_end.append((completed_at - triggered_at[build_id]).total_seconds())
+                last_completed = max(last_completed or completed_at, completed_at)
+
+        completed = len(end_to_end)
+        first_trigger = min(triggered_at.values()) if triggered_at else None
+        elapsed_minutes = ((last_completed - first_trigger).total_seconds() / 60.0) \
+            if (last_completed and first_trigger) else None
+        final_size = database_size(workspace.db_path)
+
+        results = {
+            'parameters': {
+                'configs': args.configs, 'rate': args.rate, 'count': args.count, 'steps': args.steps,
+                'step_sleep': args.step_sleep, 'output_lines': args.output_lines,
+            },
+            'triggers': {
+                'accepted': len(build_ids),
+                'rejected': sum(1 for r in records if r['status'] != 200),
+                'latency': summarize([r['latency'] for r in records]),
+            },
+            'queue_wait': summarize(queue_waits),
+            'end_to_end': summarize(end_to_end),
+            'builds': {
+                'completed': completed,
+                'statuses': statuses,
+                'per_minute': (completed / elapsed_minutes) if elapsed_minutes else None,
+                'wall_time': finished - started,
+            },
+            'database': {
+                'initial_bytes': initial_size,
+                'final_bytes': final_size,
+                'growth_bytes': final_size - initial_size,
+                'bytes_per_build': ((final_size - initial_size) / completed) if completed else None,
+            },
+        }
+
+    print_report(results)
+    if args.output:
+        write_results(args.output, results)
+    baseline = load_baseline(args.baseline)
+    if baseline:
+        print('\nComparison with baseline:')
+        compare_results(results, baseline)
+    return results
+
+
+def format_summary(summary):
+    if not summary.get('count'):
+        return 'n/a'
+    return (f"n={summary['count']} mean={summary['mean']:.3f}s p50={summary['p50']:.3f}s "
+            f"p90={summary['p90']:.3f}s p99={summary['p99']:.3f}s max={summary['max']:.3f}s")
+
+
+def print_report(results):
+    builds = results['builds']
+    database = results['database']
+    print()
+    print(f"Triggers:        {results['triggers']['accepted']} accepted, {results['triggers']['rejected']} rejected")
+    print(f"Trigger latency: {format_summary(results['triggers']['latency'])}")
+    print(f"Queue wait:      {format_summary(results['queue_wait'])}")
+    print(f"End-to-end:      {format_summary(results['end_to_end'])}")
+    per_minute = f"{builds['per_minute']:.1f}" if builds['per_minute'] else 'n/a'
+    print(f"Throughput:      {builds['completed']} builds completed, {per_minute} builds/minute")
+    print(f"Statuses:        {builds['statuses']}")
+    print(f"Database:        {database['initial_bytes']} -> {database['final_bytes']} bytes "
+          f"(+{database['growth_bytes']})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Webhook-triggered build load test')
+    parser.add_argument('--configs', type=int, default=3, help='Number of configurations to create')
+    parser.add_argument('--rate', type=float, default=2.0, help='Webhooks per second')
+    parser.add_argument('--count', type=int, default=30, help='Total number of webhooks to send')
+    parser.add_argument('--concurrency', type=int, default=16, help='Maximum concurrent webhook requests')
+    parser.add_argument('--steps', type=int, default=3, help='Build steps per configuration')
+    parser.add_argument('--step-sleep', type=float, default=0.2, help='Seconds each sleep step takes')
+    parser.add_argument('--output-lines', type=int, default=2000, help='Lines printed by each output step')
+    parser.add_argument('--max-queue', type=int, default=1000, help='Maximum queue length per configuration')
+    parser.add_argument('--drain-timeout', type=float, default=600, help='Seconds to wait for builds to finish')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    parser.add_argument('--baseline', help='Compare results with this JSON file')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary database and server log')
+    args = parser.parse_args(argv)
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+﻿"""
+Log Search Benchmark
+
+Seeds a build history, indexes its logs for search with the same backfill the server runs
+at startup, and measures the latency of log searches for rare and common terms.
+
+Usage:
+    python -m benchmarks.log_search --builds 20000 --log-lines 200
+    python -m benchmarks.log_search --db history.db --output log_search.json
+"""
+
+import argparse
+import os
+import random
+import time
+
+from benchmarks.common import TempWorkspace, use_database, summarize, write_results, compare_results, \
+    load_baseline
+from benchmarks.seed_history import seed
+
+NEEDLE_BUILDS = 50  # Builds given a rare error line to find
+
+QUERIES = {
+    'rare_phrase': '"undefined reference" needle_symbol',
+    'rare_word': 'needle_symbol',
+    'common_word': 'compiling',
+    'common_phrase': '"compiling module_42.c"',
+    'prefix': 'modul*',
+    'no_match': 'nonexistentword',
+}
+
+
+def add_needles(db, Build, rng):
+    """Append a rare error line to the logs of a few builds."""
+    build_ids = [row.id for row in db.session.query(Build.id).all()]
+    for build_id in rng.sample(build_ids, min(NEEDLE_BUILDS, len(build_ids))):
+        db.session.query(Build).filter(Build.id == build_id).update(
+            {'log': Build.log + "error: undefined reference to `needle_symbol'\n"}, synchronize_session=False)
+    db.session.commit()
+
+
+def run(args):
+    with TempWorkspace(keep=args.keep) as workspace:
+        db_path = args.db
+        if not db_path:
+            db_path = workspace.db_path
+            print(f'Seeding {args.builds} builds into a temporary database...')
+            seed(db_path, configs=args.configs, builds=args.builds, log_lines=args.log_lines, running=0)
+            seeded = True
+        else:
+            use_database(db_path)
+            seeded = False
+
+        from cicd_server import app, db
+        from cicd_server.models import Build, BuildLogChunk
+        from cicd_server.services.log_search import backfill_log_index, search_logs
+        from cicd_server.utils.migration import migrate_add_missing_columns, migrate_add_missing_indexes, \
+            migrate_add_log_search_index
+
+        migrate_add_missing_columns()
+        migrate_add_missing_indexes()
+        migrate_add_log_search_index()
+
+        with app.app_context():
+            if seeded:
+                add_needles(db, Build, random.Random(args.seed))
+
+            started = time.perf_counter()
+            indexed_builds = backfill_log_index()
+            backfill_seconds = time.perf_counter() - started
+
+            chunks, lines = db.session.query(db.func.count(BuildLogChunk.id), db.func.sum(BuildLogChunk.line_count)).one()
+            print(f'Indexed {indexed_builds} builds ({lines or 0} lines in {chunks} chunks) in {backfill_seconds:.1f}s')
+
+            results = {
+                'parameters': {'builds': db.session.query(db.func.count(Build.id)).scalar(), 'lines': lines or 0},
+                'database_bytes': os.path.getsize(db_path),
+                'backfill': {
+                    'builds': indexed_builds,
+                    'seconds': backfill_seconds,
+                    'lines_per_second': (lines or 0) / backfill_seconds if backfill_seconds else 0,
+                },
+                'queries': {},
+            }
+
+            for name, query in QUERIES.items():
+                search_logs(query)  # Warm up the page cache
+                latencies = []
+                for _ in range(args.iterations):
+                    query_started = time.perf_counter()
+                    found = search_logs(query)
+                    latencies.append(time.perf_counter() - query_started)
+                result = summarize(latencies)
+                result['builds_found'] = len(found)
+                results['queries'][name] = result
+                print(f"{name:15s} {query!r:40s} p50={result['p50'] * 1000:8.2f}ms p99={result['p99'] * 1000:8.2f}ms "
+                      f"builds={len(found)}")
+            db.engine.dispose()
+
+    if args.output:
+        write_results(args.output, results)
+    baseline = load_baseline(args.baseline)
+    if baseline:
+        print('\nComparison with baseline:')
+        compare_results(results, baseline)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark indexing and searching build logs')
+    parser.add_argument('--db', help='Existing seeded database to index and search instead of seeding a temporary one')
+    parser.add_argument('--configs', type=int, default=10, help='Number of configurations to seed')
+    parser.add_argument('--builds', type=int, default=10000, help='Number of builds to seed')
+    parser.add_argument('--log-lines', type=int, default=200, help='Mean log lines per seeded build')
+    parser.add_argument('--iterations', type=int, default=20, help='Measured searches per query')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    parser.add_argument('--baseline', help='Compare results with this JSON file')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary database')
+    args = parser.parse_args(argv)
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+﻿"""
+Read Path Benchmark
+
+Measures latency and SQL statement counts of the dashboard, the build read APIs and the
+build service functions against a seeded build history, and writes the results to JSON
+so they can be compared between runs. With --check-budgets, it fails if an endpoint
+executes more SQL statements than its query budget (see utils.profiling.query_budget).
+
+Usage:
+    python -m benchmarks.read_paths --builds 200000 --output read_paths.json
+    python -m benchmarks.read_paths --db history.db --baseline read_paths.json
+    python -m benchmarks.read_paths --builds 5000 --check-budgets
+"""
+
+import argparse
+import os
+import time
+
+from benchmarks.common import TempWorkspace, use_database, summarize, write_results, compare_results, \
+    load_baseline, ADMIN_USERNAME, ADMIN_PASSWORD
+from benchmarks.seed_history import seed
+
+
+class QueryCounter:
+    """Counts SQL statements executed through any SQLAlchemy engine."""
+
+    def __init__(self):
+        self.count = 0
+
+    def install(self):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        event.listen(Engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args, **kwargs):
+        self.count += 1
+
+
+def measure(func, iterations, counter):
+    """Call a function repeatedly, returning latency statistics and SQL statements per call."""
+    func()  # Warm up caches and connections
+    latencies = []
+    queries = []
+    for _ in range(iterations):
+        before = counter.count
+        started = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - started)
+        queries.append(counter.count - before)
+    result = summarize(latencies)
+    result['queries'] = max(queries)
+    return result
+
+
+def run(args):
+    with TempWorkspace(keep=args.keep) as workspace:
+        db_path = args.db
+        if not db_path:
+            db_path = workspace.db_path
+            print(f'Seeding {args.builds} builds into a temporary database...')
+            seed(db_path, configs=args.configs, builds=args.builds, log_lines=args.log_lines)
+        else:
+            use_database(db_path)
+
+        from cicd_server import app, db
+        from cicd_server.models import Build
+        import cicd_server.routes  # noqa: F401 - registers the routes
+        import cicd_server.api  # noqa: F401 - registers the API endpoints
+        from cicd_server.services.build_service import calculate_build_progress, get_most_recent_similar_build
+
+        counter = QueryCounter()
+        counter.install()
+
+        client = app.test_client()
+        response = client.post('/login', data={'username': ADMIN_USERNAME, 'password': ADMIN_PASSWORD})
+        if response.status_code >= 400:
+            raise RuntimeError('Login failed; seed the database with benchmarks.seed_history first')
+
+        with app.app_context():
+            total_builds = Build.query.count()
+            latest_id = db.session.query(db.func.max(Build.id)).scalar()
+            running = Build.query.filter_by(status='running').order_by(Build.id.desc()).first()
+            running_id = running.id if running else latest_id
+            config_id = db.session.get(Build, running_id).config_id
+            oldest_id = db.session.query(db.func.min(Build.id)).scalar()
+        last_page = max(1, (total_builds + 9) // 10)
+
+        def get(path):
+            def call():
+                response = client.get(path)
+                if response.status_code != 200:
+                    raise RuntimeError(f'{path} returned {response.status_code}')
+            return call
+
+        paths = {
+            'dashboard': '/dashboard',
+            'dashboard_last_page': f'/dashboard?page={last_page}',
+            'api_latest_build': '/api/latest_build',
+            'api_build_progress_running': f'/api/build_progress/{running_id}',
+            'api_build_progress_oldest': f'/api/build_progress/{oldest_id}',
+            'api_build_log': f'/api/build_log/{running_id}',
+            'api_build_log_segments': f'/api/builds/{running_id}/log/segments',
+            'build_detail': f'/build/{running_id}',
+            'config': '/config',
+            'config_edit': f'/config/edit/{config_id}',
+            'api_analytics_configs': '/api/analytics/configs?window=all',
+            'api_analytics_trend': f'/api/analytics/configs/{config_id}/trend?window=all',
+            'api_analytics_steps': f'/api/analytics/configs/{config_id}/steps?window=all',
+        }
+        endpoints = {name: get(path) for name, path in paths.items()}
+        # Query budgets of the views the paths are routed to
+        url_adapter = app.url_map.bind('localhost')
+        budgets = {name: getattr(app.view_functions[url_adapter.match(path.split('?')[0])[0]], 'query_budget', None)
+                   for name, path in paths.items()}
+
+        def similar_build():
+            with app.app_context():
+                get_most_recent_similar_build(running_id)
+
+        def build_progress():
+            with app.app_context():
+                build = db.session.get(Build, running_id)
+                calculate_build_progress(build, get_most_recent_similar_build(running_id))
+
+        services = {
+            'get_most_recent_similar_build': similar_build,
+            'calculate_build_progress': build_progress,
+        }
+
+        results = {
+            'parameters': {'builds': total_builds, 'iterations': args.iterations},
+            'database_bytes': os.path.getsize(db_path),
+            'endpoints': {},
+            'services': {},
+        }
+        over_budget = []
+        for group, funcs in (('endpoints', endpoints), ('services', services)):
+            for name, func in funcs.items():
+                if args.only and name not in args.only:
+                    continue
+                result = measure(func, args.iterations, counter)
+                results[group][name] = result
+                budget = budgets.get(name)
+                if budget is not None:
+                    result['query_budget'] = budget
+                    if result['queries'] > budget:
+                        over_budget.append(name)
+                print(f"{name:32s} p50={result['p50'] * 1000:9.2f}ms p99={result['p99'] * 1000:9.2f}ms "
+                      f"queries={result['queries']}" + (f"/{budget}" if budget is not None else ''))
+
+    if args.output:
+        write_results(args.output, results)
+    baseline = load_baseline(args.baseline)
+    if baseline:
+        print('\nComparison with baseline:')
+        compare_results(results, baseline)
+    if args.check_budgets and over_budget:
+        raise SystemExit(f"Over their query budget: {', '.join(over_budget)}")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark dashboard, API and service read paths')
+    parser.add_argument('--db', help='Existing seeded database to benchmark instead of seeding a temporary one')
+    parser.add_argument('--configs', type=int, default=10, help='Number of configurations to seed')
+    parser.add_argument('--builds', type=int, default=50000, help='Number of builds to seed')
+    parser.add_argument('--log-lines', type=int, default=100, help='Mean log lines per seeded build')
+    parser.add_argument('--iterations', type=int, default=20, help='Measured calls per read path')
+    parser.add_argument('--only', nargs='*', help='Only run the named read paths')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    parser.add_argument('--baseline', help='Compare results with this JSON file')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary database')
+    parser.add_argument('--check-budgets', action='store_true',
+                        help='Exit with an error if an endpoint executes more SQL statements than its query budget')
+    args = parser.parse_args(argv)
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+﻿"""
+Build History Generator
+
+Seeds a database with configurations and a large history of builds with realistic
+log sizes, step timings and status mix, for benchmarking read paths.
+
+Usage:
+    python -m benchmarks.seed_history history.db --configs 20 --builds 1000000
+"""
+
+import argparse
+import datetime
+import json
+import random
+import sqlite3
+import time
+
+from benchmarks.common import use_database, create_admin
+
+BATCH_SIZE = 5000
+
+STATUSES = ['success'] * 85 + ['failed'] * 12 + ['failed-permanently'] * 3
+
+
+def make_log(build_id, branch, steps, lines, rng):
+    """Generate a build log that looks like the ones run_build writes."""
+    parts = [f"Build #{build_id} started\nBranch: {branch}\nProject path: /srv/project\nPayload: {{}}\n\n"]
+    lines_per_step = max(1, lines // max(1, len(steps)))
+    for idx, step in enumerate(steps):
+        parts.append(f"Executing: {step}\n")
+        for line_no in range(lines_per_step):
+            parts.append(f"[{idx}:{line_no:05d}] compiling module_{rng.randrange(10000)}.c "
+                         f"-O2 -Wall ... ok ({rng.random():.3f}s)\n")
+        parts.append(f"Step {idx + 1}/{len(steps)} completed successfully\n\n")
+    return ''.join(parts)
+
+
+def seed(db_path, configs=10, builds=100000, steps=8, log_lines=200, seed_value=42, running=1):
+    """
+    Seed a database with build history.
+
+    Args:
+        db_path (str): The SQLite database file to create or extend
+        configs (int): Number of configurations to create
+        builds (int): Number of builds to create
+        steps (int): Maximum number of steps per configuration
+        log_lines (int): Mean number of log lines per build
+        seed_value (int): Random seed, so runs are reproducible
+        running (int): Number of builds at the end of the history to leave running
+    """
+    use_database(db_path)
+    from cicd_server import app, db
+    from cicd_server.models import User, Config, Build
+
+    rng = random.Random(seed_value)
+
+    with app.app_context():
+        db.create_all()
+        create_admin(db, User)
+
+        config_rows = []
+        for i in range(configs):
+            step_count = rng.randint(max(1, steps // 2), steps)
+            config = Config(
+                name=f'history-{i}',
+                project_path=f'/srv/project-{i}',
+                build_steps='\n'.join(f'make target_{j}' for j in range(step_count)),
+                api_token=f'history-token-{i}'
+            )
+            db.session.add(config)
+            config_rows.append(config)
+        db.session.commit()
+        config_info = [(c.id, c.build_steps.split('\n'), rng.uniform(30, 600)) for c in config_rows]
+        db.engine.dispose()
+
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('PRAGMA journal_mode = MEMORY')
+        next_id = (conn.execute('SELECT MAX(id) FROM build').fetchone()[0] or 0) + 1
+        started = datetime.datetime.utcnow() - datetime.timedelta(minutes=builds * 5)
+        batch = []
+        step_batch = []
+        insert_started = time.time()
+
+        for n in range(builds):
+            build_id = next_id + n
+            config_id, config_steps, mean_duration = config_info[rng.randrange(len(config_info))]
+            duration = max(1.0, rng.gauss(mean_duration, mean_duration * 0.15))
+            started_at = started + datetime.timedelta(minutes=n * 5, seconds=rng.uniform(0, 60))
+            is_running = n >= builds - running
+            status = 'running' if is_running else rng.choice(STATUSES)
+
+            # Steps run until the end, or until a failing step
+            completed_steps = len(config_steps)
+            if status != 'success' and not is_running:
+                completed_steps = rng.randint(1, len(config_steps))
+            if is_running:
+                completed_steps = max(1, len(config_steps) // 2)
+
+            step_times = {}
+            step_duration = duration / len(config_steps)
+            for idx in range(completed_steps):
+                step_times[str(idx)] = round(step_duration * idx, 6)
+                step_started = started_at + datetime.timedelta(seconds=step_duration * idx)
+                is_current = is_running and idx == completed_steps - 1
+                failed = status != 'success' and idx == completed_steps - 1
+                step_batch.append((
+                    build_id, config_id, idx, None, step_started.isoformat(sep=' '),
+                    None if is_current else (step_started + datetime.timedelta(seconds=step_duration)).isoformat(sep=' '),
+                    None if is_current else (1 if failed else 0), 0
+                ))
+
+            lines = max(1, int(rng.expovariate(1.0 / log_lines)))
+            branch = rng.choice(['main', 'develop', f'feature/{rng.randrange(500)}'])
+            queued_at = started_at - datetime.timedelta(seconds=rng.expovariate(1.0 / 30))
+            batch.append((
+                build_id, status, branch, f'/srv/project-{config_id}',
+                queued_at.isoformat(sep=' '), started_at.isoformat(sep=' '),
+                None if is_running else (started_at + datetime.timedelta(seconds=duration)).isoformat(sep=' '),
+                make_log(build_id, branch, config_steps[:completed_steps], lines, rng),
+                rng.choice(['webhook', 'webhook', 'webhook', 'bench']),
+                json.dumps({'branch': branch, 'commit': f'{rng.getrandbits(64):016x}'}),
+                len(config_steps), completed_steps, json.dumps(step_times), None, config_id
+            ))
+
+            if len(batch) >= BATCH_SIZE:
+                _insert_builds(conn, batch, step_batch)
+                batch = []
+                step_batch = []
+                print(f'  {n + 1}/{builds} builds ({(n + 1) / (time.time() - insert_started):.0f}/s)', end='\r')
+
+        if batch:
+            _insert_builds(conn, batch, step_batch)
+        conn.execute('ANALYZE')
+        conn.commit()
+    finally:
+        conn.close()
+
+    # The rows above bypass the build service, so compute the statistics rollup from them
+    from cicd_server.services.config_stats import rebuild_config_stats
+    rebuild_config_stats()
+    print(f'\nSeeded {configs} configurations and {builds} builds into {db_path}')
+
+
+def _insert_builds(conn, rows, step_rows):
+    conn.executemany(
+        'INSERT INTO build (id, status, branch, project_path, queued_at, started_at, completed_at, log, '
+        'triggered_by, payload, total_steps, current_step, step_times, queue_position, config_id) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.executemany(
+        'INSERT INTO build_step (build_id, config_id, step_index, command_hash, started_at, finished_at, '
+        'exit_code, cached) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', step_rows)
+    conn.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Seed a database with a large build history')
+    parser.add_argument('db_path', help='SQLite database file to create or extend')
+    parser.add_argument('--configs', type=int, default=10, help='Number of configurations')
+    parser.add_argument('--builds', type=int, default=100000, help='Number of builds')
+    parser.add_argument('--steps', type=int, default=8, help='Maximum steps per configuration')
+    parser.add_argument('--log-lines', type=int, default=200, help='Mean log lines per build')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+    parser.add_argument('--running', type=int, default=1, help='Builds at the end of the history left running')
+    args = parser.parse_args(argv)
+    seed(args.db_path, args.configs, args.builds, args.steps, args.log_lines, args.seed, args.running)
+
+
+if __name__ == '__main__':
+    main()
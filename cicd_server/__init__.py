@@ -15,6 +15,10 @@ import logging
 import threading
 import json
 
+from cicd_server.utils.profiling import TimedLock, init_request_timing
+from cicd_server.utils.compression import init_compression
+from cicd_server.utils.emitter import CoalescingEmitter
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -22,8 +26,37 @@ logger = logging.getLogger(__name__)
 # Initialize Flask app
 app = Flask(__name__, template_folder='../templates')
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev_key_' + str(uuid.uuid4()))
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///cicd.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('CICD_DATABASE_URI', 'sqlite:///cicd.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['METRICS_TOKEN'] = os.environ.get('CICD_METRICS_TOKEN')
+# 'inline' runs builds in server threads, 'worker' leaves queued builds for worker.py processes to claim
+app.config['BUILD_EXECUTION'] = os.environ.get('CICD_BUILD_EXECUTION', 'inline')
+# Maximum Socket.IO frames per second, and packets a client may have waiting before it misses progress updates
+app.config['SOCKETIO_MAX_RATE'] = float(os.environ.get('CICD_SOCKETIO_MAX_RATE', 10))
+app.config['SOCKETIO_MAX_CLIENT_QUEUE'] = int(os.environ.get('CICD_SOCKETIO_MAX_CLIENT_QUEUE', 50))
+# Read build step output in separate processes rather than server threads
+app.config['STEP_OUTPUT_PROCESSES'] = os.environ.get('CICD_STEP_OUTPUT_PROCESSES', 'true').lower() != 'false'
+# Re-queue builds interrupted by a server restart to resume from their last resumable step, instead of failing them
+app.config['RESUME_INTERRUPTED_BUILDS'] = os.environ.get('CICD_RESUME_INTERRUPTED_BUILDS', 'false').lower() == 'true'
+# Directory for the git worktrees builds of configurations with isolated workspaces run in, the number of
+# idle worktrees kept per configuration, and the disk space in megabytes they may use before old ones are removed
+app.config['WORKSPACE_ROOT'] = os.path.abspath(os.environ.get('CICD_WORKSPACE_ROOT', 'workspaces'))
+app.config['WORKSPACE_POOL_SIZE'] = int(os.environ.get('CICD_WORKSPACE_POOL_SIZE', 2))
+app.config['WORKSPACE_MAX_BYTES'] = int(os.environ.get('CICD_WORKSPACE_MAX_MB', 20480)) * 1024 * 1024
+# Prepare the workspace of the next queued build of each configuration with isolated workspaces in the background
+app.config['PREFETCH_WORKSPACES'] = os.environ.get('CICD_PREFETCH_WORKSPACES', 'true').lower() != 'false'
+# Longest time a long-polling API request (?wait=) is held open waiting for a change
+app.config['LONG_POLL_MAX_SECONDS'] = float(os.environ.get('CICD_LONG_POLL_MAX_SECONDS', 30))
+# Seconds the logged-in user's account is cached for instead of being queried on every request, 0 to disable
+app.config['USER_CACHE_SECONDS'] = float(os.environ.get('CICD_USER_CACHE_SECONDS', 30))
+# Fail requests that execute more SQL statements than their endpoint's query budget, instead of logging a warning
+app.config['ENFORCE_QUERY_BUDGETS'] = os.environ.get('CICD_ENFORCE_QUERY_BUDGETS', 'false').lower() == 'true'
+# Most builds one request to the batch webhook endpoint may trigger
+app.config['WEBHOOK_BATCH_LIMIT'] = int(os.environ.get('CICD_WEBHOOK_BATCH_LIMIT', 100))
+# Rendered dashboard rows and build details of finished builds kept in memory
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('CICD_FRAGMENT_CACHE_SIZE', 2000))
+# Gzip HTML responses for clients that accept it
+app.config['GZIP_RESPONSES'] = os.environ.get('CICD_GZIP_RESPONSES', 'true').lower() == 'true'
 
 # Add built-in functions to Jinja2 environment
 app.jinja_env.globals.update(max=max, min=min)
@@ -51,10 +84,18 @@ login_manager.login_view = 'login'
 
 # Initialize SocketIO
 socketio = SocketIO(app, cors_allowed_origins="*")
+emitter = CoalescingEmitter(socketio, max_rate=app.config['SOCKETIO_MAX_RATE'],
+                            max_client_queue=app.config['SOCKETIO_MAX_CLIENT_QUEUE'])
+
+# Record per-request latency, SQL statement counts and Server-Timing headers
+init_request_timing(app)
+
+# Gzip HTML responses
+init_compression(app)
 
 # Global variable to track if a build is in progress
 build_in_progress = False
-build_lock = threading.Lock()
+build_lock = TimedLock('build_lock')
 
 # Import routes after app is initialized to avoid circular imports
 # Note: These imports are here to avoid circular imports, but they are not used directly.
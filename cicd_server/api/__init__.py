@@ -5,7 +5,7 @@ This package contains the API endpoints for the CICD Server application.
 """
 
 # Import all API modules to register the endpoints with Flask
-from cicd_server.api import build_api, webhook
+from cicd_server.api import build_api, webhook, metrics, analytics_api, log_stream, log_search_api
 
 # List of all API modules for easier importing
-__all__ = ['build_api', 'webhook']
+__all__ = ['build_api', 'webhook', 'metrics', 'analytics_api', 'log_stream', 'log_search_api']
@@ -0,0 +1,88 @@
+﻿"""
+Analytics API Endpoints
+
+This module contains the API endpoints for build analytics: duration trends, success rates,
+queue wait distributions and the slowest steps of each configuration.
+"""
+
+from flask import jsonify, request
+from flask_login import login_required
+
+from cicd_server import app
+from cicd_server.models import Config
+from cicd_server.services.analytics import parse_window, get_config_summary, get_config_summaries, \
+    get_duration_trend, get_slowest_steps
+from cicd_server.utils.profiling import query_budget
+
+def get_window(default):
+    """Get and validate the window query parameter, returning (window, error response)."""
+    window = request.args.get('window', default)
+    try:
+        parse_window(window)
+    except ValueError as e:
+        return None, (jsonify({'status': 'error', 'message': str(e)}), 400)
+    return window, None
+
+@app.route('/api/analytics/configs', methods=['GET'])
+@login_required
+@query_budget(5)
+def api_analytics_configs():
+    """API endpoint to get the analytics summary of every configuration"""
+    window, error = get_window('30d')
+    if error:
+        return error
+
+    configs = Config.query.order_by(Config.name).all()
+    summaries = get_config_summaries([config.id for config in configs], window)
+    return jsonify({
+        'window': window,
+        'configs': [dict(summaries[config.id], config_name=config.name) for config in configs]
+    })
+
+@app.route('/api/analytics/configs/<int:config_id>/summary', methods=['GET'])
+@login_required
+@query_budget(6)
+def api_analytics_summary(config_id):
+    """API endpoint to get build counts, success rate, duration and queue wait statistics"""
+    config = Config.query.get_or_404(config_id)
+    window, error = get_window('30d')
+    if error:
+        return error
+
+    return jsonify(dict(get_config_summary(config.id, window), config_name=config.name))
+
+@app.route('/api/analytics/configs/<int:config_id>/trend', methods=['GET'])
+@login_required
+@query_budget(5)
+def api_analytics_trend(config_id):
+    """API endpoint to get a downsampled time series of build durations and success rate"""
+    config = Config.query.get_or_404(config_id)
+    window, error = get_window('365d')
+    if error:
+        return error
+    points = request.args.get('points', 300, type=int)
+
+    return jsonify({
+        'config_id': config.id,
+        'config_name': config.name,
+        'window': window,
+        'points': get_duration_trend(config.id, window, points)
+    })
+
+@app.route('/api/analytics/configs/<int:config_id>/steps', methods=['GET'])
+@login_required
+@query_budget(5)
+def api_analytics_steps(config_id):
+    """API endpoint to get the slowest steps of a configuration"""
+    config = Config.query.get_or_404(config_id)
+    window, error = get_window('30d')
+    if error:
+        return error
+    limit = request.args.get('limit', 10, type=int)
+
+    return jsonify({
+        'config_id': config.id,
+        'config_name': config.name,
+        'window': window,
+        'steps': get_slowest_steps(config.id, window, limit)
+    })
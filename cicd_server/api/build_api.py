@@ -4,42 +4,101 @@ Build API Endpoints
 This module contains the API endpoints for build-related operations.
 """
 
-from flask import jsonify
+from flask import abort, jsonify, request
 from flask_login import login_required
 
-from cicd_server import app
-from cicd_server.models import Build
+from cicd_server import app, db
+from cicd_server.models import Build, BuildGroup, UNFINISHED_STATUSES
+from cicd_server.services.build_log import LogLines, MAX_LINES_PER_READ, get_log_segments
 from cicd_server.services.build_service import calculate_build_progress
+from cicd_server.services.live_builds import live_builds
+from cicd_server.services.matrix import summarize_group
 from cicd_server.utils.helpers import prepare_time_data, prepare_estimated_remaining_data
+from cicd_server.utils.profiling import query_budget
+from cicd_server.utils.versions import build_versions, LATEST_BUILD_KEY
+
+
+def versioned_response(key, build_response):
+    """
+    Answer a request for data that only changes when a version counter key is bumped.
+
+    Responses carry the version as an ETag, and a request whose If-None-Match matches the
+    current version gets a 304 without the database being queried. With ?wait=<seconds>, a
+    request whose version (from ?since=<version> or If-None-Match) is still current is held
+    until the version changes or the wait times out.
+
+    Args:
+        key: The version counter key the data depends on
+        build_response (callable): Called with the version to build the full response
+
+    Returns:
+        Response: The response, or a 304 response
+    """
+    since = request.args.get('since', type=int)
+    if since is None:
+        for etag in request.if_none_match.as_set():
+            since = build_versions.version_from_etag(etag)
+            if since is not None:
+                break
+
+    # Read the version before the data, so a change made meanwhile is seen by the next request
+    version = build_versions.current(key)
+    wait = min(request.args.get('wait', 0, type=float), app.config['LONG_POLL_MAX_SECONDS'])
+    if wait > 0 and since == version:
+        version = build_versions.wait(key, since, wait)
+
+    etag = build_versions.etag(version)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = build_response(version)
+    response.set_etag(etag)
+    # Clients may keep responses, but must revalidate them with If-None-Match
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 
 @app.route('/api/build_progress/<int:build_id>', methods=['GET'])
 @login_required
+@query_budget(6)
 def api_build_progress(build_id):
-    """API endpoint to get build progress data for AJAX updates"""
-    build = Build.query.get_or_404(build_id)
-    progress_data = calculate_build_progress(build)
-
-    # Format times for display
-    formatted_data = {
-        'percent': progress_data['percent'],
-        'current_step': progress_data['current_step'],
-        'total_steps': progress_data['total_steps'],
-        'elapsed_time': prepare_time_data(progress_data['elapsed_time']),
-        'steps_overdue': progress_data['steps_overdue'],
-        'status': build.status,
-        'config_id': build.config_id,
-        'config_name': build.config.name,
-        'estimated_remaining': prepare_estimated_remaining_data(progress_data)
-    }
+    """
+    API endpoint to get build progress data for AJAX updates.
 
-    response = jsonify(formatted_data)
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
-    return response
+    Supports conditional requests and long-polling, see versioned_response(). A running build's
+    version changes with every progress update, so the elapsed time is at most a second old.
+    Running builds are answered from their live state without querying the database.
+    """
+    def build_response(version):
+        build = live_builds.get(build_id)
+        if build is not None:
+            progress_data = build.progress()
+            config_name = build.config_name
+        else:
+            build = Build.query.get_or_404(build_id)
+            progress_data = calculate_build_progress(build)
+            config_name = build.config.name
+
+        # Format times for display
+        formatted_data = {
+            'percent': progress_data['percent'],
+            'current_step': progress_data['current_step'],
+            'total_steps': progress_data['total_steps'],
+            'elapsed_time': prepare_time_data(progress_data['elapsed_time']),
+            'steps_overdue': progress_data['steps_overdue'],
+            'status': build.status,
+            'config_id': build.config_id,
+            'config_name': config_name,
+            'estimated_remaining': prepare_estimated_remaining_data(progress_data),
+            'version': version
+        }
+        return jsonify(formatted_data)
+
+    return versioned_response(build_id, build_response)
 
 @app.route('/api/build_log/<int:build_id>', methods=['GET'])
 @login_required
+@query_budget(5)
 def api_build_log(build_id):
     """API endpoint to get build log for AJAX updates"""
     build = Build.query.get_or_404(build_id)
@@ -56,22 +115,98 @@ def api_build_log(build_id):
     response.headers['Expires'] = '0'
     return response
 
+@app.route('/api/builds/<int:build_id>/log/segments', methods=['GET'])
+@login_required
+@query_budget(8)
+def api_build_log_segments(build_id):
+    """
+    API endpoint to get the segments of a build's log: its setup lines, the output of each
+    step and its result lines, with the line numbers of each, but not the lines themselves.
+    """
+    build = Build.query.get_or_404(build_id)
+    segments, total_lines = get_log_segments(build)
+    response = jsonify({
+        'build_id': build.id,
+        'status': build.status,
+        'total_lines': total_lines,
+        'segments': segments
+    })
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/builds/<int:build_id>/log/lines', methods=['GET'])
+@login_required
+@query_budget(8)
+def api_build_log_lines(build_id):
+    """
+    API endpoint to get a range of lines of a build's log.
+
+    Lines are numbered from 1, from ?start for ?count lines (at most MAX_LINES_PER_READ). With
+    ?step=<step index>, the range is within the output of that step, starting from its first
+    line, rather than within the whole log.
+
+    The lines of a finished build never change, so browsers may reuse them without asking again.
+    """
+    build = Build.query.get_or_404(build_id)
+    start = max(request.args.get('start', 1, type=int), 1)
+    count = min(max(request.args.get('count', 500, type=int), 0), MAX_LINES_PER_READ)
+
+    log_lines = LogLines(build)
+    step_index = request.args.get('step', type=int)
+    if step_index is not None:
+        segments, _ = get_log_segments(build, log_lines)
+        segment = next((segment for segment in segments
+                        if segment['kind'] == 'step' and segment['step_index'] == step_index), None)
+        if segment is None:
+            abort(404)
+        count = max(min(count, segment['line_count'] - start + 1), 0)
+        start += segment['first_line'] - 1
+
+    response = jsonify({
+        'build_id': build.id,
+        'status': build.status,
+        'start': start,
+        'lines': log_lines.read(start, count),
+        'total_lines': log_lines.total_lines
+    })
+    if build.status in UNFINISHED_STATUSES:
+        response.headers['Cache-Control'] = 'no-cache'
+    else:
+        response.headers['Cache-Control'] = 'private, max-age=86400'
+    return response
+
 @app.route('/api/latest_build', methods=['GET'])
 @login_required
+@query_budget(3)
 def api_latest_build():
-    """API endpoint to get the latest build ID for checking new builds"""
-    latest_build = Build.query.order_by(Build.id.desc()).first()
-    if latest_build:
-        response = jsonify({
-            'latest_build_id': latest_build.id,
-            'status': latest_build.status,
-            'triggered_by': latest_build.triggered_by
-        })
-    else:
-        response = jsonify({
-            'latest_build_id': None
+    """
+    API endpoint to get the latest build ID for checking new builds.
+
+    Supports conditional requests and long-polling, see versioned_response(), so clients can
+    wait for a new build or status change with ?wait=30&since=<version>.
+    """
+    def build_response(version):
+        latest_build = Build.query.order_by(Build.id.desc()).first()
+        if latest_build:
+            return jsonify({
+                'latest_build_id': latest_build.id,
+                'status': latest_build.status,
+                'triggered_by': latest_build.triggered_by,
+                'version': version
+            })
+        return jsonify({
+            'latest_build_id': None,
+            'version': version
         })
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
-    return response
+
+    return versioned_response(LATEST_BUILD_KEY, build_response)
+
+
+@app.route('/api/build_groups/<int:group_id>', methods=['GET'])
+@login_required
+@query_budget(5)
+def api_build_group(group_id):
+    """API endpoint to get the aggregate status and progress of a build matrix's builds"""
+    group = BuildGroup.query.options(db.joinedload(BuildGroup.config), db.selectinload(BuildGroup.builds)) \
+        .get_or_404(group_id)
+    return jsonify(summarize_group(group))
@@ -0,0 +1,40 @@
+﻿"""
+Log Search API Endpoint
+
+This module contains the API endpoint for full-text search across build logs.
+"""
+
+from flask import jsonify, request
+from flask_login import login_required
+
+from cicd_server import app
+from cicd_server.services.log_search import search_logs, log_search_available
+
+MAX_SEARCH_BUILDS = 100
+
+@app.route('/api/logs/search', methods=['GET'])
+@login_required
+def api_search_logs():
+    """API endpoint to find builds whose logs contain the given words, with the matching lines"""
+    if not log_search_available():
+        return jsonify({'status': 'error', 'message': 'Log search is not available on this database'}), 501
+
+    search_text = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_SEARCH_BUILDS)
+    results = search_logs(search_text,
+                          config_id=request.args.get('config_id', type=int),
+                          before_build_id=request.args.get('before', type=int),
+                          max_builds=limit)
+
+    return jsonify({
+        'query': search_text,
+        'builds': [dict(result,
+                        started_at=result['started_at'].isoformat() if result['started_at'] else None,
+                        lines=[{'line': line['line'],
+                                'text': ''.join(segment for segment, _ in line['segments']),
+                                'matches': [segment for segment, matched in line['segments'] if matched]}
+                               for line in result['lines']])
+                   for result in results],
+        # Pass as ?before= to get the next page
+        'next_before': results[-1]['build_id'] if len(results) == limit else None
+    })
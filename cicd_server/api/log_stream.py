@@ -0,0 +1,131 @@
+﻿"""
+Build Log Stream Endpoint
+
+This module contains the endpoint that streams a build's log to scripts and command line
+clients, as Server-Sent Events or plain text, following new output until the build finishes.
+"""
+
+import json
+
+from flask import request, Response, jsonify
+
+from cicd_server import app, db
+from cicd_server.models import Build, Config, UNFINISHED_STATUSES
+from cicd_server.utils.metrics import LOG_STREAMS_OPEN
+from cicd_server.utils.versions import build_versions
+
+LOG_STREAM_CHUNK_CHARS = 65536  # Most log text read from the database and sent at once
+LOG_STREAM_KEEPALIVE_SECONDS = 15.0  # Longest silence before a keepalive, which also detects closed connections
+
+
+def read_log_state(build_id, offset):
+    """
+    Read a build's status and the next chunk of its log after an offset.
+
+    The log is sliced in the database, so only one chunk is held in memory however long
+    the log is. Each read uses its own short transaction, so a waiting stream doesn't keep
+    the database locked.
+
+    Returns:
+        tuple: (status, log length, log text from offset), with text of at most LOG_STREAM_CHUNK_CHARS
+    """
+    with app.app_context():
+        status, length, chunk = db.session.query(
+            Build.status,
+            db.func.length(Build.log),
+            db.func.substr(Build.log, offset + 1, LOG_STREAM_CHUNK_CHARS)
+        ).filter(Build.id == build_id).one()
+        return status, length or 0, chunk or ''
+
+
+def format_sse(event, data, event_id=None):
+    """Format one Server-Sent Event, splitting multi-line data into data fields."""
+    lines = [f'event: {event}']
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.extend(f'data: {line}' for line in data.replace('\r\n', '\n').replace('\r', '\n').split('\n'))
+    return '\n'.join(lines) + '\n\n'
+
+
+def follow_log(build_id, offset, sse):
+    """
+    Generate a build's log from an offset, then its new output until the build finishes.
+
+    Args:
+        build_id (int): The ID of the build
+        offset (int): The number of log characters the client already has
+        sse (bool): Whether to format output as Server-Sent Events rather than plain text
+
+    Yields:
+        str: Log text, keepalives and, at the end, the build's final status
+    """
+    LOG_STREAMS_OPEN.inc()
+    try:
+        last_status = None
+        while True:
+            # Read the version first, so a change made while reading wakes the wait below
+            version = build_versions.current(build_id)
+            status, length, chunk = read_log_state(build_id, offset)
+
+            # An offset past the end of the log follows from the end
+            offset = min(offset, length)
+            if chunk:
+                offset += len(chunk)
+                yield format_sse('log', chunk, offset) if sse else chunk
+                if offset < length:
+                    continue
+
+            finished = status not in UNFINISHED_STATUSES
+            if sse and (status != last_status or finished):
+                yield format_sse('status', json.dumps({
+                    'build_id': build_id,
+                    'status': status,
+                    'offset': offset,
+                    'finished': finished
+                }))
+            last_status = status
+            if finished:
+                if not sse:
+                    yield f'\n[Build #{build_id} finished with status: {status}]\n'
+                return
+
+            if build_versions.wait(build_id, version, LOG_STREAM_KEEPALIVE_SECONDS) == version and sse:
+                yield ': keepalive\n\n'
+    finally:
+        LOG_STREAMS_OPEN.dec()
+
+
+@app.route('/api/builds/<int:build_id>/log/stream', methods=['GET'])
+def stream_build_log(build_id):
+    """
+    Stream a build's log, following new output until the build finishes.
+
+    Authenticated with a configuration's API token, as the webhook is, in the X-API-Token
+    header or as an Authorization: Bearer token. Clients that send Accept: text/event-stream
+    or ?format=sse get Server-Sent Events: 'log' events whose ID is the log offset after them,
+    and 'status' events, the last of which has finished set. Other clients get the log as
+    plain text, ending with a line giving the final status. ?offset=<characters>, or the
+    Last-Event-ID header of a reconnecting event stream, skips log text the client already has.
+    """
+    token = request.headers.get('X-API-Token')
+    auth_header = request.headers.get('Authorization', '')
+    if auth_header.startswith('Bearer '):
+        token = auth_header[len('Bearer '):]
+    if not token or not Config.query.filter_by(api_token=token).first():
+        return jsonify({'status': 'error', 'message': 'Invalid API token'}), 401
+
+    if not db.session.query(Build.id).filter_by(id=build_id).first():
+        return jsonify({'status': 'error', 'message': f'Build #{build_id} not found'}), 404
+
+    offset = request.headers.get('Last-Event-ID', type=int)
+    if offset is None:
+        offset = request.args.get('offset', 0, type=int)
+    sse = request.args.get('format') == 'sse' or \
+        request.accept_mimetypes.best_match(['text/plain', 'text/event-stream']) == 'text/event-stream'
+
+    response = Response(follow_log(build_id, max(offset, 0), sse),
+                        mimetype='text/event-stream' if sse else 'text/plain')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop reverse proxies such as nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,47 @@
+﻿"""
+Metrics API Endpoint
+
+This module contains the endpoint that exposes server metrics in the Prometheus text format.
+"""
+
+from flask import request, Response, jsonify
+
+from cicd_server import app, db
+from cicd_server.models import Build, Config, ACTIVE_STATUSES
+from cicd_server.services import build_service
+from cicd_server.utils.metrics import registry, QUEUE_LENGTH, BUILDS_IN_PROGRESS
+
+@registry.add_collector
+def collect_queue_lengths():
+    """Refresh the queue length gauge from the database."""
+    with app.app_context():
+        counts = dict(db.session.query(Config.name, db.func.count(Build.id))
+                      .outerjoin(Build, db.and_(Build.config_id == Config.id, Build.status == 'queued'))
+                      .group_by(Config.id).all())
+    QUEUE_LENGTH.clear()
+    for config_name, count in counts.items():
+        QUEUE_LENGTH.set(count, config=config_name)
+
+@registry.add_collector
+def collect_builds_in_progress():
+    """Refresh the builds in progress gauge from the scheduler state, or the database when workers run builds."""
+    if build_service.uses_workers():
+        with app.app_context():
+            BUILDS_IN_PROGRESS.set(Build.query.filter(Build.status.in_(ACTIVE_STATUSES)).count())
+        return
+    BUILDS_IN_PROGRESS.set(1 if build_service.build_in_progress else 0)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Metrics endpoint for Prometheus-compatible scrapers"""
+    # If a metrics token is configured, require it
+    token = app.config.get('METRICS_TOKEN')
+    if token:
+        provided = request.headers.get('X-API-Token')
+        auth_header = request.headers.get('Authorization', '')
+        if auth_header.startswith('Bearer '):
+            provided = auth_header[len('Bearer '):]
+        if provided != token:
+            return jsonify({'status': 'error', 'message': 'Invalid metrics token'}), 401
+
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
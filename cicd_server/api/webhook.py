@@ -1,19 +1,33 @@
 ﻿"""
 Webhook API Endpoint
 
-This module contains the webhook API endpoint for triggering builds from external systems.
+This module contains the webhook API endpoints for triggering builds from external systems.
 """
 
 from flask import request, jsonify
+from sqlalchemy import or_
 import json
+import time
 
 from cicd_server import app, logger
 from cicd_server.models import Config
-from cicd_server.services.build_service import trigger_build_with_config
+from cicd_server.services.build_service import trigger_build_with_config, queue_builds
+from cicd_server.services.matrix import summarize_group
+from cicd_server.utils.metrics import WEBHOOK_SECONDS
+from cicd_server.utils.profiling import query_budget
 
 @app.route('/api/webhook', methods=['POST'])
+@query_budget(12)
 def webhook():
     """Webhook endpoint for triggering builds from external systems"""
+    started = time.perf_counter()
+    response = handle_webhook()
+    status_code = response[1] if isinstance(response, tuple) else 200
+    WEBHOOK_SECONDS.observe(time.perf_counter() - started, status=status_code)
+    return response
+
+def handle_webhook():
+    """Validate a webhook request and trigger the requested build"""
     # Verify API token
     token = request.headers.get('X-API-Token')
 
@@ -42,24 +56,135 @@ def webhook():
     build, status, message = trigger_build_with_config(config, branch, 'webhook', data)
 
     if status == 'error':
-        return jsonify({
+        return jsonify(trigger_result(config, build, status, message)), 429  # 429 Too Many Requests
+    return jsonify(trigger_result(config, build, status, message))
+
+def trigger_result(config, build, status, message):
+    """
+    Describe the result of a trigger for a webhook response.
+
+    Args:
+        config: The configuration the build was triggered with
+        build, status, message: What trigger_build_with_config() or queue_builds() returned
+
+    Returns:
+        dict: The response data
+    """
+    if status == 'error':
+        return {
             'status': 'error',
             'message': message
-        }), 429  # 429 Too Many Requests
+        }
 
     if status == 'queued':
-        return jsonify({
+        return {
             'status': 'queued',
             'message': message,
             'build_id': build.id,
             'config': config.name,
             'queue_position': build.queue_position
-        })
+        }
+
+    if status == 'matrix':
+        # build is the group of the matrix's builds
+        summary = summarize_group(build)
+        return {
+            'status': 'success',
+            'message': message,
+            'group_id': summary['group_id'],
+            'group_status': summary['status'],
+            'percent': summary['percent'],
+            'config': config.name,
+            'build_ids': [child['build_id'] for child in summary['builds']],
+            'builds': summary['builds']
+        }
 
     # Status must be 'success'
-    return jsonify({
+    return {
         'status': 'success',
         'message': message,
         'build_id': build.id,
         'config': config.name
+    }
+
+@app.route('/api/webhook/batch', methods=['POST'])
+def webhook_batch():
+    """Webhook endpoint for triggering many builds in one request"""
+    started = time.perf_counter()
+    response = handle_webhook_batch()
+    status_code = response[1] if isinstance(response, tuple) else 200
+    WEBHOOK_SECONDS.observe(time.perf_counter() - started, status=status_code)
+    return response
+
+def handle_webhook_batch():
+    """
+    Validate a batch of triggers and queue their builds together.
+
+    The request body has a "triggers" list, each with an optional "config" name or "token"
+    (the configuration's API token), "branch" and "payload". Triggers without either use the
+    configuration of the request's X-API-Token. All the triggers' builds are queued with one
+    lock acquisition and one transaction, and the response has a result for each trigger, in
+    order, like the /api/webhook response for it. Triggers that are invalid or whose
+    configuration's queue is full are rejected without affecting the others.
+    """
+    # Verify API token
+    token = request.headers.get('X-API-Token')
+    default_config = Config.query.filter_by(api_token=token).first() if token else None
+    if not default_config:
+        return jsonify({'status': 'error', 'message': 'Invalid API token'}), 401
+
+    data = request.json or {}
+    items = data.get('triggers')
+    if not isinstance(items, list) or not items:
+        return jsonify({'status': 'error', 'message': 'Expected a non-empty "triggers" list'}), 400
+    limit = app.config['WEBHOOK_BATCH_LIMIT']
+    if len(items) > limit:
+        return jsonify({'status': 'error', 'message': f'At most {limit} triggers can be sent at once'}), 400
+
+    # Look up every configuration the triggers name or have the token of with one query
+    names = {item['config'] for item in items if isinstance(item, dict) and isinstance(item.get('config'), str)}
+    tokens = {item['token'] for item in items if isinstance(item, dict) and isinstance(item.get('token'), str)}
+    configs = Config.query.filter(or_(Config.name.in_(names), Config.api_token.in_(tokens))).all() \
+        if names or tokens else []
+    by_name = {config.name: config for config in configs}
+    by_token = {config.api_token: config for config in configs}
+
+    results = [None] * len(items)
+    triggers = []  # (index, config, branch, payload) of the valid triggers
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = {'status': 'error', 'message': 'Trigger must be an object'}
+            continue
+        if 'token' in item:
+            config = by_token.get(item['token']) if isinstance(item['token'], str) else None
+            if config is None:
+                results[index] = {'status': 'error', 'message': 'Invalid API token'}
+                continue
+        elif 'config' in item:
+            config = by_name.get(item['config']) if isinstance(item['config'], str) else None
+            if config is None:
+                results[index] = {'status': 'error', 'message': f'Configuration "{item["config"]}" not found'}
+                continue
+        else:
+            config = default_config
+        branch = item.get('branch', 'main')
+        payload = item.get('payload', {})
+        if not isinstance(branch, str) or not isinstance(payload, dict):
+            results[index] = {'status': 'error', 'message': 'Trigger "branch" must be a string and "payload" an object'}
+            continue
+        payload = dict(payload)
+        payload.setdefault('branch', branch)
+        triggers.append((index, config, branch, payload))
+
+    if triggers:
+        queued = queue_builds([(config, branch, payload) for _, config, branch, payload in triggers], 'webhook')
+        for (index, config, _, _), (build, status, message) in zip(triggers, queued):
+            results[index] = trigger_result(config, build, status, message)
+
+    rejected = sum(1 for result in results if result['status'] == 'error')
+    return jsonify({
+        'status': 'success' if not rejected else 'error' if rejected == len(results) else 'partial',
+        'queued': len(results) - rejected,
+        'rejected': rejected,
+        'results': results
     })
@@ -4,7 +4,9 @@ Models Package
 This package contains the database models for the CICD Server application.
 """
 
-from cicd_server.models.models import User, Build, Config
+from cicd_server.models.models import User, Build, BuildStep, BuildLogChunk, BuildGroup, Config, ConfigStats, \
+    FINISHED_STATUSES, FAILED_STATUSES, UNFINISHED_STATUSES, ACTIVE_STATUSES
 
 # Import the models to make them available when importing the package
-__all__ = ['User', 'Build', 'Config']
+__all__ = ['User', 'Build', 'BuildStep', 'BuildLogChunk', 'BuildGroup', 'Config', 'ConfigStats',
+           'FINISHED_STATUSES', 'FAILED_STATUSES', 'UNFINISHED_STATUSES', 'ACTIVE_STATUSES']
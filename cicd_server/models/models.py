@@ -5,12 +5,20 @@ This module contains the database models for the CICD Server application.
 """
 
 from flask_login import UserMixin
+from sqlalchemy.ext.hybrid import hybrid_property
 from werkzeug.security import generate_password_hash, check_password_hash
 import datetime
+import json
 import uuid
 
 from cicd_server import db
 
+# Build statuses, see Build.status
+FINISHED_STATUSES = ('success', 'failed', 'failed-permanently')
+FAILED_STATUSES = ('failed', 'failed-permanently')
+UNFINISHED_STATUSES = ('queued', 'pending', 'running')
+ACTIVE_STATUSES = ('pending', 'running')  # Started, or claimed by a worker, and not finished
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(100), unique=True, nullable=False)
@@ -25,23 +33,125 @@ class User(UserMixin, db.Model):
         return check_password_hash(self.password_hash, password)
 
 class Build(db.Model):
+    __table_args__ = (
+        db.Index('ix_build_config_started', 'config_id', 'started_at'),
+        db.Index('ix_build_status_lease', 'status', 'lease_expires_at'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    status = db.Column(db.String(20), default='pending')  # pending, running, success, failed, queued
+    status = db.Column(db.String(20), default='pending')  # One of UNFINISHED_STATUSES or FINISHED_STATUSES
     branch = db.Column(db.String(100))
     project_path = db.Column(db.String(500))
+    queued_at = db.Column(db.DateTime, nullable=True)  # When the build was triggered, before any time spent queued
     started_at = db.Column(db.DateTime)
     completed_at = db.Column(db.DateTime)
-    log = db.Column(db.Text, default='')
+    log = db.deferred(db.Column(db.Text, default=''))  # Only loaded when accessed, since logs can be many megabytes
     triggered_by = db.Column(db.String(100))
     payload = db.Column(db.Text, default='{}')  # Store the webhook payload as JSON string
     total_steps = db.Column(db.Integer, default=0)
     current_step = db.Column(db.Integer, default=0)
-    step_times = db.Column(db.Text, default='{}')  # JSON string storing time each step took from the start of the build
+    # Legacy JSON string of step index -> seconds from the start of the build, only used by builds without BuildStep rows
+    _step_times = db.Column('step_times', db.Text, default='{}')
     queue_position = db.Column(db.Integer, default=None, nullable=True)  # Position in the build queue (null if not queued)
+    worker_id = db.Column(db.String(100), nullable=True)  # Worker that claimed the build, null for builds run by the server
+    lease_expires_at = db.Column(db.DateTime, nullable=True)  # The claim is void after this unless the worker renews it
+    heartbeat_at = db.Column(db.DateTime, nullable=True)  # When the worker last renewed its lease
+    log_indexed = db.Column(db.Integer, nullable=True)  # Log characters split into BuildLogChunk rows, null if not started
+    resume_step = db.Column(db.Integer, nullable=True)  # Index of the step an interrupted build was re-queued to resume from
+    workspace_path = db.Column(db.String(500), nullable=True)  # Worktree the build ran in, if its configuration isolates builds
+    group_id = db.Column(db.Integer, db.ForeignKey('build_group.id'), nullable=True)  # Matrix group the build is part of
+    matrix_values = db.Column(db.Text, nullable=True)  # JSON object of matrix axis -> value, for builds in a matrix group
 
     # Foreign key to Config
     config_id = db.Column(db.Integer, db.ForeignKey('config.id'), nullable=False)
 
+    # Relationship with build steps
+    steps = db.relationship('BuildStep', backref='build', lazy=True, order_by='BuildStep.step_index')
+
+    @hybrid_property
+    def step_times(self):
+        """JSON string of step index -> seconds from the start of the build, derived from the build's steps."""
+        if self.started_at and self.steps:
+            return json.dumps({
+                str(step.step_index): (step.started_at - self.started_at).total_seconds()
+                for step in self.steps if step.started_at
+            })
+        return self._step_times
+
+    @step_times.setter
+    def step_times(self, value):
+        self._step_times = value
+
+    @step_times.expression
+    def step_times(cls):
+        return cls._step_times
+
+    @property
+    def matrix(self):
+        """The build's matrix axis values, or an empty dict if it isn't part of a matrix group."""
+        return json.loads(self.matrix_values) if self.matrix_values else {}
+
+class BuildStep(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('build_id', 'step_index', name='uq_build_step_build_index'),
+        db.Index('ix_build_step_config_index', 'config_id', 'step_index'),
+        db.Index('ix_build_step_command_hash', 'command_hash'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    build_id = db.Column(db.Integer, db.ForeignKey('build.id'), nullable=False)
+    config_id = db.Column(db.Integer, db.ForeignKey('config.id'), nullable=False)  # Denormalized for per-config queries
+    step_index = db.Column(db.Integer, nullable=False)  # Zero-based position of the step in the pipeline
+    command_hash = db.Column(db.String(40))  # SHA-1 of the step template, stable across payloads
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    exit_code = db.Column(db.Integer, nullable=True)  # Null while running or if the step could not be started
+    log_start = db.Column(db.Integer)  # Offset into Build.log where the step's output starts
+    log_end = db.Column(db.Integer)  # Offset into Build.log where the step's output ends
+    cached = db.Column(db.Boolean, default=False)  # True if the step's result was reused instead of running it
+    skipped = db.Column(db.Boolean, default=False)  # True if no changed files matched the step's path filters
+
+    @property
+    def duration(self):
+        """Step duration in seconds, or None if the step hasn't finished."""
+        if self.started_at and self.finished_at:
+            return (self.finished_at - self.started_at).total_seconds()
+        return None
+
+class BuildLogChunk(db.Model):
+    """
+    A run of whole lines of a build's log, indexed for full-text search by the build_log_fts table.
+
+    The chunks also index the log by line number, for reading ranges of lines (see build_log).
+    """
+    __tablename__ = 'build_log_chunk'
+    __table_args__ = (
+        db.Index('ix_build_log_chunk_build_start', 'build_id', 'log_start'),
+        db.Index('ix_build_log_chunk_build_line', 'build_id', 'first_line'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    build_id = db.Column(db.Integer, db.ForeignKey('build.id'), nullable=False)
+    log_start = db.Column(db.Integer, nullable=False)  # Offset into Build.log where the chunk starts
+    first_line = db.Column(db.Integer, nullable=False)  # One-based number of the chunk's first line in the log
+    line_count = db.Column(db.Integer, nullable=False)
+    content = db.Column(db.Text, nullable=False)
+
+class BuildGroup(db.Model):
+    """
+    The builds started by one trigger of a configuration with a build matrix, one for each
+    combination of the matrix's values. The group's status and progress are derived from its
+    builds' (see services.matrix), so they are not stored.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    config_id = db.Column(db.Integer, db.ForeignKey('config.id'), nullable=False)
+    branch = db.Column(db.String(100))
+    triggered_by = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    builds = db.relationship('Build', backref='group', lazy=True, order_by='Build.id')
+    config = db.relationship('Config')
+
 class Config(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
@@ -49,6 +159,33 @@ class Config(db.Model):
     project_path = db.Column(db.String(500), default='')
     build_steps = db.Column(db.Text, default='')
     max_queue_length = db.Column(db.Integer, default=5)  # Maximum number of builds that can be queued
+    isolated_workspaces = db.Column(db.Boolean, default=False)  # Run each build in a git worktree of its own
+    shell_session = db.Column(db.Boolean, default=False)  # Run all of a build's steps in one shell
+    matrix = db.Column(db.Text, default='')  # Build matrix axes, one "name: value, value" per line
 
     # Relationship with builds
     builds = db.relationship('Build', backref='config', lazy=True)
+
+    # Relationship with the summary statistics
+    stats = db.relationship('ConfigStats', backref='config', uselist=False, cascade='all, delete-orphan')
+
+class ConfigStats(db.Model):
+    """Per-configuration rollup, updated in the same transaction as the build changes it summarizes."""
+    config_id = db.Column(db.Integer, db.ForeignKey('config.id'), primary_key=True)
+    total_builds = db.Column(db.Integer, default=0)  # Finished builds
+    successes = db.Column(db.Integer, default=0)
+    failures = db.Column(db.Integer, default=0)  # Includes builds that failed permanently
+    last_success_id = db.Column(db.Integer, nullable=True)
+    last_failure_id = db.Column(db.Integer, nullable=True)
+    duration_count = db.Column(db.Integer, default=0)  # Successful builds with a known duration
+    duration_mean = db.Column(db.Float, default=0.0)  # Running mean duration of successful builds, in seconds
+    duration_sketch = db.Column(db.Text, default='{}')  # JSON log-bucket histogram of successful build durations
+    queue_length = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    @property
+    def success_rate(self):
+        """Fraction of finished builds that succeeded, or None if there are none."""
+        if not self.total_builds:
+            return None
+        return self.successes / self.total_builds
@@ -5,7 +5,7 @@ This package contains the route handlers for the CICD Server application.
 """
 
 # Import all route modules to register the routes with Flask
-from cicd_server.routes import auth, dashboard, user, build, config
+from cicd_server.routes import auth, dashboard, user, build, config, profiling, search
 
 # List of all route modules for easier importing
-__all__ = ['auth', 'dashboard', 'user', 'build', 'config']
+__all__ = ['auth', 'dashboard', 'user', 'build', 'config', 'profiling', 'search']
@@ -6,13 +6,39 @@ This module contains the authentication-related routes for the CICD Server appli
 
 from flask import render_template, request, redirect, url_for, flash
 from flask_login import login_user, logout_user, current_user
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
 
 from cicd_server import app, db, login_manager
 from cicd_server.models import User, Config
+from cicd_server.utils.cache import TTLCache
+
+# Column values of recently loaded users by id, so current_user isn't queried on every request
+user_cache = TTLCache(app.config['USER_CACHE_SECONDS'], max_size=1024)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    """
+    Load the logged-in user, from the cache if it was loaded in the last USER_CACHE_SECONDS.
+
+    A cached user is attached to the request's session without a query, so it can be
+    changed and committed like a queried one. Routes that change or delete a user
+    invalidate its cache entry.
+    """
+    user_id = int(user_id)
+    if app.config['USER_CACHE_SECONDS'] <= 0:
+        return db.session.get(User, user_id)
+
+    values = user_cache.get(user_id)
+    if values is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            user_cache.set(user_id, {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs})
+        return user
+
+    user = User(**values)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
 
 @app.route('/')
 def index():
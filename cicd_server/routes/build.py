@@ -7,19 +7,32 @@ This module contains the build-related routes for the CICD Server application.
 from flask import render_template, request, redirect, url_for, flash
 from flask_login import login_required, current_user
 
-from cicd_server import app
+from cicd_server import app, db
 from cicd_server.models import Build, Config
+from cicd_server.services.build_log import get_log_segments
 from cicd_server.services.build_service import calculate_build_progress, trigger_build_with_config
+from cicd_server.services.live_builds import live_builds
+from cicd_server.utils.fragments import build_fragments
+from cicd_server.utils.profiling import query_budget
 
 @app.route('/build/<int:build_id>')
 @login_required
+@query_budget(8)
 def build_detail(build_id):
-    build = Build.query.get_or_404(build_id)
+    build = Build.query.options(db.joinedload(Build.config)).get_or_404(build_id)
 
-    # Calculate progress and time information
-    progress_data = calculate_build_progress(build)
+    # Calculate progress and time information, from the live state while the build runs,
+    # only if the build information isn't rendered from the fragment cache
+    def progress_data():
+        live = live_builds.get(build_id)
+        return {'progress_data': live.progress() if live is not None else calculate_build_progress(build)}
+    build_information = build_fragments.render('build_information', build, progress_data)
 
-    return render_template('build_detail.html', build=build, progress_data=progress_data)
+    # The page only gets the log's segments, and loads their lines as they are shown
+    log_segments, log_total_lines = get_log_segments(build)
+
+    return render_template('build_detail.html', build=build, build_information=build_information,
+                           log_segments=log_segments, log_total_lines=log_total_lines)
 
 @app.route('/trigger_build', methods=['POST'])
 @login_required
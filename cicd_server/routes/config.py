@@ -7,22 +7,55 @@ This module contains the configuration-related routes for the CICD Server applic
 from flask import render_template, request, redirect, url_for, flash
 from flask_login import login_required, current_user
 import uuid
+import json
 
 from cicd_server import app, db
-from cicd_server.models import Config, Build
+from cicd_server.models import Config, Build, BuildGroup
+from cicd_server.services.pipeline import validate_build_steps, invalidate_pipeline
+from cicd_server.services.matrix import validate_matrix
+from cicd_server.services.config_stats import get_or_create_stats, rebuild_config_stats, duration_percentile
+from cicd_server.utils.profiling import query_budget
+from cicd_server.utils.versions import build_versions
+
+
+def get_sample_payload(config_id):
+    """Get the payload of the most recent build of a configuration, or None if it has no builds."""
+    latest_build = Build.query.filter_by(config_id=config_id).order_by(Build.id.desc()).first()
+    if not latest_build:
+        return None
+    try:
+        return json.loads(latest_build.payload or '{}')
+    except json.JSONDecodeError:
+        return None
+
+def get_configs_with_stats():
+    """
+    Get all configurations with their statistics loaded, and their median build durations.
+
+    Returns:
+        tuple: (configs, median_durations, build_counts), where build_counts has the number
+               of builds of each configuration, counted in one query
+    """
+    configs = Config.query.options(db.joinedload(Config.stats)).all()
+    median_durations = {c.id: duration_percentile(c.stats, 50) for c in configs}
+    build_counts = dict(db.session.query(Build.config_id, db.func.count(Build.id)).group_by(Build.config_id))
+    return configs, median_durations, build_counts
 
 @app.route('/config', methods=['GET'])
 @login_required
+@query_budget(4)
 def config():
     if not current_user.is_admin:
         flash('Admin access required')
         return redirect(url_for('dashboard'))
 
-    configs = Config.query.all()
-    return render_template('config.html', configs=configs)
+    configs, median_durations, build_counts = get_configs_with_stats()
+    return render_template('config.html', configs=configs, median_durations=median_durations,
+                           build_counts=build_counts)
 
 @app.route('/config/add', methods=['GET', 'POST'])
 @login_required
+@query_budget(8)
 def add_config():
     if not current_user.is_admin:
         flash('Admin access required')
@@ -33,6 +66,9 @@ def add_config():
         project_path = request.form.get('project_path', '')
         build_steps = request.form.get('build_steps', '')
         max_queue_length = request.form.get('max_queue_length', '5')
+        isolated_workspaces = request.form.get('isolated_workspaces') == 'on'
+        shell_session = request.form.get('shell_session') == 'on'
+        matrix = request.form.get('matrix', '').strip()
 
         # Validate max_queue_length
         try:
@@ -54,31 +90,43 @@ def add_config():
             project_path=project_path,
             build_steps=build_steps,
             max_queue_length=max_queue_length,
+            isolated_workspaces=isolated_workspaces,
+            shell_session=shell_session,
+            matrix=matrix,
             api_token=str(uuid.uuid4())
         )
 
         db.session.add(config)
+        db.session.flush()
+        get_or_create_stats(config.id)
         db.session.commit()
         flash('Configuration added successfully')
+
+        # Report problems with the build steps now rather than during the first build
+        for warning in validate_build_steps(build_steps) + validate_matrix(matrix):
+            flash(warning, 'error')
         return redirect(url_for('config'))
 
     return render_template('add_config.html')
 
 @app.route('/config/edit/<int:config_id>', methods=['GET', 'POST'])
 @login_required
+@query_budget(8)
 def edit_config(config_id):
     if not current_user.is_admin:
         flash('Admin access required')
         return redirect(url_for('dashboard'))
 
     config = Config.query.get_or_404(config_id)
-    configs = Config.query.all()
 
     if request.method == 'POST':
         name = request.form.get('name', '')
         project_path = request.form.get('project_path', '')
         build_steps = request.form.get('build_steps', '')
         max_queue_length = request.form.get('max_queue_length', '5')
+        isolated_workspaces = request.form.get('isolated_workspaces') == 'on'
+        shell_session = request.form.get('shell_session') == 'on'
+        matrix = request.form.get('matrix', '').strip()
 
         # Validate max_queue_length
         try:
@@ -98,15 +146,27 @@ def edit_config(config_id):
         config.project_path = project_path
         config.build_steps = build_steps
         config.max_queue_length = max_queue_length
+        config.isolated_workspaces = isolated_workspaces
+        config.shell_session = shell_session
+        config.matrix = matrix
 
         if 'regenerate_token' in request.form:
             config.api_token = str(uuid.uuid4())
 
         db.session.commit()
+        invalidate_pipeline(config.id)
+        # Build responses include the configuration name
+        build_versions.bump_all()
         flash('Configuration updated successfully')
+
+        # Report problems with the build steps now rather than during the next build
+        for warning in validate_build_steps(build_steps, get_sample_payload(config.id)) + validate_matrix(matrix):
+            flash(warning, 'error')
         return redirect(url_for('config'))
 
-    return render_template('config.html', configs=configs, selected_config=config)
+    configs, median_durations, build_counts = get_configs_with_stats()
+    return render_template('config.html', configs=configs, median_durations=median_durations,
+                           build_counts=build_counts, selected_config=config)
 
 @app.route('/config/delete/<int:config_id>', methods=['POST'])
 @login_required
@@ -124,13 +184,21 @@ def delete_config(config_id):
 
     # Check if there are any builds using this configuration
     builds_count = Build.query.filter_by(config_id=config_id).count()
+    other_config = None
     if builds_count > 0:
         # Update builds to use another configuration
         other_config = Config.query.filter(Config.id != config_id).first()
         Build.query.filter_by(config_id=config_id).update({'config_id': other_config.id})
+        BuildGroup.query.filter_by(config_id=config_id).update({'config_id': other_config.id})
         flash(f'Updated {builds_count} builds to use configuration "{other_config.name}"')
 
     db.session.delete(config)
     db.session.commit()
+    invalidate_pipeline(config_id)
+    build_versions.bump_all()
+
+    # The reassigned builds now count towards the other configuration
+    if other_config:
+        rebuild_config_stats(other_config.id)
     flash('Configuration deleted successfully')
     return redirect(url_for('config'))
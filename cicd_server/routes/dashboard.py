@@ -7,12 +7,22 @@ This module contains the dashboard-related routes for the CICD Server applicatio
 from flask import render_template, request
 from flask_login import login_required, current_user
 
-from cicd_server import app, build_in_progress
-from cicd_server.models import Build, Config
+from cicd_server import app, db, build_in_progress
+from cicd_server.models import Build, BuildGroup, Config, UNFINISHED_STATUSES
 from cicd_server.services.build_service import calculate_build_progress
+from cicd_server.services.config_stats import duration_percentile
+from cicd_server.services.live_builds import live_builds
+from cicd_server.services.matrix import summarize_group, format_matrix
+from cicd_server.utils.fragments import build_fragments
+from cicd_server.utils.profiling import query_budget
+
+RECENT_BUILD_GROUPS = 5  # Build matrices shown on the dashboard
+
+app.jinja_env.filters['format_matrix'] = format_matrix
 
 @app.route('/dashboard')
 @login_required
+@query_budget(10)
 def dashboard():
     # Get pagination parameters
     page = request.args.get('page', 1, type=int)
@@ -24,15 +34,25 @@ def dashboard():
 
     # Query builds with pagination
     builds = Build.query.order_by(Build.id.desc()).offset((page - 1) * per_page).limit(per_page).all()
-    configs = Config.query.all()
+    configs = Config.query.options(db.joinedload(Config.stats)).all()
+    median_durations = {c.id: duration_percentile(c.stats, 50) for c in configs}
 
-    # Calculate progress for each build
+    # Calculate progress for each unfinished build, finished builds' rows are rendered from the fragment cache
     builds_progress = {}
     running_builds_count = 0
     for build in builds:
-        builds_progress[build.id] = calculate_build_progress(build)
+        if build.status in UNFINISHED_STATUSES:
+            live = live_builds.get(build.id)
+            builds_progress[build.id] = live.progress() if live is not None else calculate_build_progress(build)
         if build.status == 'running':
             running_builds_count += 1
+    build_rows = [build_fragments.render('dashboard_row', build, lambda build=build: {'progress': builds_progress.get(build.id)})
+                  for build in builds]
+
+    # Aggregate status and progress of the most recent build matrices
+    build_groups = [summarize_group(group) for group in
+                    BuildGroup.query.options(db.selectinload(BuildGroup.builds))
+                    .order_by(BuildGroup.id.desc()).limit(RECENT_BUILD_GROUPS)]
 
     # Count queued builds
     queued_builds_count = Build.query.filter_by(status='queued').count()
@@ -46,8 +66,10 @@ def dashboard():
     return render_template('dashboard.html', 
                           builds=builds, 
                           configs=configs, 
+                          median_durations=median_durations,
                           build_in_progress=local_build_in_progress, 
-                          builds_progress=builds_progress,
+                          build_rows=build_rows,
+                          build_groups=build_groups,
                           queued_builds_count=queued_builds_count,
                           current_page=page,
                           total_pages=total_pages)
@@ -0,0 +1,37 @@
+﻿"""
+Profiling Routes
+
+This module contains the admin-only routes for capturing a profile of the running server.
+"""
+
+import datetime
+import io
+
+from flask import request, redirect, url_for, flash, send_file
+from flask_login import login_required, current_user
+
+from cicd_server import app
+from cicd_server.utils.profiling import sample_profile
+
+MAX_PROFILE_SECONDS = 120
+
+@app.route('/admin/profile', methods=['GET'])
+@login_required
+def profile():
+    if not current_user.is_admin:
+        flash('Admin access required')
+        return redirect(url_for('dashboard'))
+
+    # Validate the profiling duration
+    seconds = request.args.get('seconds', 10, type=float)
+    if seconds is None or seconds <= 0:
+        seconds = 10
+    seconds = min(seconds, MAX_PROFILE_SECONDS)
+
+    data = sample_profile(seconds)
+
+    timestamp = datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+    return send_file(io.BytesIO(data),
+                     mimetype='application/octet-stream',
+                     as_attachment=True,
+                     download_name=f'cicd-profile-{timestamp}.pstats')
@@ -0,0 +1,34 @@
+﻿"""
+Search Routes
+
+This module contains the log search page for the CICD Server application.
+"""
+
+from flask import render_template, request
+from flask_login import login_required
+
+from cicd_server import app
+from cicd_server.models import Config
+from cicd_server.services.log_search import search_logs, log_search_available
+
+SEARCH_PAGE_BUILDS = 20
+
+@app.route('/search', methods=['GET'])
+@login_required
+def search():
+    search_text = request.args.get('q', '').strip()
+    config_id = request.args.get('config_id', type=int)
+    before = request.args.get('before', type=int)
+
+    results = []
+    if search_text:
+        results = search_logs(search_text, config_id=config_id, before_build_id=before,
+                              max_builds=SEARCH_PAGE_BUILDS)
+
+    return render_template('search.html',
+                           search_text=search_text,
+                           config_id=config_id,
+                           configs=Config.query.order_by(Config.name).all(),
+                           results=results,
+                           next_before=results[-1]['build_id'] if len(results) == SEARCH_PAGE_BUILDS else None,
+                           search_available=log_search_available())
@@ -9,9 +9,12 @@ from flask_login import login_required, current_user
 
 from cicd_server import app, db
 from cicd_server.models import User
+from cicd_server.routes.auth import user_cache
+from cicd_server.utils.profiling import query_budget
 
 @app.route('/users')
 @login_required
+@query_budget(3)
 def users():
     if not current_user.is_admin:
         flash('Admin access required')
@@ -66,6 +69,7 @@ def delete_user(user_id):
 
     db.session.delete(user)
     db.session.commit()
+    user_cache.invalidate(user_id)
 
     flash('User deleted successfully')
     return redirect(url_for('users'))
\ No newline at end of file
@@ -6,6 +6,8 @@ such as build processing logic.
 """
 
 from cicd_server.services.build_service import calculate_build_progress, run_build, mark_abandoned_builds
+from cicd_server.services.pipeline import compile_pipeline, get_pipeline, invalidate_pipeline
 
 # List of all service functions for easier importing
-__all__ = ['calculate_build_progress', 'run_build', 'mark_abandoned_builds']
+__all__ = ['calculate_build_progress', 'run_build', 'mark_abandoned_builds',
+           'compile_pipeline', 'get_pipeline', 'invalidate_pipeline']
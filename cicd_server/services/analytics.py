@@ -0,0 +1,380 @@
+﻿"""
+Build Analytics
+
+This module computes per-configuration build statistics over a time window: duration trends,
+success rates, queue wait distributions and the slowest steps.
+
+Filtering and counting are done in SQL, and the remaining numbers are fetched as columns and
+aggregated in one pass (with NumPy when it is installed). Results are cached per
+configuration and window, and invalidated whenever a build of that configuration completes.
+"""
+
+import datetime
+import re
+import threading
+from array import array
+
+from cicd_server import db
+from cicd_server.models import Build, BuildStep, FINISHED_STATUSES
+from cicd_server.utils.cache import TTLCache
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional, the pure Python fallback gives the same results
+    numpy = None
+
+DEFAULT_PERCENTILES = (50, 90, 99)
+MAX_TREND_POINTS = 1000
+MAX_SLOWEST_STEPS = 100
+
+# Cached results expire even without invalidation, since the window moves with time
+CACHE_TTL_SECONDS = 60
+CACHE_MAX_ENTRIES = 1000
+
+WINDOW_PATTERN = re.compile(r'^(\d+)([hdw])$')
+WINDOW_UNITS = {'h': 'hours', 'd': 'days', 'w': 'weeks'}
+MAX_WINDOW = datetime.timedelta(days=36500)  # Longer windows are rejected, since their start can't be represented
+
+
+def parse_window(window):
+    """
+    Parse a window such as '24h', '30d', '12w' or 'all'.
+
+    Returns:
+        datetime.timedelta or None: The window length, or None for all history
+
+    Raises:
+        ValueError: If the window is not valid, or longer than 100 years
+    """
+    if window in (None, '', 'all'):
+        return None
+    match = WINDOW_PATTERN.match(window)
+    if not match:
+        raise ValueError(f'Invalid window "{window}", expected e.g. 24h, 30d, 12w or all')
+    try:
+        length = datetime.timedelta(**{WINDOW_UNITS[match.group(2)]: int(match.group(1))})
+    except OverflowError:
+        length = None
+    if length is None or length > MAX_WINDOW:
+        raise ValueError(f'Window "{window}" is longer than 100 years, use all for all history')
+    return length
+
+
+def _window_start(window):
+    length = parse_window(window)
+    return datetime.datetime.utcnow() - length if length else None
+
+
+def _seconds_between(start_column, end_column):
+    """SQL expression for the number of seconds between two datetime columns (SQLite)."""
+    return (db.func.julianday(end_column) - db.func.julianday(start_column)) * 86400.0
+
+
+def percentiles(values, ps=DEFAULT_PERCENTILES):
+    """
+    Compute several percentiles of a column of numbers with linear interpolation.
+
+    Args:
+        values (array or list): The values
+        ps (tuple): The percentiles to compute, between 0 and 100
+
+    Returns:
+        dict: 'p<N>' -> value, or None values if there is no data
+    """
+    if len(values) == 0:
+        return {f'p{p}': None for p in ps}
+    if numpy is not None:
+        results = numpy.percentile(numpy.asarray(values, dtype=float), ps)
+        return {f'p{p}': float(v) for p, v in zip(ps, results)}
+
+    ordered = sorted(values)
+    results = {}
+    for p in ps:
+        rank = (len(ordered) - 1) * p / 100.0
+        lower = int(rank)
+        upper = min(lower + 1, len(ordered) - 1)
+        results[f'p{p}'] = ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+    return results
+
+
+def describe(values):
+    """Count, mean, min, max and percentiles of a column of numbers."""
+    data = {'count': len(values), 'mean': None, 'min': None, 'max': None}
+    if len(values):
+        data['mean'] = sum(values) / len(values)
+        data['min'] = min(values)
+        data['max'] = max(values)
+    data.update(percentiles(values))
+    return data
+
+
+def histogram(values, bounds):
+    """Count values into buckets with the given upper bounds, plus an overflow bucket."""
+    counts = [0] * (len(bounds) + 1)
+    for value in values:
+        for i, bound in enumerate(bounds):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+    labels = [f'<={bound}' for bound in bounds] + [f'>{bounds[-1]}']
+    return [{'bucket': label, 'count': count} for label, count in zip(labels, counts)]
+
+
+def downsample(timestamps, durations, successes, points):
+    """
+    Reduce a time series to at most `points` equal-width time buckets.
+
+    Args:
+        timestamps (array): Seconds since the epoch, in ascending order
+        durations (array): Build durations in seconds
+        successes (array): 1 for successful builds, 0 otherwise
+        points (int): The maximum number of buckets
+
+    Returns:
+        list: One dictionary per non-empty bucket with start time, count, duration stats and success rate
+    """
+    if len(timestamps) == 0:
+        return []
+
+    start = timestamps[0]
+    span = max(timestamps[-1] - start, 1.0)
+    width = span / points
+
+    if numpy is not None:
+        ts = numpy.asarray(timestamps, dtype=float)
+        ds = numpy.asarray(durations, dtype=float)
+        ok = numpy.asarray(successes, dtype=float)
+        index = numpy.minimum(((ts - start) / width).astype(int), points - 1)
+        counts = numpy.bincount(index, minlength=points)
+        sums = numpy.bincount(index, weights=ds, minlength=points)
+        success_counts = numpy.bincount(index, weights=ok, minlength=points)
+        mins = numpy.full(points, numpy.inf)
+        maxs = numpy.full(points, -numpy.inf)
+        numpy.minimum.at(mins, index, ds)
+        numpy.maximum.at(maxs, index, ds)
+        buckets = [(int(i), int(counts[i]), float(sums[i]), float(mins[i]), float(maxs[i]), float(success_counts[i]))
+                   for i in numpy.nonzero(counts)[0]]
+    else:
+        state = {}
+        for t, d, ok in zip(timestamps, durations, successes):
+            i = min(int((t - start) / width), points - 1)
+            entry = state.get(i)
+            if entry is None:
+                state[i] = [1, d, d, d, ok]
+            else:
+                entry[0] += 1
+                entry[1] += d
+                entry[2] = min(entry[2], d)
+                entry[3] = max(entry[3], d)
+                entry[4] += ok
+        buckets = [(i, e[0], e[1], e[2], e[3], e[4]) for i, e in sorted(state.items())]
+
+    return [{
+        'start': datetime.datetime.utcfromtimestamp(start + i * width).isoformat(),
+        'count': count,
+        'mean_duration': total / count,
+        'min_duration': low,
+        'max_duration': high,
+        'success_rate': success_count / count,
+    } for i, count, total, low, high, success_count in buckets]
+
+
+_cache = TTLCache(CACHE_TTL_SECONDS, CACHE_MAX_ENTRIES)  # (kind, config_id, window, *args) -> (config version, value)
+_config_versions = {}  # Dictionary of config_id -> version, bumped when a build completes
+_cache_lock = threading.Lock()
+
+
+def invalidate_analytics(config_id):
+    """
+    Invalidate cached analytics for a configuration, e.g. because one of its builds completed.
+
+    Entries of older versions are ignored, and dropped when they expire or are evicted.
+    """
+    with _cache_lock:
+        _config_versions[config_id] = _config_versions.get(config_id, 0) + 1
+
+
+def _cache_lookup(key):
+    """Get (hit, value, version) for a cache key, whose second item is the configuration ID."""
+    with _cache_lock:
+        version = _config_versions.get(key[1], 0)
+    entry = _cache.get(key)
+    if entry and entry[0] == version:
+        return True, entry[1], version
+    return False, None, version
+
+
+def _cache_store(key, version, value):
+    with _cache_lock:
+        # Only store the value if no build completed while it was being computed
+        if _config_versions.get(key[1], 0) == version:
+            _cache.set(key, (version, value))
+
+
+def _cached(kind, config_id, window, *args, compute):
+    key = (kind, config_id, window) + args
+    hit, value, version = _cache_lookup(key)
+    if hit:
+        return value
+    value = compute()
+    _cache_store(key, version, value)
+    return value
+
+
+def _compute_summaries(config_ids, window):
+    """Compute the summaries of several configurations with one query per statistic."""
+    since = _window_start(window)
+    filters = [Build.config_id.in_(config_ids)]
+    if since:
+        filters.append(Build.started_at >= since)
+
+    # Counts per configuration and status in one aggregate query
+    counts = {config_id: {} for config_id in config_ids}
+    for config_id, status, count in db.session.query(Build.config_id, Build.status, db.func.count(Build.id)) \
+            .filter(*filters).group_by(Build.config_id, Build.status).all():
+        counts[config_id][status] = count
+
+    # Durations of successful builds and queue waits as columns per configuration
+    durations = {config_id: array('d') for config_id in config_ids}
+    duration = _seconds_between(Build.started_at, Build.completed_at)
+    for config_id, seconds in db.session.query(Build.config_id, duration) \
+            .filter(*filters, Build.status == 'success', Build.completed_at.isnot(None)).all():
+        durations[config_id].append(seconds)
+    queue_waits = {config_id: array('d') for config_id in config_ids}
+    queue_wait = _seconds_between(Build.queued_at, Build.started_at)
+    for config_id, seconds in db.session.query(Build.config_id, queue_wait) \
+            .filter(*filters, Build.queued_at.isnot(None), Build.started_at.isnot(None)).all():
+        queue_waits[config_id].append(max(0.0, seconds))
+
+    summaries = {}
+    for config_id in config_ids:
+        finished = sum(counts[config_id].get(status, 0) for status in FINISHED_STATUSES)
+        summaries[config_id] = {
+            'config_id': config_id,
+            'window': window,
+            'builds': sum(counts[config_id].values()),
+            'statuses': counts[config_id],
+            'success_rate': (counts[config_id].get('success', 0) / finished) if finished else None,
+            'duration': describe(durations[config_id]),
+            'queue_wait': describe(queue_waits[config_id]),
+            'queue_wait_histogram': histogram(queue_waits[config_id], (1, 5, 15, 60, 300, 900, 3600)),
+        }
+    return summaries
+
+
+def get_config_summaries(config_ids, window='30d'):
+    """
+    Get build counts, success rate, duration and queue wait statistics for several configurations.
+
+    The summaries that aren't cached are computed together, so the number of queries doesn't
+    grow with the number of configurations.
+
+    Args:
+        config_ids (list): The IDs of the configurations
+        window (str): The time window, e.g. '30d' or 'all'
+
+    Returns:
+        dict: Configuration ID -> summary
+    """
+    summaries = {}
+    versions = {}
+    for config_id in config_ids:
+        hit, value, versions[config_id] = _cache_lookup(('summary', config_id, window))
+        if hit:
+            summaries[config_id] = value
+
+    missing = [config_id for config_id in config_ids if config_id not in summaries]
+    if missing:
+        for config_id, summary in _compute_summaries(missing, window).items():
+            _cache_store(('summary', config_id, window), versions[config_id], summary)
+            summaries[config_id] = summary
+    return summaries
+
+
+def get_config_summary(config_id, window='30d'):
+    """
+    Get build counts, success rate, duration and queue wait statistics for a configuration.
+
+    Args:
+        config_id (int): The ID of the configuration
+        window (str): The time window, e.g. '30d' or 'all'
+
+    Returns:
+        dict: The summary
+    """
+    return get_config_summaries([config_id], window)[config_id]
+
+
+def get_duration_trend(config_id, window='365d', points=300):
+    """
+    Get a downsampled time series of build durations and success rate for a configuration.
+
+    Args:
+        config_id (int): The ID of the configuration
+        window (str): The time window, e.g. '365d' or 'all'
+        points (int): The maximum number of points to return
+
+    Returns:
+        list: One point per time bucket
+    """
+    points = max(1, min(points, MAX_TREND_POINTS))
+
+    def compute():
+        since = _window_start(window)
+        query = db.session.query(
+            (db.func.julianday(Build.started_at) - 2440587.5) * 86400.0,
+            _seconds_between(Build.started_at, Build.completed_at),
+            db.case((Build.status == 'success', 1), else_=0)
+        ).filter(Build.config_id == config_id,
+                 Build.status.in_(FINISHED_STATUSES),
+                 Build.started_at.isnot(None),
+                 Build.completed_at.isnot(None))
+        if since:
+            query = query.filter(Build.started_at >= since)
+
+        timestamps, durations, successes = array('d'), array('d'), array('d')
+        for t, d, ok in query.order_by(Build.started_at).all():
+            timestamps.append(t)
+            durations.append(d)
+            successes.append(ok)
+        return downsample(timestamps, durations, successes, points)
+
+    return _cached('trend', config_id, window, points, compute=compute)
+
+
+def get_slowest_steps(config_id, window='30d', limit=10):
+    """
+    Get the steps of a configuration with the highest mean duration.
+
+    Args:
+        config_id (int): The ID of the configuration
+        window (str): The time window, e.g. '30d' or 'all'
+        limit (int): The maximum number of steps to return
+
+    Returns:
+        list: One dictionary per step, slowest first
+    """
+    limit = max(1, min(limit, MAX_SLOWEST_STEPS))
+
+    def compute():
+        since = _window_start(window)
+        duration = _seconds_between(BuildStep.started_at, BuildStep.finished_at)
+        query = db.session.query(BuildStep.step_index, duration).filter(
+            BuildStep.config_id == config_id,
+            BuildStep.finished_at.isnot(None),
+            BuildStep.cached.isnot(True),
+            BuildStep.skipped.isnot(True))
+        if since:
+            query = query.filter(BuildStep.started_at >= since)
+
+        columns = {}
+        for step_index, seconds in query.all():
+            columns.setdefault(step_index, array('d')).append(seconds)
+
+        steps = [dict(step_index=step_index, **describe(values)) for step_index, values in columns.items()]
+        steps.sort(key=lambda step: step['mean'], reverse=True)
+        return steps[:limit]
+
+    return _cached('steps', config_id, window, limit, compute=compute)
@@ -0,0 +1,207 @@
+﻿"""
+Build Log Lines
+
+This module reads build logs by line number instead of as a whole. A log is divided into
+segments: the setup lines before the first step, the output of each step, and the result
+lines after the last step. Any range of lines can be read from the BuildLogChunk rows the
+log is split into as it is written (see log_search), whose first line numbers serve as a
+line index, so reading a few hundred lines of a huge log reads one or two chunks.
+
+Only the end of a running build's log that hasn't been split into chunks yet is read from
+Build.log itself.
+"""
+
+import bisect
+
+from cicd_server import db
+from cicd_server.models import Build, BuildLogChunk, UNFINISHED_STATUSES
+from cicd_server.services.log_search import index_build_log
+
+MAX_LINES_PER_READ = 2000  # Most lines returned by one read
+MAX_LINE_CHARS = 10000  # Longer lines are cut short when read
+SEGMENT_TITLE_CHARS = 200  # Characters of a step's first line used as its title
+
+
+class LogLines:
+    """Line-numbered access to one build's log, as it was when this was created."""
+
+    def __init__(self, build):
+        """
+        Args:
+            build (Build): The build, whose log is split into chunks first if it is finished
+                           and the backfill hasn't reached it yet
+        """
+        self.build_id = build.id
+        self.status = build.status
+        if build.log_indexed is None and build.status not in UNFINISHED_STATUSES:
+            index_build_log(build.id)
+            db.session.commit()
+
+        last = db.session.query(BuildLogChunk.log_start, BuildLogChunk.first_line, BuildLogChunk.line_count,
+                                db.func.length(BuildLogChunk.content),
+                                db.func.substr(BuildLogChunk.content, -1)) \
+            .filter(BuildLogChunk.build_id == build.id) \
+            .order_by(BuildLogChunk.log_start.desc()).first()
+        if last is None:
+            self.indexed = 0  # Log characters in chunks
+            self.chunk_lines_end = 1  # Number of the line after the last line in chunks
+            self.next_line = 1  # Number of the line the text after the chunks starts on
+        else:
+            log_start, first_line, line_count, length, last_char = last
+            self.indexed = log_start + length
+            self.chunk_lines_end = first_line + line_count
+            # The text after the chunks continues the last chunk's line if it doesn't end with a line break
+            self.next_line = self.chunk_lines_end - (0 if last_char == '\n' else 1)
+
+        # The rest of a running build's log, which is only a few chunks at most
+        self.tail = ''
+        if build.status in UNFINISHED_STATUSES:
+            self.tail = db.session.query(db.func.substr(Build.log, self.indexed + 1)) \
+                .filter(Build.id == build.id).scalar() or ''
+
+        if self.tail:
+            self.total_lines = self.next_line - 1 + self.tail.count('\n') + (0 if self.tail.endswith('\n') else 1)
+        else:
+            self.total_lines = self.chunk_lines_end - 1
+
+        self._chunk_starts = None
+
+    def line_at(self, offset):
+        """
+        Get the number of the line that contains a log offset.
+
+        An offset at the end of a log that ends with a line break gives total_lines + 1.
+        """
+        if offset >= self.indexed:
+            return self.next_line + self.tail.count('\n', 0, offset - self.indexed)
+
+        if self._chunk_starts is None:
+            self._chunk_starts = [tuple(row) for row in db.session.query(BuildLogChunk.log_start,
+                                                                         BuildLogChunk.first_line)
+                                  .filter(BuildLogChunk.build_id == self.build_id)
+                                  .order_by(BuildLogChunk.log_start)]
+        position = bisect.bisect_right(self._chunk_starts, (offset, float('inf'))) - 1
+        log_start, first_line = self._chunk_starts[position]
+        if log_start == offset:
+            # Steps start on a chunk boundary, since the log is flushed into chunks at the end of each step
+            return first_line
+        before = db.session.query(db.func.substr(BuildLogChunk.content, 1, offset - log_start)) \
+            .filter(BuildLogChunk.build_id == self.build_id, BuildLogChunk.log_start == log_start).scalar()
+        return first_line + before.count('\n')
+
+    def read(self, start, count):
+        """
+        Read a range of lines.
+
+        Args:
+            start (int): The one-based number of the first line
+            count (int): The number of lines, at most MAX_LINES_PER_READ
+
+        Returns:
+            list: The lines, without line breaks, which are fewer than requested at the end of the log
+        """
+        start = max(start, 1)
+        end = min(start + min(count, MAX_LINES_PER_READ), self.total_lines + 1)
+        if end <= start:
+            return []
+
+        pieces = []
+        first_line = self.next_line
+        reached_tail = True
+        if start < self.chunk_lines_end:
+            from_line = db.session.query(db.func.max(BuildLogChunk.first_line)) \
+                .filter(BuildLogChunk.build_id == self.build_id, BuildLogChunk.first_line <= start).scalar()
+            chunks = db.session.query(BuildLogChunk.log_start, BuildLogChunk.first_line, BuildLogChunk.content) \
+                .filter(BuildLogChunk.build_id == self.build_id,
+                        BuildLogChunk.first_line >= from_line, BuildLogChunk.first_line < end) \
+                .order_by(BuildLogChunk.log_start).all()
+            first_line = chunks[0].first_line
+            pieces = [chunk.content for chunk in chunks]
+            reached_tail = chunks[-1].log_start + len(chunks[-1].content) == self.indexed
+        if reached_tail and self.tail:
+            pieces.append(self.tail)
+
+        text = ''.join(pieces)
+        lines = text.split('\n')
+        if text.endswith('\n'):
+            lines.pop()
+        return [
+            line if len(line) <= MAX_LINE_CHARS
+            else f"{line[:MAX_LINE_CHARS]}... ({len(line) - MAX_LINE_CHARS} more characters)"
+            for line in lines[start - first_line:end - first_line]
+        ]
+
+    def segment_titles(self, first_lines):
+        """
+        Get the first line of each of several segments, cut to SEGMENT_TITLE_CHARS.
+
+        Args:
+            first_lines (list): Numbers of the segments' first lines
+
+        Returns:
+            dict: Line number -> line
+        """
+        titles = {}
+        if first_lines:
+            # Segments that start a chunk, which step segments do, are read in one query
+            rows = db.session.query(BuildLogChunk.first_line,
+                                    db.func.substr(BuildLogChunk.content, 1, SEGMENT_TITLE_CHARS)) \
+                .filter(BuildLogChunk.build_id == self.build_id, BuildLogChunk.first_line.in_(first_lines)).all()
+            for line_number, text in rows:
+                titles.setdefault(line_number, text.split('\n', 1)[0])
+        for line_number in first_lines:
+            if line_number not in titles:
+                lines = self.read(line_number, 1)
+                titles[line_number] = lines[0][:SEGMENT_TITLE_CHARS] if lines else ''
+        return titles
+
+
+def get_log_segments(build, log_lines=None):
+    """
+    Divide a build's log into segments by step.
+
+    Builds whose steps have no log offsets, which are builds from before steps were
+    recorded, have a single segment for the whole log.
+
+    Args:
+        build (Build): The build
+        log_lines (LogLines, optional): The build's log, if it has been read already
+
+    Returns:
+        tuple: (segments, total_lines), where each segment is a dictionary with the kind
+               ('setup', 'step', 'result' or 'log'), first_line and line_count, and steps
+               also have step_index, title, exit_code, cached and skipped
+    """
+    log_lines = log_lines or LogLines(build)
+    total_lines = log_lines.total_lines
+    steps = [step for step in build.steps if step.log_start is not None]
+
+    segments = []
+    position = 1
+    for step in steps:
+        first_line = log_lines.line_at(step.log_start)
+        end_line = log_lines.line_at(step.log_end) if step.log_end is not None else total_lines + 1
+        if first_line > position:
+            segments.append({'kind': 'setup' if not segments else 'log',
+                             'first_line': position, 'line_count': first_line - position})
+        segments.append({
+            'kind': 'step',
+            'step_index': step.step_index,
+            'first_line': first_line,
+            'line_count': max(end_line - first_line, 0),
+            'exit_code': step.exit_code,
+            'cached': bool(step.cached),
+            'skipped': bool(step.skipped),
+            'running': step.finished_at is None and build.status == 'running'
+        })
+        position = max(end_line, position)
+    if total_lines + 1 > position or not segments:
+        segments.append({'kind': 'result' if steps else 'log',
+                         'first_line': position, 'line_count': total_lines + 1 - position})
+
+    step_segments = [segment for segment in segments if segment['kind'] == 'step']
+    titles = log_lines.segment_titles([segment['first_line'] for segment in step_segments
+                                       if segment['line_count']])
+    for segment in step_segments:
+        segment['title'] = titles.get(segment['first_line'], '')
+    return segments, total_lines
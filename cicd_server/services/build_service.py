@@ -7,93 +7,86 @@ This module contains the build processing logic for the CICD Server application.
 import datetime
 import json
 import random
-import subprocess
-import re
 import logging
 import threading
 import time
 
-from cicd_server import app, db, build_in_progress, build_lock, logger, socketio
-from cicd_server.models import Build
-from cicd_server.utils.helpers import get_nested_value, format_time_duration, prepare_time_data, \
+from cicd_server import app, db, build_in_progress, build_lock, logger, emitter
+from cicd_server.models import Build, BuildGroup, BuildStep, Config, ACTIVE_STATUSES
+from cicd_server.services.analytics import invalidate_analytics
+from cicd_server.services.changes import changed_paths
+from cicd_server.services.config_stats import record_build_queued, record_build_dequeued, record_build_completed
+from cicd_server.services.live_builds import LiveBuild, live_builds, estimate_duration
+from cicd_server.services.log_search import LogIndexer, index_build_log
+from cicd_server.services.matrix import MatrixError, parse_matrix, expand_matrix
+from cicd_server.services.pipeline import get_pipeline
+from cicd_server.services.prefetch import prefetcher
+from cicd_server.services.step_runner import SHELL_SESSIONS_SUPPORTED, ShellSession, run_step
+from cicd_server.services.workspaces import acquire_workspace, release_workspace, payload_commit
+from cicd_server.utils.helpers import format_time_duration, prepare_time_data, \
     prepare_estimated_remaining_data, prepare_progress_update_data, log_caller
+from cicd_server.utils.metrics import QUEUE_WAIT_SECONDS, BUILDS_TRIGGERED, BUILD_DURATION_SECONDS, \
+    STEP_DURATION_SECONDS, WORKSPACE_PREFETCHES
+from cicd_server.utils.versions import build_versions, LATEST_BUILD_KEY
 
-from threading import local
+LOG_COMMIT_INTERVAL = 1.0  # Seconds between saves of a running step's log, each of which rewrites the whole log
 
-build_progress = {}  # Dictionary to store build progress data
 
-from threading import Lock
+class LeaseLostError(RuntimeError):
+    """Raised when a worker no longer holds the lease on the build it is running."""
 
-build_progress_lock = Lock()
 
+def uses_workers():
+    """Check whether builds are run by separate worker processes instead of server threads."""
+    return app.config.get('BUILD_EXECUTION') == 'worker'
 
-def send_progress_updates(build_id, similar_build, stop_event):
-    """Send progress updates every second for a running build."""
-    logger.info(f"Start progress updates thread for build: {build_id}")
 
-    with app.app_context():
-        while not stop_event.is_set():
-            try:
-                # Get the latest build data from the database
-                build = Build.query.get(build_id)
-                # db.session.refresh(build)  # Force refresh from database
-
-                # If build doesn't exist, stop sending updates
-                if not build:
-                    break
+def check_lease(lease, build_id):
+    """Raise LeaseLostError if the lease a build runs under has been lost."""
+    if lease is not None and lease.lost.is_set():
+        raise LeaseLostError(f"Lease on build #{build_id} was lost")
 
-                # Get current_step and total_steps from shared memory if available
-                # When reading from the shared memory:
-                with build_progress_lock:
-                    current_step = build_progress.get(build_id, {}).get('current_step', build.current_step)
-                    total_steps = build_progress.get(build_id, {}).get('total_steps', build.total_steps)
 
-                # Print total steps of the build
-                print(
-                    f"Build #{build.id} - Status: {build.status}, Current Step: {current_step}, Total Steps: {total_steps}")
+def emit_event(event, data):
+    """
+    Emit a Socket.IO event to all clients, through the rate-limited, coalescing emitter.
 
-                # Handle queued builds differently
-                if build.status == 'queued':
-                    # For queued builds, just send the status and queue position
-                    socketio.emit('build_progress_update', {
-                        'build_id': build.id,
-                        'status': build.status,
-                        'queue_position': build.queue_position
-                    })
-                    time.sleep(1)  # Sleep for 1 second before the next update
-                    continue
+    Every change to a build is emitted, so this also bumps the build's version, which
+    conditional and long-polling API requests wait on.
+    """
+    # Worker processes have no clients, the server relays their progress from the database
+    if app.config.get('WORKER_ID'):
+        return
+    if event == 'build_status_update':
+        build_versions.bump(data['build_id'], LATEST_BUILD_KEY)
+    elif 'build_id' in data:
+        build_versions.bump(data['build_id'])
+    emitter.emit(event, data)
+
+
+def send_progress_updates(build_id, stop_event):
+    """Send progress updates every second for a running build, from its live state."""
+    logger.info(f"Start progress updates thread for build: {build_id}")
 
-                # If build is not running or pending, stop sending updates
-                if build.status not in ['running', 'pending']:
-                    break
+    while not stop_event.is_set():
+        try:
+            live = live_builds.get(build_id)
 
-                # Skip sending updates if the build data is invalid (e.g., during database updates)
-                if current_step <= 0 or total_steps <= 0:
-                    time.sleep(0.5)  # Short sleep to avoid tight loop
-                    continue
+            # The build has finished
+            if live is None:
+                break
 
-                # Create a temporary build object with the correct current_step and total_steps
-                # for the calculate_build_progress function
-                temp_build = build
-                temp_build.current_step = current_step
-                temp_build.total_steps = total_steps
-
-                # Calculate progress and send update
-                progress_data = calculate_build_progress(temp_build, similar_build)
-
-                # Prepare the progress update data and emit it
-                update_data = prepare_progress_update_data(
-                    build,
-                    progress_data,
-                    current_step=current_step,
-                    total_steps=total_steps
-                )
-                socketio.emit('build_progress_update', update_data)
-                # Sleep for 1 second before sending the next update
-                time.sleep(1)
-            except Exception as e:
-                logger.exception(f"Error sending progress update for build #{build_id}: {str(e)}")
-                time.sleep(1)  # Sleep even on error to avoid tight loop
+            # Skip sending updates until the build has started its first step
+            if live.current_step <= 0 or live.total_steps <= 0:
+                stop_event.wait(0.5)
+                continue
+
+            emit_event('build_progress_update', prepare_progress_update_data(live, live.progress()))
+        except Exception as e:
+            logger.exception(f"Error sending progress update for build #{build_id}: {str(e)}")
+
+        # Sleep for 1 second before sending the next update
+        stop_event.wait(1)
 
 
 def get_most_recent_similar_build(build_id):
@@ -218,14 +211,6 @@ def calculate_build_progress(build, similar_build=None):
         if build_total_time > 0:
             # build_percent = (elapsed_time / build_total_time)
             build_percent = (build.current_step / build.total_steps + elapsed_time / build_total_time) * 0.5
-
-        # Steptimes from csv step_times
-        try:
-            step_times = json.loads(similar_build.step_times)
-            step_times = list(step_times.values())
-        except json.JSONDecodeError as e:
-            logger.error(f"Error decoding step_times JSON for similar build #{similar_build.id}: {str(e)}")
-            step_times = None
     else:
         logger.info("No similar build found for progress updates")
 
@@ -248,6 +233,23 @@ def calculate_build_progress(build, similar_build=None):
 
 
 
+def skipped_steps_duration(similar_build, skipped_steps):
+    """
+    Get the time that steps a build skips took in the similar build its duration is estimated from.
+
+    Args:
+        similar_build (Build): The similar build
+        skipped_steps (set): Indexes of the steps the build skips
+
+    Returns:
+        float: Seconds
+    """
+    rows = db.session.query(BuildStep.started_at, BuildStep.finished_at).filter(
+        BuildStep.build_id == similar_build.id, BuildStep.step_index.in_(skipped_steps),
+        BuildStep.started_at.isnot(None), BuildStep.finished_at.isnot(None))
+    return sum((finished_at - started_at).total_seconds() for started_at, finished_at in rows)
+
+
 def trigger_build_with_config(config, branch, triggered_by, payload=None):
     """
     Trigger a build with the given configuration.
@@ -262,22 +264,34 @@ def trigger_build_with_config(config, branch, triggered_by, payload=None):
     Returns:
         tuple: (build, status, message)
             build: The created Build object
-            status: 'success', 'queued', or 'error'
+            status: 'success', 'queued', 'matrix', or 'error'
             message: A message describing the result
+
+        For configurations with a build matrix, build is the BuildGroup of the builds
+        queued, and status is 'matrix', see queue_builds().
     """
     global build_in_progress
 
+    if config.matrix:
+        try:
+            has_matrix = bool(parse_matrix(config.matrix))
+        except MatrixError:
+            has_matrix = True  # queue_builds() rejects the trigger
+        if has_matrix:
+            return queue_builds([(config, branch, payload)], triggered_by)[0]
+
     # Convert payload to JSON string if provided
     payload_json = json.dumps(payload or {})
 
     with build_lock:
-        # Check if a build is already in progress
-        if build_in_progress:
+        # Check if a build is already in progress, workers take every build from the queue
+        if build_in_progress or uses_workers():
             # Count how many builds of this config type are already in the queue
             queued_builds_count = Build.query.filter_by(status='queued', config_id=config.id).count()
 
             # Check if we've reached the max queue length for this config
             if queued_builds_count >= config.max_queue_length:
+                BUILDS_TRIGGERED.inc(config=config.name, result='rejected')
                 return None, 'error', f'Maximum queue length ({config.max_queue_length}) reached for configuration "{config.name}".'
 
             # Find the highest queue position
@@ -289,6 +303,7 @@ def trigger_build_with_config(config, branch, triggered_by, payload=None):
                 status='queued',
                 branch=branch,
                 project_path=config.project_path,
+                queued_at=datetime.datetime.utcnow(),
                 triggered_by=triggered_by,
                 payload=payload_json,
                 config_id=config.id,
@@ -296,10 +311,13 @@ def trigger_build_with_config(config, branch, triggered_by, payload=None):
             )
 
             db.session.add(build)
+            record_build_queued(config.id)
             db.session.commit()
+            BUILDS_TRIGGERED.inc(config=config.name, result='queued')
+            prefetcher.wake()
 
             # Emit WebSocket event for build status update
-            socketio.emit('build_status_update', {
+            emit_event('build_status_update', {
                 'build_id': build.id,
                 'status': build.status,
                 'config_id': config.id,
@@ -312,11 +330,13 @@ def trigger_build_with_config(config, branch, triggered_by, payload=None):
             return build, 'queued', f'Build queued (position {build.queue_position}) using configuration "{config.name}"'
 
         # No build is in progress, start this one
+        now = datetime.datetime.utcnow()
         build = Build(
             status='pending',
             branch=branch,
             project_path=config.project_path,
-            started_at=datetime.datetime.utcnow(),
+            queued_at=now,
+            started_at=now,
             triggered_by=triggered_by,
             payload=payload_json,
             config_id=config.id
@@ -324,9 +344,11 @@ def trigger_build_with_config(config, branch, triggered_by, payload=None):
 
         db.session.add(build)
         db.session.commit()
+        build_versions.bump(build.id, LATEST_BUILD_KEY)
 
         # Set build_in_progress to True before starting the build thread
         build_in_progress = True
+        BUILDS_TRIGGERED.inc(config=config.name, result='started')
 
         # Start build in a separate thread
         threading.Thread(target=run_build, args=(build.id, branch, config.project_path, config.build_steps)).start()
@@ -334,10 +356,134 @@ def trigger_build_with_config(config, branch, triggered_by, payload=None):
         return build, 'success', f'Build triggered using configuration "{config.name}"'
 
 
+def queue_builds(triggers, triggered_by):
+    """
+    Queue several builds at once, taking the build lock once and committing them in one transaction.
+
+    Builds of configurations with a build matrix are queued as a build group, with one build
+    for each combination of the matrix's values. Each build's payload has its combination
+    under "matrix", for steps to use as ${matrix.<name>}. The builds are started as executors
+    become free: one at a time by the server, or in parallel by as many workers as are idle.
+
+    Args:
+        triggers (list): (config, branch, payload) tuples, where payload is a dict or None
+        triggered_by: Who triggered the builds
+
+    Returns:
+        list: A (build, status, message) tuple for each trigger, in order, where status is
+              'queued' with the queued Build, 'matrix' with the BuildGroup of the builds
+              queued, or 'error' with None if the trigger was rejected
+    """
+    # Expand matrices before taking the lock
+    expanded = []
+    for config, branch, payload in triggers:
+        try:
+            combinations = expand_matrix(parse_matrix(config.matrix)) or [None]
+        except MatrixError as e:
+            combinations = e
+        expanded.append((config, branch, payload or {}, combinations))
+
+    results = [None] * len(expanded)
+    accepted = []  # (index, config, builds, group) of each trigger whose builds were queued
+    with build_lock:
+        config_ids = {config.id for config, _, _, _ in expanded}
+        queued_counts = dict(db.session.query(Build.config_id, db.func.count(Build.id)).filter(
+            Build.status == 'queued', Build.config_id.in_(config_ids)).group_by(Build.config_id))
+        position = db.session.query(db.func.max(Build.queue_position)).filter(
+            Build.queue_position.isnot(None)).scalar() or 0
+        now = datetime.datetime.utcnow()
+
+        for index, (config, branch, payload, combinations) in enumerate(expanded):
+            if isinstance(combinations, MatrixError):
+                BUILDS_TRIGGERED.inc(config=config.name, result='rejected')
+                results[index] = (None, 'error', f'Invalid build matrix for configuration "{config.name}": '
+                                                 f'{combinations}')
+                continue
+            if queued_counts.get(config.id, 0) >= config.max_queue_length:
+                BUILDS_TRIGGERED.inc(config=config.name, result='rejected')
+                results[index] = (None, 'error', f'Maximum queue length ({config.max_queue_length}) reached '
+                                                 f'for configuration "{config.name}".')
+                continue
+
+            group = None
+            if combinations != [None]:
+                group = BuildGroup(config_id=config.id, branch=branch, triggered_by=triggered_by)
+                db.session.add(group)
+            builds = []
+            for values in combinations:
+                position += 1
+                build = Build(
+                    status='queued',
+                    branch=branch,
+                    project_path=config.project_path,
+                    queued_at=now,
+                    triggered_by=triggered_by,
+                    payload=json.dumps(payload if values is None else dict(payload, matrix=values)),
+                    config_id=config.id,
+                    queue_position=position,
+                    group=group,
+                    matrix_values=None if values is None else json.dumps(values)
+                )
+                db.session.add(build)
+                builds.append(build)
+            queued_counts[config.id] = queued_counts.get(config.id, 0) + len(builds)
+            accepted.append((index, config, builds, group))
+
+        if accepted:
+            # A configuration's queue length is updated with one SQL expression, so count its builds together
+            counts = {}
+            for _, config, builds, _ in accepted:
+                counts[config.id] = counts.get(config.id, 0) + len(builds)
+            for config_id, count in counts.items():
+                record_build_queued(config_id, count)
+            db.session.flush()
+
+            # Read everything needed from the builds before committing expires them
+            events = []
+            for index, config, builds, group in accepted:
+                for build in builds:
+                    events.append({
+                        'build_id': build.id,
+                        'status': build.status,
+                        'config_id': config.id,
+                        'config_name': config.name,
+                        'triggered_by': build.triggered_by,
+                        'branch': build.branch,
+                        'queue_position': build.queue_position,
+                        'group_id': group.id if group is not None else None
+                    })
+                if group is not None:
+                    results[index] = (group, 'matrix', f'Build matrix of {len(builds)} builds queued '
+                                                       f'using configuration "{config.name}"')
+                else:
+                    results[index] = (builds[0], 'queued', f'Build queued (position {builds[0].queue_position}) '
+                                                           f'using configuration "{config.name}"')
+                BUILDS_TRIGGERED.inc(len(builds), config=config.name, result='queued')
+            db.session.commit()
+
+            for data in events:
+                emit_event('build_status_update', data)
+
+    if accepted:
+        # Start the first build now if nothing else is running
+        start_next_queued_build()
+        prefetcher.wake()
+
+        # Reload the builds and configurations with one query each, rather than one per object as they are read
+        Build.query.filter(Build.id.in_([data['build_id'] for data in events])).all()
+        Config.query.filter(Config.id.in_(config_ids)).all()
+
+    return results
+
+
 def start_next_queued_build():
     """Start the next build in the queue if any."""
     global build_in_progress
 
+    # Workers claim queued builds themselves
+    if uses_workers():
+        return False
+
     # Use the build_lock to ensure thread safety
     with build_lock:
         # Check if a build is already in progress
@@ -352,14 +498,22 @@ def start_next_queued_build():
             if next_build:
                 # Update the build status and clear the queue position
                 next_build.status = 'pending'
-                next_build.started_at = datetime.datetime.utcnow()
+                if next_build.resume_step is None:
+                    # Resumed builds keep the start time of their first run
+                    next_build.started_at = datetime.datetime.utcnow()
                 next_build.queue_position = None
+                record_build_dequeued(next_build.config_id)
                 db.session.commit()
+                build_versions.bump(next_build.id, LATEST_BUILD_KEY)
 
                 # Get the configuration for this build
                 from cicd_server.models import Config
                 config = Config.query.get(next_build.config_id)
 
+                if next_build.queued_at and next_build.resume_step is None:
+                    QUEUE_WAIT_SECONDS.observe((next_build.started_at - next_build.queued_at).total_seconds(),
+                                               config=config.name)
+
                 # Set build_in_progress to True before starting the build thread
                 build_in_progress = True
 
@@ -369,13 +523,21 @@ def start_next_queued_build():
                                                          config.build_steps)).start()
 
                 logger.info(f"Started next queued build #{next_build.id}")
+                # The build after it in the queue can be prepared now
+                prefetcher.wake()
                 return True
 
             return False
 
 
-def run_build(build_id, branch, project_path, build_steps):
-    """Run a build with the specified parameters."""
+def run_build(build_id, branch, project_path, build_steps, lease=None):
+    """
+    Run a build with the specified parameters.
+
+    Args:
+        lease (BuildLease, optional): The lease a worker holds on the build. The build stops
+            between steps if the lease is lost, leaving the build to whoever reclaimed it.
+    """
     global build_in_progress
 
     with build_lock:
@@ -384,6 +546,8 @@ def run_build(build_id, branch, project_path, build_steps):
     # Create a stop event for the progress update thread
     progress_stop_event = threading.Event()
     progress_thread = None
+    workspace = None
+    shell_session = None
 
     # Use Flask application context for database operations
     with app.app_context():
@@ -391,12 +555,6 @@ def run_build(build_id, branch, project_path, build_steps):
             build = Build.query.get(build_id)
             build.status = 'running'
 
-            # Initialize the shared memory object with proper values
-            build_progress[build_id] = {
-                'current_step': 0,
-                'total_steps': 0  # Will be updated after we calculate steps
-            }
-
             # Set the started_at timestamp if it's not already set
             if not build.started_at:
                 build.started_at = datetime.datetime.utcnow()
@@ -404,29 +562,96 @@ def run_build(build_id, branch, project_path, build_steps):
             # Always commit the changes to ensure they're saved
             db.session.commit()
 
+            # Readers get the build's state from memory until it finishes
+            live_builds.publish(LiveBuild(build.id, build.config_id, build.config.name, build.status,
+                                          started_at=build.started_at))
+
             # Parse the payload JSON
             payload = json.loads(build.payload) if build.payload else {}
 
-            # Log the build start
-            log_message = f"Build #{build_id} started at {build.started_at}\n"
-            log_message += f"Branch: {branch}\n"
-            log_message += f"Project path: {project_path}\n"
-
-            # Log the payload
-            log_message += f"Payload: {json.dumps(payload, indent=2)}\n\n"
-
-            # Initialize step tracking
-            steps = [s for s in build_steps.strip().split('\n') if s.strip()]
-            build.total_steps = len(steps)
-            build_progress[build_id]['total_steps'] = len(steps)
-            build.current_step = 0
-            build.step_times = json.dumps({})
+            # Initialize step tracking from the configuration's compiled pipeline
+            pipeline = get_pipeline(build.config_id, build_steps)
+            first_step = 0
+
+            previous_workspace = build.workspace_path
+            prefetch = None
+            if build.config.isolated_workspaces:
+                if build.resume_step is None and prefetcher.enabled():
+                    # The workspace may have been prepared while the build was queued
+                    prefetch = prefetcher.take(build.id)
+                    WORKSPACE_PREFETCHES.inc(config=build.config.name, result='hit' if prefetch else 'miss')
+                if prefetch is not None:
+                    workspace = prefetch.workspace
+                else:
+                    # The build runs in a worktree of its own, which a resumed build gets back if it is still there
+                    workspace = acquire_workspace(build.config, branch, payload_commit(payload),
+                                                  previous_path=previous_workspace if build.resume_step is not None
+                                                  else None)
+                build.workspace_path = project_path = workspace.path
+            else:
+                build.workspace_path = None
+            workspace_message = ''
+            if workspace:
+                workspace_message = f"Workspace: {workspace.path} at {workspace.revision}" \
+                                    f"{' (prefetched while queued)' if prefetch else ''}\n"
+
+            # Steps with path filters are skipped if none of the files the push changed match them
+            skipped_steps = set()
+            if pipeline.has_path_filters:
+                changed = changed_paths(payload, project_path)
+                if changed is None:
+                    workspace_message += "Changed files: unknown, so steps with path filters run\n"
+                else:
+                    skipped_steps = {step.index for step in pipeline.steps if not step.matches_changes(changed)}
+                    workspace_message += f"Changed files: {len(changed)}\n"
+
+            if build.resume_step is None:
+                # Log the build start
+                log_message = f"Build #{build_id} started at {build.started_at}\n"
+                log_message += f"Branch: {branch}\n"
+                log_message += f"Project path: {project_path}\n"
+                log_message += workspace_message
+
+                # Log the payload
+                log_message += f"Payload: {json.dumps(payload, indent=2)}\n\n"
+                build.step_times = json.dumps({})
+                log_indexer = LogIndexer(build.id)
+            else:
+                # An interrupted build continues its log, and skips the steps it completed unless they have changed
+                completed = {step.step_index: step.command_hash for step in build.steps
+                             if step.exit_code == 0 and step.finished_at}
+                if build.resume_step > len(pipeline) or not all(
+                        completed.get(step.index) == step.command_hash for step in pipeline.steps[:build.resume_step]):
+                    log_message = build.log + f"\nBuild #{build_id} restarted at {datetime.datetime.utcnow()}, " \
+                                              f"since its build steps changed while it was interrupted\n"
+                elif build.workspace_path != previous_workspace:
+                    log_message = build.log + f"\nBuild #{build_id} restarted at {datetime.datetime.utcnow()}, " \
+                                              f"since the workspace it ran in is no longer available\n"
+                else:
+                    first_step = build.resume_step
+                    log_message = build.log + f"\nBuild #{build_id} resumed from step {first_step + 1} at " \
+                                              f"{datetime.datetime.utcnow()}\n"
+                log_message += workspace_message + "\n"
+                BuildStep.query.filter(BuildStep.build_id == build.id, BuildStep.step_index >= first_step) \
+                    .delete(synchronize_session=False)
+                db.session.expire(build, ['steps'])
+                log_indexer = LogIndexer.resume(build.id)
+
+            build.total_steps = len(pipeline)
+            build.current_step = first_step
             build.log = log_message
+            # The log is split into searchable chunks as it is saved
+            log_indexer.update(log_message, flush=True)
             db.session.commit()
 
             logger.info(f"Build #{build.id} started with {build.total_steps} steps")
 
             similar_build = get_most_recent_similar_build(build_id)
+            estimated_total = estimate_duration(similar_build)
+            if estimated_total is not None and skipped_steps:
+                estimated_total = max(estimated_total - skipped_steps_duration(similar_build, skipped_steps), 0)
+            live_builds.update(build_id, current_step=first_step, total_steps=build.total_steps,
+                               log_length=len(log_message), estimated_total=estimated_total)
 
             if similar_build:
                 logger.info(f"Found similar build #{similar_build.id} for build #{build_id}")
@@ -436,7 +661,7 @@ def run_build(build_id, branch, project_path, build_steps):
                 logger.info(f"No similar build found for build #{build_id}")
 
             # Emit WebSocket event for build status change
-            socketio.emit('build_status_update', {
+            emit_event('build_status_update', {
                 'build_id': build.id,
                 'status': build.status,
                 'config_id': build.config_id,
@@ -449,110 +674,181 @@ def run_build(build_id, branch, project_path, build_steps):
             # Start the progress update thread
             progress_thread = threading.Thread(
                 target=send_progress_updates,
-                args=(build_id, similar_build, progress_stop_event),
+                args=(build_id, progress_stop_event),
                 daemon=True
             )
             progress_thread.start()
 
+            log_committed_at = time.monotonic()
+
+            def append_output(text):
+                # Called with batches of step output, at most a few times per second
+                nonlocal log_message, log_committed_at
+                log_message += text
+                live_builds.update(build.id, log_length=len(log_message))
+                if time.monotonic() - log_committed_at >= LOG_COMMIT_INTERVAL:
+                    build.log = log_message
+                    log_indexer.update(log_message)
+                    db.session.commit()
+                    log_committed_at = time.monotonic()
+
+                # Emit WebSocket event for log update; clients read the new lines from the API when they want them
+                emit_event('build_log_update', {
+                    'build_id': build.id,
+                    'log_length': len(log_message),
+                    'status': build.status
+                })
+
+            # Warm-up steps that ran while the build was queued are recorded rather than run again
+            for prefetched in prefetch.steps if prefetch else ():
+                if first_step >= len(pipeline) or prefetched.index != first_step or \
+                        prefetched.command_hash != pipeline.steps[first_step].command_hash or \
+                        first_step in skipped_steps:
+                    break
+                build.current_step = first_step + 1
+                build_step = BuildStep(
+                    build_id=build.id,
+                    config_id=build.config_id,
+                    step_index=first_step,
+                    command_hash=prefetched.command_hash,
+                    started_at=prefetched.started_at,
+                    finished_at=prefetched.finished_at,
+                    exit_code=0,
+                    cached=True,
+                    log_start=len(log_message)
+                )
+                log_message += f"Executing: {prefetched.command}\n{prefetched.output}"
+                log_message += f"Step {build.current_step}/{build.total_steps} completed successfully " \
+                               f"while the build was queued\n\n"
+                build_step.log_end = len(log_message)
+                build.log = log_message
+                db.session.add(build_step)
+                log_indexer.update(log_message, flush=True)
+                db.session.commit()
+                live_builds.update(build_id, current_step=build.current_step, log_length=len(log_message))
+                first_step += 1
+
+            if build.config.shell_session and SHELL_SESSIONS_SUPPORTED:
+                # Steps run one after another in the same shell, keeping its variables and directory
+                shell_session = ShellSession(project_path)
+
             # Execute build steps
             success = True
-            step_times = {}
 
-            for step_idx, step in enumerate(steps):
-                if not step.strip():
-                    continue
+            for step in pipeline.steps[first_step:]:
+                step_idx = step.index
+                check_lease(lease, build_id)
 
                 # Update current step
                 build.current_step = step_idx + 1
-                # When updating the shared memory:
-                with build_progress_lock:
-                    build_progress[build_id]['current_step'] = step_idx + 1
-
-                # Record time from build start
-                current_time = datetime.datetime.utcnow()
-                time_from_start = (current_time - build.started_at).total_seconds()
-                step_times[str(step_idx)] = time_from_start
-                build.step_times = json.dumps(step_times)
-                db.session.commit()
 
-                # Emit WebSocket event for build progress update
-                progress_data = calculate_build_progress(build, similar_build)
+                if step_idx in skipped_steps:
+                    now = datetime.datetime.utcnow()
+                    build_step = BuildStep(
+                        build_id=build.id,
+                        config_id=build.config_id,
+                        step_index=step_idx,
+                        command_hash=step.command_hash,
+                        started_at=now,
+                        finished_at=now,
+                        exit_code=0,
+                        skipped=True,
+                        log_start=len(log_message)
+                    )
+                    log_message += f"Skipping: {step.render(payload)}\n"
+                    log_message += f"Step {build.current_step}/{build.total_steps} skipped, since no changed files " \
+                                   f"match {' '.join(step.paths)}\n\n"
+                    build_step.log_end = len(log_message)
+                    build.log = log_message
+                    db.session.add(build_step)
+                    log_indexer.update(log_message, flush=True)
+                    db.session.commit()
+                    live = live_builds.update(build_id, current_step=build.current_step, log_length=len(log_message))
+                    emit_event('build_progress_update', prepare_progress_update_data(live, live.progress()))
+                    continue
 
-                # Prepare the progress update data and emit it
-                update_data = prepare_progress_update_data(build, progress_data)
-                socketio.emit('build_progress_update', update_data)
+                # Record the step start
+                build_step = BuildStep(
+                    build_id=build.id,
+                    config_id=build.config_id,
+                    step_index=step_idx,
+                    command_hash=step.command_hash,
+                    started_at=datetime.datetime.utcnow(),
+                    log_start=len(log_message)
+                )
+                db.session.add(build_step)
+                db.session.commit()
+                live = live_builds.update(build_id, current_step=build.current_step)
 
-                # Replace variables in the step with values from the payload
-                processed_step = step
+                # Emit WebSocket event for build progress update
+                emit_event('build_progress_update', prepare_progress_update_data(live, live.progress()))
 
                 # Replace ${variable} with the corresponding value from the payload
-                for match in re.finditer(r'\${([\w\.]+)}', step):
-                    var_name = match.group(1)
-                    var_value = get_nested_value(payload, var_name)
-                    if var_value is not None:
-                        processed_step = processed_step.replace(match.group(0), str(var_value))
+                processed_step = step.render(payload)
 
                 log_message += f"Executing: {processed_step}\n"
                 build.log = log_message
                 db.session.commit()
+                live_builds.update(build_id, log_length=len(log_message))
 
+                step_started = time.monotonic()
                 try:
-                    process = subprocess.Popen(
-                        processed_step,  # Use the processed step with variables replaced
-                        shell=True,
-                        cwd=project_path,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT,
-                        text=True
-                    )
-
-                    # Capture output in real-time
-                    while True:
-                        output = process.stdout.readline()
-                        if output == '' and process.poll() is not None:
-                            break
-                        if output:
-                            log_message += output
-                            build.log = log_message
-                            db.session.commit()
-
-                            # Emit WebSocket event for log update
-                            socketio.emit('build_log_update', {
-                                'build_id': build.id,
-                                'log': build.log,
-                                'status': build.status
-                            })
-
-                    return_code = process.poll()
+                    # Run the processed step with variables replaced, capturing output in real-time
+                    if shell_session is not None:
+                        return_code = shell_session.run(processed_step, append_output)
+                    else:
+                        return_code = run_step(processed_step, project_path, append_output)
+                    STEP_DURATION_SECONDS.observe(time.monotonic() - step_started, config=build.config.name,
+                                                  result='success' if return_code == 0 else 'failed')
+                    build_step.exit_code = return_code
                     if return_code != 0:
                         log_message += f"Step failed with return code {return_code}\n"
                         success = False
 
-                        # No need to record step end time as we're only tracking time from build start
+                        build_step.finished_at = datetime.datetime.utcnow()
+                        build_step.log_end = len(log_message)
+                        build.log = log_message
+                        log_indexer.update(log_message, flush=True)
                         db.session.commit()
                         break
                     else:
                         log_message += f"Step {build.current_step}/{build.total_steps} completed successfully\n\n"
 
-                        # No need to record step end time as we're only tracking time from build start
+                        build_step.finished_at = datetime.datetime.utcnow()
+                        build_step.log_end = len(log_message)
+                        build.log = log_message
+                        log_indexer.update(log_message, flush=True)
                         db.session.commit()
                 except Exception as e:
                     log_message += f"Error executing step: {str(e)}\n"
                     success = False
+                    STEP_DURATION_SECONDS.observe(time.monotonic() - step_started, config=build.config.name,
+                                                  result='error')
 
-                    # No need to record step end time as we're only tracking time from build start
+                    build_step.finished_at = datetime.datetime.utcnow()
+                    build_step.log_end = len(log_message)
+                    build.log = log_message
+                    log_indexer.update(log_message, flush=True)
                     db.session.commit()
                     break
 
             # Update build status
+            check_lease(lease, build_id)
             build.status = 'success' if success else 'failed'
             build.completed_at = datetime.datetime.utcnow()
             log_message += f"\nBuild {'succeeded' if success else 'failed'} at {build.completed_at}\n"
             build.log = log_message
+            log_indexer.update(log_message, final=True)
+            record_build_completed(build)
             db.session.commit()
+            # The database has the build's final state now
+            live_builds.remove(build_id)
+            BUILD_DURATION_SECONDS.observe((build.completed_at - build.started_at).total_seconds(),
+                                           config=build.config.name, status=build.status)
+            invalidate_analytics(build.config_id)
 
             # Emit WebSocket event for build completion
-            socketio.emit('build_status_update', {
+            emit_event('build_status_update', {
                 'build_id': build.id,
                 'status': build.status,
                 'config_id': build.config_id,
@@ -570,24 +866,35 @@ def run_build(build_id, branch, project_path, build_steps):
 
             # Prepare the progress update data and emit it with 100% completion
             update_data = prepare_progress_update_data(build, progress_data, force_percent=100)
-            socketio.emit('build_progress_update', update_data)
+            emit_event('build_progress_update', update_data)
 
             # Also emit a final log update
-            socketio.emit('build_log_update', {
+            emit_event('build_log_update', {
                 'build_id': build.id,
-                'log': build.log,
+                'log_length': len(log_message),
                 'status': build.status
             })
 
+        except LeaseLostError as e:
+            # The build has been failed by whoever found the lease expired, so leave it as it is
+            logger.error(f"Stopping build #{build_id}: {str(e)}")
+            db.session.rollback()
         except Exception as e:
             logger.exception("Error in build process")
             build.status = 'failed'
             build.completed_at = datetime.datetime.utcnow()
             build.log += f"\nError in build process: {str(e)}\n"
+            index_build_log(build.id)
+            record_build_completed(build)
             db.session.commit()
+            live_builds.remove(build_id)
+            if build.started_at:
+                BUILD_DURATION_SECONDS.observe((build.completed_at - build.started_at).total_seconds(),
+                                               config=build.config.name, status=build.status)
+            invalidate_analytics(build.config_id)
 
             # Emit WebSocket event for build failure
-            socketio.emit('build_status_update', {
+            emit_event('build_status_update', {
                 'build_id': build.id,
                 'status': build.status,
                 'config_id': build.config_id,
@@ -605,12 +912,12 @@ def run_build(build_id, branch, project_path, build_steps):
 
             # Prepare the progress update data and emit it
             update_data = prepare_progress_update_data(build, progress_data)
-            socketio.emit('build_progress_update', update_data)
+            emit_event('build_progress_update', update_data)
 
             # Also emit a final log update
-            socketio.emit('build_log_update', {
+            emit_event('build_log_update', {
                 'build_id': build.id,
-                'log': build.log,
+                'log_length': len(build.log),
                 'status': build.status
             })
         finally:
@@ -620,9 +927,17 @@ def run_build(build_id, branch, project_path, build_steps):
                 # Wait for the thread to finish, but with a timeout
                 progress_thread.join(timeout=2.0)
 
-            # Clean up shared memory
-            if build_id in build_progress:
-                del build_progress[build_id]
+            # Forget the build's live state, if it wasn't already when the build finished
+            live_builds.remove(build_id)
+
+            if shell_session is not None:
+                shell_session.close()
+
+            if workspace is not None:
+                try:
+                    release_workspace(workspace, Config.query.get(workspace.config_id))
+                except Exception:
+                    logger.exception(f"Error releasing workspace {workspace.path}")
 
             with build_lock:
                 build_in_progress = False
@@ -631,29 +946,90 @@ def run_build(build_id, branch, project_path, build_steps):
             start_next_queued_build()
 
 
+def requeue_interrupted_build(build):
+    """
+    Queue a build that was interrupted by a server restart to resume from its resume point.
+
+    The build resumes from the first step it didn't complete if that step is resumable,
+    or otherwise from the closest resumable step before it (see Pipeline.resume_point()).
+    The records of the steps it completed before that are kept, and the records of the
+    steps it runs again are deleted when it starts. The caller sets the queue position,
+    counts the build as queued and commits.
+
+    Args:
+        build (Build): The interrupted build
+
+    Returns:
+        int or None: The index of the step the build resumes from, or None if it can't be resumed
+    """
+    pipeline = get_pipeline(build.config_id, build.config.build_steps)
+    completed = {step.step_index: step.command_hash for step in build.steps
+                 if step.exit_code == 0 and step.finished_at}
+    resume_step = pipeline.resume_point(completed)
+    if resume_step is None:
+        return None
+
+    build.status = 'queued'
+    build.resume_step = resume_step
+    build.current_step = resume_step
+    if resume_step < len(pipeline):
+        build.log += f"\nBuild interrupted by a server restart at {datetime.datetime.utcnow()}, " \
+                     f"it will resume from step {resume_step + 1}\n"
+    else:
+        build.log += f"\nBuild interrupted by a server restart at {datetime.datetime.utcnow()}, " \
+                     f"after all its steps completed\n"
+    return resume_step
+
+
 def mark_abandoned_builds():
     """
     Mark any builds that are still in 'pending' or 'running' state as 'failed-permanently'.
     Reset queued builds to be started again.
     This is called at server startup to handle builds that were interrupted by a server shutdown.
+    Builds claimed by workers are left alone, since they outlive the server and their leases
+    expire if the worker stops.
+
+    If RESUME_INTERRUPTED_BUILDS is set, interrupted builds that can resume from a resumable
+    step are queued ahead of the other queued builds instead, see requeue_interrupted_build().
     """
     with app.app_context():
-        # Mark pending and running builds as failed-permanently
-        abandoned_builds = Build.query.filter(Build.status.in_(['pending', 'running'])).all()
+        # Mark pending and running builds as failed-permanently, or queue them to resume
+        abandoned_builds = Build.query.filter(Build.status.in_(ACTIVE_STATUSES),
+                                              Build.worker_id.is_(None)).all()
+        resumed_builds = []
         for build in abandoned_builds:
+            if app.config.get('RESUME_INTERRUPTED_BUILDS') and requeue_interrupted_build(build) is not None:
+                # Ahead of the builds that were already queued
+                build.queue_position = 0
+                resumed_builds.append(build)
+                continue
+
             build.status = 'failed-permanently'
             build.completed_at = datetime.datetime.utcnow()
             build.log += f"\nBuild marked as FAILED PERMANENTLY due to server restart at {build.completed_at}\n"
+            index_build_log(build.id)
+            record_build_completed(build)
+            invalidate_analytics(build.config_id)
+
+        # Count resumed builds once per configuration, since the count is one SQL expression
+        resumed_counts = {}
+        for build in resumed_builds:
+            resumed_counts[build.config_id] = resumed_counts.get(build.config_id, 0) + 1
+        for config_id, count in resumed_counts.items():
+            record_build_queued(config_id, count)
 
         # Reset queue positions for queued builds
         # This ensures they maintain their relative order in the queue
-        queued_builds = Build.query.filter_by(status='queued').order_by(Build.queue_position).all()
+        queued_builds = Build.query.filter_by(status='queued').order_by(Build.queue_position, Build.id).all()
         for i, build in enumerate(queued_builds):
             build.queue_position = i + 1
 
         if abandoned_builds or queued_builds:
             db.session.commit()
-            logger.info(f"Marked {len(abandoned_builds)} abandoned builds as failed-permanently")
+            logger.info(f"Marked {len(abandoned_builds) - len(resumed_builds)} abandoned builds as failed-permanently")
+            if resumed_builds:
+                logger.info(f"Queued {len(resumed_builds)} interrupted builds to resume: "
+                            f"{', '.join(f'#{build.id} from step {build.resume_step + 1}' for build in resumed_builds)}")
             logger.info(f"Reset queue positions for {len(queued_builds)} queued builds")
 
         # Start the first queued build if any
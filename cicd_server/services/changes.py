@@ -0,0 +1,90 @@
+﻿"""
+Changed Files
+
+This module finds the files a push changed, for build steps with path filters. They are
+read from the payload if it lists them, as a "changed_files" list or in the added, modified
+and removed lists of its "commits" like GitHub and GitLab push payloads, or otherwise
+compared with git between the payload's "before" and "after" commits in the build's
+project path or workspace.
+"""
+
+from cicd_server import logger
+from cicd_server.services.workspaces import WorkspaceError, git, is_commit_hash
+
+# Push payloads list at most this many commits, so longer pushes are compared with git if possible
+PAYLOAD_COMMITS_LIMIT = 20
+
+
+def _is_commit(value):
+    # GitHub sends a hash of zeros as "before" for new branches
+    return is_commit_hash(value) and value.strip('0') != ''
+
+
+def payload_changed_paths(payload):
+    """
+    Get the changed files a payload lists.
+
+    Args:
+        payload (dict): The build payload
+
+    Returns:
+        tuple: (paths, complete), where paths is a set of paths, or None if the payload
+               doesn't list changed files, and complete is False if the list may be cut short
+    """
+    if isinstance(payload.get('changed_files'), list):
+        return {path for path in payload['changed_files'] if isinstance(path, str)}, True
+
+    commits = payload.get('commits')
+    if not isinstance(commits, list) or not commits:
+        return None, False
+    paths = set()
+    for commit in commits:
+        if not isinstance(commit, dict):
+            continue
+        for key in ('added', 'modified', 'removed'):
+            paths.update(path for path in commit.get(key) or () if isinstance(path, str))
+    return paths, len(commits) < PAYLOAD_COMMITS_LIMIT
+
+
+def git_changed_paths(repository, before, after):
+    """
+    Compare two commits with git.
+
+    Returns:
+        set: The paths of the files that differ, with both paths of renamed files, or None
+             if the commits can't be compared, e.g. because before isn't in the repository
+    """
+    try:
+        result = git(repository, 'diff', '--name-only', '--no-renames', '--end-of-options', before, after, '--',
+                     check=False)
+    except WorkspaceError as e:
+        logger.warning(f"Could not compare {before} and {after} in {repository}: {e}")
+        return None
+    if result.returncode != 0:
+        return None
+    return {line for line in result.stdout.splitlines() if line}
+
+
+def changed_paths(payload, repository):
+    """
+    Find the files a build's push changed.
+
+    Args:
+        payload (dict): The build payload
+        repository (str): The directory the build runs in
+
+    Returns:
+        set: The changed files' paths, relative to the repository root, or None if they
+             can't be found, in which case steps with path filters run
+    """
+    paths, complete = payload_changed_paths(payload)
+    if complete:
+        return paths
+
+    before, after = payload.get('before'), payload.get('after')
+    if _is_commit(before) and _is_commit(after):
+        compared = git_changed_paths(repository, before, after)
+        if compared is not None:
+            return compared
+    # Running a step needlessly is better than skipping one that was needed
+    return None
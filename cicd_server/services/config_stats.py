@@ -0,0 +1,202 @@
+﻿"""
+Configuration Statistics
+
+This module maintains the per-configuration ConfigStats rollup. The record functions only
+modify the session, so callers commit them in the same transaction as the build change
+they describe, keeping the rollup consistent with the build table. Counters are updated
+with SQL expressions so that concurrent sessions never overwrite each other's increments.
+"""
+
+import datetime
+import json
+import math
+
+from cicd_server import app, db
+from cicd_server.models import Build, Config, ConfigStats, FAILED_STATUSES
+
+# Relative accuracy of the duration sketch: percentiles are within about 5% of the true value
+SKETCH_GAMMA = 1.1
+SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+
+
+class DurationSketch:
+    """A mergeable log-bucket histogram that estimates percentiles with bounded relative error."""
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or {}  # Dictionary of bucket index -> count
+
+    @classmethod
+    def loads(cls, value):
+        try:
+            return cls({int(k): v for k, v in json.loads(value or '{}').items()})
+        except (json.JSONDecodeError, ValueError, AttributeError):
+            return cls()
+
+    def dumps(self):
+        return json.dumps({str(k): v for k, v in sorted(self.buckets.items())})
+
+    def add(self, seconds):
+        # Durations under a second all share the lowest bucket
+        index = 0 if seconds <= 1 else math.ceil(math.log(seconds) / SKETCH_LOG_GAMMA)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def count(self):
+        return sum(self.buckets.values())
+
+    def percentile(self, percent):
+        """Estimate a percentile in seconds, or None if the sketch is empty."""
+        total = self.count()
+        if not total:
+            return None
+        rank = percent / 100.0 * (total - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                if index == 0:
+                    return 1.0
+                # Midpoint of the bucket (gamma^(i-1), gamma^i]
+                return 2 * SKETCH_GAMMA ** index / (SKETCH_GAMMA + 1)
+        return None
+
+
+def get_or_create_stats(config_id):
+    """Get the ConfigStats row for a configuration, adding an empty one to the session if needed."""
+    stats = db.session.get(ConfigStats, config_id)
+    if stats is None:
+        stats = ConfigStats(config_id=config_id, total_builds=0, successes=0, failures=0, duration_count=0,
+                            duration_mean=0.0, duration_sketch='{}', queue_length=0)
+        db.session.add(stats)
+        # Insert the row now, so counters can be updated with SQL expressions
+        db.session.flush()
+    return stats
+
+
+def record_build_queued(config_id, count=1):
+    """
+    Count builds entering the queue. The caller commits.
+
+    The count is applied as one SQL expression, so builds queued together must be counted
+    with one call rather than one call each.
+    """
+    stats = get_or_create_stats(config_id)
+    stats.queue_length = ConfigStats.queue_length + count
+    stats.updated_at = datetime.datetime.utcnow()
+
+
+def record_build_dequeued(config_id):
+    """Count a build leaving the queue. The caller commits."""
+    stats = get_or_create_stats(config_id)
+    stats.queue_length = db.func.max(ConfigStats.queue_length - 1, 0)
+    stats.updated_at = datetime.datetime.utcnow()
+
+
+def record_build_completed(build):
+    """
+    Add a finished build to its configuration's statistics. The caller commits.
+
+    Args:
+        build (Build): A build whose status and completed_at have just been set
+    """
+    stats = get_or_create_stats(build.config_id)
+
+    # The mean and sketch are read-modify-write, so start from the committed values
+    db.session.refresh(stats, ['duration_count', 'duration_mean', 'duration_sketch'])
+
+    stats.total_builds = ConfigStats.total_builds + 1
+
+    if build.status == 'success':
+        stats.successes = ConfigStats.successes + 1
+        stats.last_success_id = build.id
+
+        if build.started_at and build.completed_at:
+            duration = (build.completed_at - build.started_at).total_seconds()
+            count = (stats.duration_count or 0) + 1
+            stats.duration_mean = (stats.duration_mean or 0.0) + (duration - (stats.duration_mean or 0.0)) / count
+            stats.duration_count = count
+
+            sketch = DurationSketch.loads(stats.duration_sketch)
+            sketch.add(duration)
+            stats.duration_sketch = sketch.dumps()
+    elif build.status in FAILED_STATUSES:
+        stats.failures = ConfigStats.failures + 1
+        stats.last_failure_id = build.id
+
+    stats.updated_at = datetime.datetime.utcnow()
+
+
+def duration_percentile(stats, percent):
+    """Estimate a duration percentile in seconds from a ConfigStats row, or None if unknown."""
+    if stats is None:
+        return None
+    return DurationSketch.loads(stats.duration_sketch).percentile(percent)
+
+
+def rebuild_config_stats(config_id=None):
+    """
+    Recompute ConfigStats from the build table.
+
+    Args:
+        config_id (int, optional): Only rebuild this configuration, otherwise rebuild all
+
+    Returns:
+        int: The number of configurations rebuilt
+    """
+    with app.app_context():
+        config_ids = [config_id] if config_id is not None else [c.id for c in Config.query.all()]
+        for cid in config_ids:
+            stats = get_or_create_stats(cid)
+
+            counts = dict(db.session.query(Build.status, db.func.count(Build.id))
+                          .filter(Build.config_id == cid).group_by(Build.status).all())
+            stats.successes = counts.get('success', 0)
+            stats.failures = sum(counts.get(status, 0) for status in FAILED_STATUSES)
+            stats.total_builds = stats.successes + stats.failures
+            stats.queue_length = counts.get('queued', 0)
+
+            stats.last_success_id = db.session.query(db.func.max(Build.id)) \
+                .filter(Build.config_id == cid, Build.status == 'success').scalar()
+            stats.last_failure_id = db.session.query(db.func.max(Build.id)) \
+                .filter(Build.config_id == cid, Build.status.in_(FAILED_STATUSES)).scalar()
+
+            # Stream durations into the sketch without loading the builds themselves
+            sketch = DurationSketch()
+            total = 0.0
+            count = 0
+            durations = db.session.query(
+                (db.func.julianday(Build.completed_at) - db.func.julianday(Build.started_at)) * 86400.0
+            ).filter(Build.config_id == cid, Build.status == 'success',
+                     Build.started_at.isnot(None), Build.completed_at.isnot(None))
+            for (duration,) in durations.yield_per(10000):
+                sketch.add(duration)
+                total += duration
+                count += 1
+            stats.duration_count = count
+            stats.duration_mean = total / count if count else 0.0
+            stats.duration_sketch = sketch.dumps()
+            stats.updated_at = datetime.datetime.utcnow()
+
+            db.session.commit()
+        return len(config_ids)
+
+
+def ensure_config_stats():
+    """
+    Create missing ConfigStats rows from existing data and resynchronize queue lengths.
+
+    This is called at server startup, so existing databases get their rollup on first start.
+    """
+    with app.app_context():
+        missing = [c.id for c in Config.query.outerjoin(ConfigStats).filter(ConfigStats.config_id.is_(None)).all()]
+
+        # Queue lengths can drift if the server stopped between enqueue and commit
+        queued = dict(db.session.query(Build.config_id, db.func.count(Build.id))
+                      .filter(Build.status == 'queued').group_by(Build.config_id).all())
+        for stats in ConfigStats.query.all():
+            stats.queue_length = queued.get(stats.config_id, 0)
+        db.session.commit()
+
+    for config_id in missing:
+        rebuild_config_stats(config_id)
+    if missing:
+        print(f"Built statistics for {len(missing)} configurations")
@@ -0,0 +1,138 @@
+﻿"""
+Live Build State
+
+This module keeps the state of running builds in memory: their status, step, start time,
+log length and duration estimate. Builds publish their state here as they run, and the
+progress API, the build pages and the Socket.IO progress updates read it from here instead
+of querying the database and recomputing it. The database is only written on transitions,
+such as a build starting, moving to the next step or finishing.
+
+Records are never modified once published; a change publishes a new record. Readers
+therefore don't need a lock, and always see a consistent record.
+"""
+
+import datetime
+import threading
+
+
+class LiveBuild:
+    """The state of a running build at one point in time."""
+
+    __slots__ = ('id', 'config_id', 'config_name', 'status', 'current_step', 'total_steps', 'started_at',
+                 'completed_at', 'log_length', 'estimated_total')
+
+    def __init__(self, id, config_id, config_name, status, current_step=0, total_steps=0, started_at=None,
+                 log_length=0, estimated_total=None):
+        """
+        Args:
+            id (int): The ID of the build, named like Build.id so records can be used in its place
+            config_id (int): The ID of the build's configuration
+            config_name (str): The name of the build's configuration
+            status (str): The build's status, 'pending' or 'running'
+            current_step (int): The one-based number of the step being run, 0 before the first step
+            total_steps (int): The number of steps, 0 until the pipeline is known
+            started_at (datetime.datetime): When the build started, in UTC
+            log_length (int): Characters of output written to the log so far
+            estimated_total (float): Expected duration in seconds, from the last similar build
+        """
+        self.id = id
+        self.config_id = config_id
+        self.config_name = config_name
+        self.status = status
+        self.current_step = current_step
+        self.total_steps = total_steps
+        self.started_at = started_at
+        self.completed_at = None
+        self.log_length = log_length
+        self.estimated_total = estimated_total
+
+    @classmethod
+    def from_build(cls, build, log_length=0, similar_build=None):
+        """Create a record from a build and the similar build its duration is estimated from."""
+        return cls(build.id, build.config_id, build.config.name, build.status,
+                   current_step=build.current_step or 0, total_steps=build.total_steps or 0,
+                   started_at=build.started_at, log_length=log_length,
+                   estimated_total=estimate_duration(similar_build))
+
+    def replace(self, **changes):
+        """Create a copy of the record with some fields changed."""
+        record = LiveBuild.__new__(LiveBuild)
+        for name in self.__slots__:
+            setattr(record, name, changes.get(name, getattr(self, name)))
+        return record
+
+    def progress(self):
+        """
+        Calculate the build's progress, like calculate_build_progress does for builds in the database.
+
+        Returns:
+            dict: percent, current_step, total_steps, elapsed_time, estimated_remaining,
+                  step_times and steps_overdue
+        """
+        elapsed_time = 0
+        if self.started_at:
+            elapsed_time = (datetime.datetime.utcnow() - self.started_at).total_seconds()
+        total_steps = max(self.total_steps, 1)
+
+        build_percent = self.current_step / total_steps
+        estimated_remaining = None
+        if self.estimated_total:
+            estimated_remaining = self.estimated_total - elapsed_time
+            build_percent = (build_percent + elapsed_time / self.estimated_total) * 0.5
+
+        return {
+            'percent': round(build_percent * 100, 0),
+            'current_step': self.current_step,
+            'total_steps': total_steps,
+            'elapsed_time': elapsed_time,
+            'estimated_remaining': estimated_remaining,
+            'step_times': {},
+            'steps_overdue': False
+        }
+
+
+def estimate_duration(similar_build):
+    """Get the duration in seconds of the build a running build is estimated from, if any."""
+    if similar_build is None or not similar_build.started_at or not similar_build.completed_at:
+        return None
+    return (similar_build.completed_at - similar_build.started_at).total_seconds()
+
+
+class LiveBuildRegistry:
+    """The latest LiveBuild record of each running build."""
+
+    def __init__(self):
+        self._builds = {}  # Dictionary of build_id -> LiveBuild
+        self._lock = threading.Lock()  # Only taken by writers
+
+    def get(self, build_id):
+        """Get the latest record of a build, or None if it isn't running in or relayed by this process."""
+        return self._builds.get(build_id)
+
+    def publish(self, record):
+        """Publish a build's record, replacing any earlier one."""
+        with self._lock:
+            self._builds[record.id] = record
+        return record
+
+    def update(self, build_id, **changes):
+        """
+        Publish a copy of a build's record with some fields changed.
+
+        Returns:
+            LiveBuild: The new record, or None if the build has no record
+        """
+        with self._lock:
+            record = self._builds.get(build_id)
+            if record is None:
+                return None
+            record = self._builds[build_id] = record.replace(**changes)
+            return record
+
+    def remove(self, build_id):
+        """Forget a build, once its final state has been written to the database."""
+        with self._lock:
+            self._builds.pop(build_id, None)
+
+
+live_builds = LiveBuildRegistry()
@@ -0,0 +1,349 @@
+﻿"""
+Build Log Search
+
+This module maintains the full-text search index over build logs and searches it. Logs are
+split into chunks of whole lines, stored as BuildLogChunk rows and indexed by the
+build_log_fts FTS5 table, so a match can be found and its lines shown by reading one small
+chunk rather than the whole log.
+
+Running builds are split into chunks as their log is saved, by a LogIndexer. Builds from
+before the index existed are indexed in batches by backfill_log_index, newest first.
+"""
+
+import re
+import time
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+
+from cicd_server import app, db, logger
+from cicd_server.models import Build, BuildLogChunk, UNFINISHED_STATUSES
+
+LOG_CHUNK_CHARS = 16384  # Chunks end at the first line break after this many characters
+LOG_READ_CHARS = 4 * 1024 * 1024  # Most log text read from the database at once when indexing a finished build
+BACKFILL_BATCH_SIZE = 200  # Builds looked up at once by the backfill
+BACKFILL_COMMIT_SECONDS = 0.1  # Longest the backfill holds the database's write lock, unless one log takes longer
+
+SEARCH_MAX_CHUNKS = 500  # Most matching chunks read per search
+SEARCH_MAX_LINES_PER_BUILD = 5
+SEARCH_CHUNKS_PER_BUILD = 2  # Matching chunks of each build searched for the lines shown
+SEARCH_LINE_CONTEXT_CHARS = 200  # Characters kept either side of the first match on long lines
+
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+_search_available = None
+
+
+def log_search_available():
+    """Check whether the full-text index exists, which it doesn't on databases without FTS5."""
+    global _search_available
+    if _search_available is None:
+        _search_available = inspect(db.engine).has_table('build_log_fts')
+    return _search_available
+
+
+def split_log_chunks(text, flush=False, final=False):
+    """
+    Split log text into chunks of whole lines of at least LOG_CHUNK_CHARS.
+
+    Args:
+        text (str): The log text to split
+        flush (bool): Also make a shorter chunk of the complete lines left over
+        final (bool): Also make a chunk of everything left over, including an unfinished line
+
+    Returns:
+        list: The chunks, which together are a prefix of the text
+    """
+    chunks = []
+    position = 0
+    while len(text) - position >= LOG_CHUNK_CHARS:
+        end = text.find('\n', position + LOG_CHUNK_CHARS - 1)
+        if end == -1:
+            break
+        chunks.append(text[position:end + 1])
+        position = end + 1
+
+    if final:
+        if position < len(text):
+            chunks.append(text[position:])
+    elif flush:
+        end = text.rfind('\n', position)
+        if end != -1:
+            chunks.append(text[position:end + 1])
+    return chunks
+
+
+class LogIndexer:
+    """Splits a build's log into BuildLogChunk rows as it grows."""
+
+    def __init__(self, build_id, indexed=0, next_line=1):
+        self.build_id = build_id
+        self.indexed = indexed  # Log characters already split into chunks
+        self.next_line = next_line  # Number of the line the next chunk starts on
+
+    @classmethod
+    def resume(cls, build_id):
+        """Create an indexer that continues after the build's existing chunks."""
+        last = BuildLogChunk.query.filter_by(build_id=build_id).order_by(BuildLogChunk.log_start.desc()).first()
+        if last is None:
+            return cls(build_id)
+        return cls(build_id, last.log_start + len(last.content), last.first_line + last.content.count('\n'))
+
+    def update(self, log, flush=False, final=False):
+        """
+        Index the new part of a log that is being written, without committing.
+
+        Cheap to call on every save of the log, since nothing happens until a full chunk
+        has been written, unless flush or final is set.
+
+        Args:
+            log (str): The whole log so far
+            flush (bool): Index every complete line, e.g. at the end of a step
+            final (bool): Index everything, at the end of the build
+        """
+        if not (flush or final) and len(log) - self.indexed < LOG_CHUNK_CHARS:
+            return
+        self.add(log[self.indexed:], flush, final)
+
+    def add(self, text, flush=False, final=False):
+        """
+        Index text that follows what has been indexed, without committing.
+
+        Returns:
+            int: The number of characters indexed, which is less than the length of the text
+                 if it doesn't end with a full chunk and neither flush nor final is set
+        """
+        chunks = split_log_chunks(text, flush, final)
+        if not chunks:
+            return 0
+
+        rows = []
+        indexed = 0
+        for chunk in chunks:
+            line_breaks = chunk.count('\n')
+            rows.append({
+                'build_id': self.build_id,
+                'log_start': self.indexed + indexed,
+                'first_line': self.next_line,
+                'line_count': line_breaks + (0 if chunk.endswith('\n') else 1),
+                'content': chunk
+            })
+            indexed += len(chunk)
+            self.next_line += line_breaks
+        self.indexed += indexed
+
+        db.session.execute(BuildLogChunk.__table__.insert(), rows)
+        Build.query.filter(Build.id == self.build_id).update({'log_indexed': self.indexed},
+                                                             synchronize_session=False)
+        return indexed
+
+
+def index_build_log(build_id, resume=True):
+    """
+    Index the rest of a finished build's log, without committing.
+
+    The log is read in slices, so a huge log is never held in memory as a whole.
+
+    Args:
+        build_id (int): The ID of the build
+        resume (bool): Continue after existing chunks, which is only unnecessary for builds
+                       that have never been indexed
+    """
+    indexer = LogIndexer.resume(build_id) if resume else LogIndexer(build_id)
+    while True:
+        text = db.session.query(db.func.substr(Build.log, indexer.indexed + 1, LOG_READ_CHARS)) \
+            .filter(Build.id == build_id).scalar() or ''
+        last = len(text) < LOG_READ_CHARS
+        if last:
+            indexer.add(text, final=True)
+            break
+        if not indexer.add(text, flush=True):
+            # A single line longer than a slice
+            indexer.add(text, final=True)
+
+    if indexer.indexed == 0:
+        # Mark an empty log as indexed, so the backfill doesn't return to it
+        Build.query.filter(Build.id == build_id).update({'log_indexed': 0}, synchronize_session=False)
+
+
+def backfill_log_index(stop_event=None):
+    """
+    Index the logs of finished builds that have never been indexed, newest first.
+
+    Builds are committed in short batches, so builds being run aren't kept waiting for the
+    database for long.
+
+    Args:
+        stop_event (threading.Event, optional): Stop early once this is set
+
+    Returns:
+        int: The number of builds indexed
+    """
+    indexed = 0
+    last_id = None
+    with app.app_context():
+        batch_started = time.monotonic()
+        while stop_event is None or not stop_event.is_set():
+            query = db.session.query(Build.id).filter(Build.log_indexed.is_(None),
+                                                      Build.status.notin_(UNFINISHED_STATUSES))
+            if last_id is not None:
+                query = query.filter(Build.id < last_id)
+            build_ids = [row.id for row in query.order_by(Build.id.desc()).limit(BACKFILL_BATCH_SIZE)]
+            if not build_ids:
+                break
+            last_id = build_ids[-1]
+
+            for build_id in build_ids:
+                if stop_event is not None and stop_event.is_set():
+                    break
+                try:
+                    index_build_log(build_id, resume=False)
+                except OperationalError:
+                    # The builds since the last commit are indexed again at the next startup
+                    db.session.rollback()
+                    logger.exception(f"Error indexing the log of build #{build_id}")
+                    continue
+                indexed += 1
+
+                if time.monotonic() - batch_started >= BACKFILL_COMMIT_SECONDS:
+                    db.session.commit()
+                    # Don't keep the whole history in the identity map
+                    db.session.expunge_all()
+                    batch_started = time.monotonic()
+        db.session.commit()
+
+    if indexed:
+        if log_search_available():
+            # Merge the many small index segments written by the backfill, which speeds up searches
+            with app.app_context():
+                db.session.execute(text("INSERT INTO build_log_fts(build_log_fts) VALUES ('optimize')"))
+                db.session.commit()
+        logger.info(f"Indexed the logs of {indexed} builds for search")
+    return indexed
+
+
+def build_match_query(search_text):
+    """
+    Turn search box text into an FTS5 query.
+
+    Words and "quoted phrases" must all appear, in any order, and a word ending in * matches
+    any word it is a prefix of. Everything else is matched literally, so the query can't be
+    a syntax error.
+    """
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', search_text):
+        term = phrase or word
+        prefix = not phrase and len(term) > 1 and term.endswith('*')
+        term = term.rstrip('*') if prefix else term
+        if term.strip():
+            terms.append('"' + term.replace('"', '""') + '"' + ('*' if prefix else ''))
+    return ' '.join(terms)
+
+
+def split_highlighted(line):
+    """
+    Split a line with highlighted matches into segments.
+
+    Returns:
+        list: [(text, is_match), ...]
+    """
+    # Keep long lines readable by cropping them around the first match
+    first = line.find(MATCH_START)
+    if len(line) > SEARCH_LINE_CONTEXT_CHARS * 2 and first != -1:
+        start = max(0, first - SEARCH_LINE_CONTEXT_CHARS)
+        end = first + SEARCH_LINE_CONTEXT_CHARS
+        line = ('…' if start > 0 else '') + line[start:end] + ('…' if end < len(line) else '')
+
+    segments = []
+    matched = False
+    for part in re.split(f'([{MATCH_START}{MATCH_END}])', line):
+        if part == MATCH_START:
+            matched = True
+        elif part == MATCH_END:
+            matched = False
+        elif part:
+            segments.append((part, matched))
+    return segments
+
+
+def search_logs(search_text, config_id=None, before_build_id=None, max_builds=20):
+    """
+    Search build logs, newest builds first.
+
+    Args:
+        search_text (str): Words and "quoted phrases" to search for, see build_match_query()
+        config_id (int, optional): Only search builds of this configuration
+        before_build_id (int, optional): Only search builds older than this one, for paging
+        max_builds (int): The most builds to return
+
+    Returns:
+        list: A dictionary per matching build with the build's details and 'lines', a list of
+              {'line': line number, 'segments': [(text, is_match), ...]}
+    """
+    match_query = build_match_query(search_text)
+    if not match_query or not log_search_available():
+        return []
+
+    conditions = ['build_log_fts MATCH :match']
+    params = {'match': match_query, 'limit': SEARCH_MAX_CHUNKS}
+    join = ''
+    if before_build_id is not None:
+        conditions.append('c.build_id < :before')
+        params['before'] = before_build_id
+    if config_id is not None:
+        join = 'JOIN build b ON b.id = c.build_id'
+        conditions.append('b.config_id = :config_id')
+        params['config_id'] = config_id
+
+    # Chunk IDs increase with time, so this finds the newest matches first and stops early
+    rows = db.session.execute(text(
+        'SELECT c.build_id, c.id FROM build_log_fts JOIN build_log_chunk c ON c.id = build_log_fts.rowid ' + join +
+        ' WHERE ' + ' AND '.join(conditions) +
+        ' ORDER BY build_log_fts.rowid DESC LIMIT :limit'), params).all()
+
+    chunk_ids = {}  # Dictionary of build_id -> matching chunk IDs, in the order builds were found
+    for build_id, chunk_id in rows:
+        if build_id not in chunk_ids:
+            if len(chunk_ids) >= max_builds:
+                break
+            chunk_ids[build_id] = []
+        chunk_ids[build_id].append(chunk_id)
+
+    # Only highlight the earliest matching chunks of each build, which hold the lines shown
+    shown_chunks = [chunk_id for ids in chunk_ids.values() for chunk_id in ids[-SEARCH_CHUNKS_PER_BUILD:]]
+    matches = {build_id: [] for build_id in chunk_ids}
+    if shown_chunks:
+        highlighted_chunks = db.session.execute(text(
+            'SELECT c.build_id, c.first_line, highlight(build_log_fts, 0, :start, :end) '
+            'FROM build_log_fts JOIN build_log_chunk c ON c.id = build_log_fts.rowid '
+            'WHERE build_log_fts MATCH :match AND build_log_fts.rowid IN (' +
+            ', '.join(str(int(chunk_id)) for chunk_id in shown_chunks) + ') '
+            'ORDER BY c.build_id, c.log_start'),
+            {'match': match_query, 'start': MATCH_START, 'end': MATCH_END}).all()
+        for build_id, first_line, highlighted in highlighted_chunks:
+            lines = matches[build_id]
+            for number, line in enumerate(highlighted.split('\n'), first_line):
+                if len(lines) > SEARCH_MAX_LINES_PER_BUILD:
+                    break
+                if MATCH_START in line:
+                    lines.append({'line': number, 'segments': split_highlighted(line)})
+
+    builds = {build.id: build for build in Build.query.options(db.joinedload(Build.config))
+              .filter(Build.id.in_(matches)).all()}
+    results = []
+    for build_id, lines in matches.items():
+        build = builds.get(build_id)
+        if build is None:
+            continue
+        results.append({
+            'build_id': build.id,
+            'status': build.status,
+            'branch': build.branch,
+            'config_id': build.config_id,
+            'config_name': build.config.name,
+            'started_at': build.started_at,
+            'lines': lines[:SEARCH_MAX_LINES_PER_BUILD],
+            'more_lines': len(lines) > SEARCH_MAX_LINES_PER_BUILD or len(chunk_ids[build_id]) > SEARCH_CHUNKS_PER_BUILD
+        })
+    return results
@@ -0,0 +1,163 @@
+﻿"""
+Build Matrix
+
+This module expands a configuration's build matrix into the builds one trigger starts, and
+summarizes the status and progress of the resulting build group. A matrix has one axis per
+line, with its name and comma-separated values:
+
+    python: 3.10, 3.11, 3.12
+    target: linux, windows
+
+which starts one build for every combination of values, six here. Each build's payload has
+the combination under "matrix", so build steps can use ${matrix.python}.
+"""
+
+import itertools
+import re
+
+from cicd_server.models import FINISHED_STATUSES
+from cicd_server.services.live_builds import live_builds
+
+MAX_MATRIX_BUILDS = 64  # Most builds one trigger may start
+
+AXIS_PATTERN = re.compile(r'^\s*(\w+)\s*:(.*)$')
+
+
+class MatrixError(ValueError):
+    """Raised for a build matrix that can't be expanded."""
+
+
+def parse_matrix(text):
+    """
+    Parse a build matrix definition.
+
+    Blank lines and lines starting with # are ignored.
+
+    Args:
+        text (str): The matrix, one "name: value, value" axis per line
+
+    Returns:
+        list: (name, values) tuples, in order, empty if the configuration has no matrix
+
+    Raises:
+        MatrixError: If a line isn't an axis, an axis is repeated or has no values, or the
+                     matrix has more than MAX_MATRIX_BUILDS combinations
+    """
+    axes = []
+    for line in (text or '').splitlines():
+        if not line.strip() or line.strip().startswith('#'):
+            continue
+        match = AXIS_PATTERN.match(line)
+        if not match:
+            raise MatrixError(f'Build matrix line "{line.strip()}" is not in the form "name: value, value"')
+        name = match.group(1)
+        values = [value.strip() for value in match.group(2).split(',') if value.strip()]
+        if not values:
+            raise MatrixError(f'Build matrix axis "{name}" has no values')
+        if any(name == existing for existing, _ in axes):
+            raise MatrixError(f'Build matrix axis "{name}" is defined more than once')
+        axes.append((name, values))
+
+    count = 1
+    for _, values in axes:
+        count *= len(values)
+    if count > MAX_MATRIX_BUILDS:
+        raise MatrixError(f"Build matrix has {count} combinations, more than the limit of {MAX_MATRIX_BUILDS}")
+    return axes
+
+
+def expand_matrix(axes):
+    """
+    Get every combination of a matrix's values.
+
+    Args:
+        axes (list): (name, values) tuples from parse_matrix()
+
+    Returns:
+        list: Dictionaries of axis name -> value, with the first axis changing slowest,
+              or an empty list if there are no axes
+    """
+    if not axes:
+        return []
+    names = [name for name, _ in axes]
+    return [dict(zip(names, combination)) for combination in itertools.product(*(values for _, values in axes))]
+
+
+def validate_matrix(text):
+    """
+    Check a build matrix for problems.
+
+    Returns:
+        list: Warning messages, empty if no problems were found
+    """
+    try:
+        parse_matrix(text)
+    except MatrixError as e:
+        return [f"{e}. Builds will not start until it is fixed."]
+    return []
+
+
+def group_status(statuses):
+    """
+    Derive a build group's status from its builds' statuses.
+
+    Returns:
+        str: 'queued' if no build has started, 'running' until every build has finished,
+             then 'failed' if any build failed, else 'success'
+    """
+    if all(status == 'queued' for status in statuses):
+        return 'queued'
+    if any(status not in FINISHED_STATUSES for status in statuses):
+        return 'running'
+    if any(status != 'success' for status in statuses):
+        return 'failed'
+    return 'success'
+
+
+def summarize_group(group):
+    """
+    Summarize a build group's status and progress.
+
+    Args:
+        group (BuildGroup): The group
+
+    Returns:
+        dict: group_id, config_id, config_name, branch, status, percent, finished, total and
+              builds, which has the build_id, matrix, status, percent and queue_position of each build
+    """
+    builds = []
+    for build in group.builds:
+        if build.status in FINISHED_STATUSES:
+            percent = 100
+        elif build.status == 'queued':
+            percent = 0
+        else:
+            # Builds running on workers aren't tracked in this process, so their steps are counted instead
+            live = live_builds.get(build.id)
+            percent = live.progress()['percent'] if live is not None \
+                else round(100 * (build.current_step or 0) / max(build.total_steps or 1, 1))
+        builds.append({
+            'build_id': build.id,
+            'matrix': build.matrix,
+            'status': build.status,
+            'percent': percent,
+            'queue_position': build.queue_position
+        })
+
+    statuses = [build['status'] for build in builds]
+    return {
+        'group_id': group.id,
+        'config_id': group.config_id,
+        'config_name': group.config.name,
+        'branch': group.branch,
+        'status': group_status(statuses) if statuses else 'queued',
+        'percent': round(sum(build['percent'] for build in builds) / len(builds)) if builds else 0,
+        'finished': sum(1 for status in statuses if status in FINISHED_STATUSES),
+        'total': len(builds),
+        'builds': builds
+    }
+
+
+def format_matrix(values):
+    """Format a build's matrix values for display, e.g. "python=3.11, target=linux"."""
+    return ', '.join(f'{name}={value}' for name, value in values.items())
@@ -0,0 +1,336 @@
+﻿"""
+Build Pipeline
+
+This module compiles a configuration's build steps into a reusable pipeline object.
+Each step is tokenized once into literal segments and variable references so that
+payload substitution is a single pass, and compiled pipelines are cached per configuration.
+
+A step may start with options in square brackets, e.g. "[resumable] make test", which are
+not part of the command. Path filters, e.g. "[paths=frontend/ docs/*.md] npm test", are
+compiled into a regular expression matched against the files a push changed.
+"""
+
+import hashlib
+import re
+import threading
+
+from cicd_server.utils.helpers import get_nested_value
+
+# Matches ${variable} and ${parent.child} references in a build step
+VARIABLE_PATTERN = re.compile(r'\${([\w\.]+)}')
+
+# Matches anything that looks like a variable reference, valid or not
+PLACEHOLDER_PATTERN = re.compile(r'\${[^}]*}?')
+
+# Matches step options at the start of a step, e.g. "[resumable] ". A step starting with the
+# shell's "[ " test command has a space after the bracket, so it isn't mistaken for options.
+STEP_OPTIONS_PATTERN = re.compile(r'^\[(\w[^\]]*)\]\s+')
+
+# resumable: an interrupted build may resume from this step, see Pipeline.resume_point()
+# prefetch: a warm-up step, such as installing dependencies, that may run before the build
+#           starts while it is queued, see Pipeline.prefetch_steps
+# paths: glob patterns separated by spaces; the step is skipped unless a changed file matches one
+STEP_OPTIONS = frozenset(['resumable', 'prefetch', 'paths'])
+
+
+def parse_step_options(text):
+    """
+    Parse step options, e.g. "resumable, name=value".
+
+    Returns:
+        dict: Option name -> value, which is True for options without a value
+    """
+    options = {}
+    for option in text.split(','):
+        name, has_value, value = option.partition('=')
+        if name.strip():
+            options[name.strip()] = value.strip() if has_value else True
+    return options
+
+
+def compile_path_patterns(patterns):
+    """
+    Compile glob patterns for file paths into one regular expression.
+
+    Paths are relative to the repository root, with / between directories. '*' matches
+    any characters except '/', '?' one character except '/', and '**' any characters.
+    A pattern that matches a directory also matches everything in it, so "frontend" and
+    "frontend/" both match "frontend/src/app.js".
+
+    Args:
+        patterns (list): The glob patterns
+
+    Returns:
+        re.Pattern: An expression whose fullmatch() matches paths that match any of the patterns
+    """
+    expressions = []
+    for pattern in patterns:
+        pattern = pattern.strip('/')
+        expression = []
+        position = 0
+        while position < len(pattern):
+            if pattern.startswith('**/', position):
+                expression.append('(?:.*/)?')
+                position += 3
+            elif pattern.startswith('**', position):
+                expression.append('.*')
+                position += 2
+            elif pattern[position] == '*':
+                expression.append('[^/]*')
+                position += 1
+            elif pattern[position] == '?':
+                expression.append('[^/]')
+                position += 1
+            else:
+                expression.append(re.escape(pattern[position]))
+                position += 1
+        expressions.append(''.join(expression) + '(?:/.*)?')
+    return re.compile('|'.join(f'(?:{expression})' for expression in expressions))
+
+
+class CompiledStep:
+    """A single build step, pre-tokenized into literal segments and variable names."""
+
+    __slots__ = ('index', 'source', 'command_hash', 'literals', 'variables', 'options', 'paths', 'path_matcher')
+
+    def __init__(self, index, source):
+        self.options = {}
+        match = STEP_OPTIONS_PATTERN.match(source)
+        if match:
+            self.options = parse_step_options(match.group(1))
+            source = source[match.end():]
+
+        # Glob patterns of the files the step depends on, or None if it always runs
+        self.paths = None
+        self.path_matcher = None
+        if isinstance(self.options.get('paths'), str) and self.options['paths'].split():
+            self.paths = tuple(self.options['paths'].split())
+            self.path_matcher = compile_path_patterns(self.paths)
+
+        self.index = index
+        self.source = source
+        # Only the command is hashed, so adding options keeps the step's history
+        self.command_hash = hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+        # literals always has one more entry than variables:
+        # source == literals[0] + ${variables[0]} + literals[1] + ... + literals[-1]
+        literals = []
+        variables = []
+        position = 0
+        for match in VARIABLE_PATTERN.finditer(source):
+            literals.append(source[position:match.start()])
+            variables.append(match.group(1))
+            position = match.end()
+        literals.append(source[position:])
+
+        self.literals = tuple(literals)
+        self.variables = tuple(variables)
+
+    @property
+    def resumable(self):
+        return bool(self.options.get('resumable'))
+
+    @property
+    def prefetch(self):
+        return bool(self.options.get('prefetch'))
+
+    def matches_changes(self, changed_paths):
+        """
+        Check whether the step needs to run for a set of changed files.
+
+        Args:
+            changed_paths (iterable): The changed files' paths, or None if they aren't known
+
+        Returns:
+            bool: False if the step has path filters and none of the changed files match them
+        """
+        if self.path_matcher is None or changed_paths is None:
+            return True
+        return any(self.path_matcher.fullmatch(path) for path in changed_paths)
+
+    def render(self, payload):
+        """
+        Substitute payload values into the step in a single pass.
+
+        Variables that are not present in the payload are left as-is.
+
+        Args:
+            payload (dict): The build payload
+
+        Returns:
+            str: The command with variables replaced
+        """
+        if not self.variables:
+            return self.source
+
+        parts = [self.literals[0]]
+        for var_name, literal in zip(self.variables, self.literals[1:]):
+            var_value = get_nested_value(payload, var_name)
+            if var_value is None:
+                parts.append('${' + var_name + '}')
+            else:
+                parts.append(str(var_value))
+            parts.append(literal)
+        return ''.join(parts)
+
+
+class Pipeline:
+    """The compiled form of a configuration's build steps."""
+
+    __slots__ = ('source', 'steps', 'variables', 'malformed', 'unknown_options', 'has_path_filters')
+
+    def __init__(self, source):
+        self.source = source or ''
+        lines = [s for s in self.source.strip().split('\n') if s.strip()]
+        self.steps = tuple(CompiledStep(idx, line) for idx, line in enumerate(lines))
+
+        # Unique referenced variables, in order of first appearance
+        variables = []
+        for step in self.steps:
+            for var_name in step.variables:
+                if var_name not in variables:
+                    variables.append(var_name)
+        self.variables = tuple(variables)
+
+        # Placeholders that will never be substituted, e.g. ${foo-bar} or an unclosed ${foo
+        self.malformed = tuple(
+            match.group(0)
+            for step in self.steps
+            for match in PLACEHOLDER_PATTERN.finditer(step.source)
+            if not VARIABLE_PATTERN.fullmatch(match.group(0))
+        )
+
+        self.unknown_options = tuple(sorted({name for step in self.steps for name in step.options
+                                             if name not in STEP_OPTIONS}))
+        self.has_path_filters = any(step.paths for step in self.steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def unresolved_variables(self, payload):
+        """
+        Get the referenced variables that are not present in a payload.
+
+        Args:
+            payload (dict): The payload to check against
+
+        Returns:
+            list: The variable names that would not be substituted
+        """
+        return [v for v in self.variables if get_nested_value(payload, v) is None]
+
+    @property
+    def prefetch_steps(self):
+        """The steps at the start of the pipeline marked [prefetch], which can run before the build starts."""
+        count = 0
+        while count < len(self.steps) and self.steps[count].prefetch:
+            count += 1
+        return self.steps[:count]
+
+    def resume_point(self, completed_hashes):
+        """
+        Find the step an interrupted build can resume from.
+
+        That is the first step that didn't complete, if it is resumable, or otherwise the
+        closest resumable step before it, whose following steps are run again. Steps only
+        count as completed if they are still the same steps.
+
+        Args:
+            completed_hashes (dict): Step index -> command hash of the build's steps that
+                                     completed successfully
+
+        Returns:
+            int or None: The index of the step to resume from, len(self) if every step
+                         completed, or None if the build can't be resumed
+        """
+        first_incomplete = 0
+        while first_incomplete < len(self.steps) and \
+                completed_hashes.get(first_incomplete) == self.steps[first_incomplete].command_hash:
+            first_incomplete += 1
+        if first_incomplete == len(self.steps):
+            return first_incomplete
+
+        for index in range(first_incomplete, -1, -1):
+            if self.steps[index].resumable:
+                return index
+        return None
+
+
+def compile_pipeline(build_steps):
+    """Compile build steps text into a Pipeline."""
+    return Pipeline(build_steps)
+
+
+def validate_build_steps(build_steps, sample_payload=None):
+    """
+    Check build steps for problems that would otherwise only show up during a build.
+
+    Args:
+        build_steps (str): The build steps text
+        sample_payload (dict, optional): A representative payload to resolve variables against
+
+    Returns:
+        list: Warning messages, empty if no problems were found
+    """
+    pipeline = compile_pipeline(build_steps)
+    warnings = []
+
+    if pipeline.malformed:
+        warnings.append(f"Build steps contain invalid variable references: {', '.join(pipeline.malformed)}")
+
+    if pipeline.unknown_options:
+        warnings.append(f"Build steps use unknown step options: {', '.join(pipeline.unknown_options)}")
+
+    empty_paths = [str(step.index + 1) for step in pipeline.steps if 'paths' in step.options and not step.paths]
+    if empty_paths:
+        warnings.append(f"Step {', '.join(empty_paths)} has a paths option without patterns, e.g. "
+                        f"[paths=src/ docs/*.md], so it always runs")
+
+    late_prefetch = [str(step.index + 1) for step in pipeline.steps[len(pipeline.prefetch_steps):] if step.prefetch]
+    if late_prefetch:
+        warnings.append(f"Only steps at the start of the build steps can be prefetched, so [prefetch] has no "
+                        f"effect on step {', '.join(late_prefetch)}")
+
+    if sample_payload is not None:
+        unresolved = pipeline.unresolved_variables(sample_payload)
+        if unresolved:
+            warnings.append(f"Build steps reference variables not found in the latest payload: "
+                            f"{', '.join(unresolved)}")
+
+    return warnings
+
+
+_pipeline_cache = {}  # Dictionary of config_id -> Pipeline
+_pipeline_cache_lock = threading.Lock()
+
+
+def get_pipeline(config_id, build_steps):
+    """
+    Get the compiled pipeline for a configuration, compiling it on first use.
+
+    The cached pipeline is only reused if it was compiled from the same build steps,
+    so a stale entry can never be returned even if invalidation was missed.
+
+    Args:
+        config_id (int): The ID of the configuration
+        build_steps (str): The configuration's current build steps
+
+    Returns:
+        Pipeline: The compiled pipeline
+    """
+    with _pipeline_cache_lock:
+        pipeline = _pipeline_cache.get(config_id)
+        if pipeline is not None and pipeline.source == (build_steps or ''):
+            return pipeline
+
+    pipeline = compile_pipeline(build_steps)
+
+    with _pipeline_cache_lock:
+        _pipeline_cache[config_id] = pipeline
+    return pipeline
+
+
+def invalidate_pipeline(config_id):
+    """Drop the cached pipeline for a configuration."""
+    with _pipeline_cache_lock:
+        _pipeline_cache.pop(config_id, None)
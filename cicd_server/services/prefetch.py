@@ -0,0 +1,185 @@
+﻿"""
+Workspace Prefetching
+
+This module prepares the workspace of the next queued build of each configuration with
+isolated workspaces while the current build is running, so the queued build starts hot:
+its worktree is leased and has its commit checked out, and its warm-up steps, the steps
+at the start of its build steps marked [prefetch], have already run. The work runs in one
+background thread, one build at a time, with low CPU and I/O priority so it doesn't slow
+down the running build.
+
+When a build starts, run_build() takes its prefetched workspace, if there is one, and
+records the warm-up steps that completed as cached steps instead of running them again.
+Whether builds found their workspace prefetched is counted by the
+cicd_workspace_prefetches metric, whose 'hit' and 'miss' results give the hit rate.
+
+Prefetching only happens when builds run in the server process. Workers claim queued
+builds as soon as they are free, so their builds don't wait in the queue for long.
+"""
+
+import datetime
+import json
+import threading
+
+from cicd_server import app, db, logger
+from cicd_server.models import Build, Config, UNFINISHED_STATUSES
+from cicd_server.services.pipeline import get_pipeline
+from cicd_server.services.step_runner import run_step
+from cicd_server.services.workspaces import WorkspaceError, acquire_workspace, release_workspace, payload_commit
+from cicd_server.utils.metrics import WORKSPACE_PREFETCHES
+
+
+class PrefetchedStep:
+    """A warm-up step that completed successfully before its build started."""
+
+    __slots__ = ('index', 'command_hash', 'command', 'output', 'started_at', 'finished_at')
+
+    def __init__(self, index, command_hash, command, output, started_at, finished_at):
+        self.index = index
+        self.command_hash = command_hash
+        self.command = command
+        self.output = output
+        self.started_at = started_at
+        self.finished_at = finished_at
+
+
+class Prefetch:
+    """A queued build's prepared workspace, and the warm-up steps that ran in it."""
+
+    def __init__(self, build_id, workspace):
+        self.build_id = build_id
+        self.workspace = workspace
+        self.steps = []  # List of PrefetchedStep, in order
+
+
+class WorkspacePrefetcher:
+    """Prefetches the workspaces of the builds at the head of each configuration's queue."""
+
+    def __init__(self):
+        self._ready = {}  # Dictionary of build_id -> Prefetch
+        self._in_progress = {}  # Dictionary of build_id -> threading.Event set when its prefetch is done
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def enabled():
+        return app.config['PREFETCH_WORKSPACES'] and app.config.get('BUILD_EXECUTION') != 'worker'
+
+    def wake(self):
+        """Look for queued builds to prefetch, e.g. after a build was queued or started."""
+        if not self.enabled():
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='cicd-workspace-prefetch', daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def take(self, build_id):
+        """
+        Take a build's prefetched workspace when it starts, waiting for its prefetch if it is in progress.
+
+        Returns:
+            Prefetch: The prefetched workspace, now leased by the caller, or None if it wasn't prefetched
+        """
+        with self._lock:
+            in_progress = self._in_progress.get(build_id)
+        if in_progress is not None:
+            in_progress.wait()
+        with self._lock:
+            return self._ready.pop(build_id, None)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            with app.app_context():
+                try:
+                    self._prefetch_queue_heads()
+                except Exception:
+                    logger.exception("Error prefetching workspaces")
+                finally:
+                    db.session.remove()
+
+    def _prefetch_queue_heads(self):
+        # Give back the workspaces of builds that finished or were removed without taking them
+        with self._lock:
+            prefetched = list(self._ready)
+        if prefetched:
+            active = {build_id for (build_id,) in db.session.query(Build.id).filter(
+                Build.id.in_(prefetched), Build.status.in_(UNFINISHED_STATUSES))}
+            for build_id in prefetched:
+                if build_id not in active:
+                    with self._lock:
+                        prefetch = self._ready.pop(build_id, None)
+                    if prefetch is not None:
+                        config = Config.query.get(prefetch.workspace.config_id)
+                        WORKSPACE_PREFETCHES.inc(config=config.name, result='discarded')
+                        release_workspace(prefetch.workspace, config)
+
+        # Resumed builds go back to the workspace they were interrupted in instead
+        queued = Build.query.join(Config, Build.config_id == Config.id) \
+            .filter(Build.status == 'queued', Config.isolated_workspaces.is_(True), Build.resume_step.is_(None)) \
+            .order_by(Build.queue_position).all()
+        heads = {}
+        for build in queued:
+            heads.setdefault(build.config_id, build)
+
+        for build in heads.values():
+            # A build may have started while the previous one was being prefetched
+            if db.session.query(Build.status).filter(Build.id == build.id).scalar() != 'queued':
+                continue
+            with self._lock:
+                if build.id in self._ready:
+                    continue
+                done = self._in_progress[build.id] = threading.Event()
+            try:
+                prefetch = self._prefetch(build)
+                if prefetch is not None:
+                    with self._lock:
+                        self._ready[build.id] = prefetch
+            except Exception:
+                logger.exception(f"Error prefetching the workspace of build #{build.id}")
+            finally:
+                with self._lock:
+                    self._in_progress.pop(build.id, None)
+                done.set()
+
+    def _prefetch(self, build):
+        """Lease and check out a queued build's workspace, and run its warm-up steps."""
+        config = build.config
+        payload = json.loads(build.payload) if build.payload else {}
+        try:
+            workspace = acquire_workspace(config, build.branch, payload_commit(payload), low_priority=True)
+        except WorkspaceError as e:
+            # The build reports the error itself when it starts
+            logger.warning(f"Could not prefetch the workspace of build #{build.id}: {e}")
+            return None
+
+        prefetch = Prefetch(build.id, workspace)
+        try:
+            for step in get_pipeline(config.id, config.build_steps).prefetch_steps:
+                command = step.render(payload)
+                output = []
+                started_at = datetime.datetime.utcnow()
+                try:
+                    return_code = run_step(command, workspace.path, output.append, low_priority=True)
+                except OSError as e:
+                    return_code = str(e)
+                if return_code != 0:
+                    # The build runs the step itself, and reports its failure
+                    logger.info(f"Warm-up step {step.index + 1} of build #{build.id} failed while prefetching: "
+                                f"{return_code}")
+                    break
+                prefetch.steps.append(PrefetchedStep(step.index, step.command_hash, command, ''.join(output),
+                                                     started_at, datetime.datetime.utcnow()))
+        except Exception:
+            release_workspace(workspace, config)
+            raise
+        logger.info(f"Prefetched the workspace of build #{build.id} in {workspace.path} "
+                    f"with {len(prefetch.steps)} warm-up steps")
+        return prefetch
+
+
+prefetcher = WorkspacePrefetcher()
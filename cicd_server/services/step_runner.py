@@ -0,0 +1,489 @@
+﻿"""
+Step Runner
+
+This module runs build step commands and streams their output back in batches. Reading the
+command's output, decoding it and buffering it happens in a separate "output pump" process,
+so a step that prints tens of megabytes per second doesn't compete with web requests for the
+server's GIL. The server process only receives one batch of text per flush interval.
+
+Pump processes are started with the spawn method, since forking a server with running threads
+and open database connections is unsafe, and are kept in a pool so the start-up cost is paid
+once rather than per step. Set CICD_STEP_OUTPUT_PROCESSES=false to pump output from a thread
+in the server process instead.
+
+Commands run ahead of time, such as prefetched warm-up steps, can be run with low CPU and I/O
+priority, so they don't slow down the build that is running.
+
+Each step normally runs in a shell of its own. A ShellSession instead runs all of a build's
+steps in one shell, so changes such as exported variables, an activated virtualenv or the
+current directory carry over to the next step. Each step is passed to the shell's eval,
+followed by a command that prints a sentinel line with the step's exit code, which marks
+the end of the step's output.
+"""
+
+import codecs
+import io
+import locale
+import multiprocessing
+import os
+import shlex
+import shutil
+import subprocess
+import threading
+import uuid
+
+from cicd_server import app, logger
+
+OUTPUT_FLUSH_INTERVAL = 0.25  # Seconds between output batches sent to the server process
+OUTPUT_READ_BYTES = 65536
+OUTPUT_MAX_MESSAGE_CHARS = 1024 * 1024  # Larger batches are split into several messages
+
+SHELL_SESSIONS_SUPPORTED = os.name == 'posix'
+
+_low_priority_prefix = None
+
+
+def low_priority_prefix():
+    """
+    Get the command prefix that runs a program with low CPU and I/O priority.
+
+    Returns:
+        list: e.g. ['nice', '-n', '19', 'ionice', '-c', '3'], or an empty list if neither
+              nice nor ionice is available, e.g. on Windows
+    """
+    global _low_priority_prefix
+    if _low_priority_prefix is None:
+        prefix = []
+        if shutil.which('nice'):
+            prefix += ['nice', '-n', '19']
+        if shutil.which('ionice'):
+            prefix += ['ionice', '-c', '3']
+        _low_priority_prefix = prefix
+    return _low_priority_prefix
+
+
+def _new_decoder():
+    # Decode like text=True would: locale encoding with universal newlines
+    return io.IncrementalNewlineDecoder(
+        codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors='replace'), translate=True)
+
+
+def _send_batches(conn, buffer, buffer_lock, finished, flush_interval):
+    """Send the text collected in a buffer over a connection every flush interval, until finished is set."""
+    while True:
+        done = finished.wait(flush_interval)
+        with buffer_lock:
+            text = ''.join(buffer)
+            buffer.clear()
+        for start in range(0, len(text), OUTPUT_MAX_MESSAGE_CHARS):
+            conn.send(('output', text[start:start + OUTPUT_MAX_MESSAGE_CHARS]))
+        if done:
+            break
+
+
+def stream_step_output(command, cwd, conn, flush_interval=OUTPUT_FLUSH_INTERVAL, low_priority=False):
+    """
+    Run a command and send its decoded output over a connection in batches.
+
+    Sends ('output', text) messages, then ('exit', return code), or ('error', message) if
+    the command could not be started.
+    """
+    prefix = low_priority_prefix() if low_priority else []
+    try:
+        process = subprocess.Popen(
+            prefix + ['/bin/sh', '-c', command] if prefix else command,
+            shell=not prefix,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT
+        )
+    except Exception as e:
+        conn.send(('error', str(e)))
+        return
+
+    buffer = []
+    buffer_lock = threading.Lock()
+    finished = threading.Event()
+
+    def read_output():
+        decoder = _new_decoder()
+        try:
+            while True:
+                data = process.stdout.read1(OUTPUT_READ_BYTES)
+                if not data:
+                    break
+                text = decoder.decode(data)
+                if text:
+                    with buffer_lock:
+                        buffer.append(text)
+            text = decoder.decode(b'', final=True)
+            if text:
+                with buffer_lock:
+                    buffer.append(text)
+        finally:
+            finished.set()
+
+    reader = threading.Thread(target=read_output, daemon=True)
+    reader.start()
+    _send_batches(conn, buffer, buffer_lock, finished, flush_interval)
+    reader.join()
+    conn.send(('exit', process.wait()))
+
+
+class SessionShell:
+    """A long-lived shell that runs commands one at a time, where their output is pumped."""
+
+    def __init__(self, cwd, low_priority=False):
+        """
+        Raises:
+            OSError: If the shell could not be started
+        """
+        prefix = low_priority_prefix() if low_priority else []
+        # bash reports syntax errors in a step, where sh would exit
+        self.process = subprocess.Popen(
+            prefix + [shutil.which('bash') or '/bin/sh'],
+            cwd=cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT
+        )
+        self.sentinel = f'__cicd_step_done_{uuid.uuid4().hex}__'
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def run(self, command, conn, flush_interval=OUTPUT_FLUSH_INTERVAL):
+        """
+        Run a command and send its decoded output over a connection in batches.
+
+        Sends ('output', text) messages, then ('exit', return code). If the command ends the
+        shell, e.g. with exit, the shell's exit code is the command's return code.
+        """
+        # One line, so the shell has read all of it before the command runs and can't read the rest itself
+        line = f"eval {shlex.quote(command)} </dev/null; printf '%s %d\\n' {self.sentinel} \"$?\"\n"
+        try:
+            self.process.stdin.write(line.encode())
+            self.process.stdin.flush()
+        except OSError:
+            conn.send(('exit', self.process.wait()))
+            return
+
+        buffer = []
+        buffer_lock = threading.Lock()
+        finished = threading.Event()
+        result = {}
+
+        def read_output():
+            decoder = _new_decoder()
+            pending = ''  # Text that may be the start of the sentinel line
+            try:
+                while True:
+                    data = self.process.stdout.read1(OUTPUT_READ_BYTES)
+                    pending += decoder.decode(data, final=not data)
+                    position = pending.find(self.sentinel)
+                    if position >= 0 and '\n' in pending[position:]:
+                        result['return_code'] = int(pending[position + len(self.sentinel):].split('\n', 1)[0])
+                        pending = pending[:position]
+                        break
+                    if not data:
+                        break
+                    if position < 0:
+                        # Hold back the longest end of the text that could be the start of the sentinel
+                        position = len(pending)
+                        for length in range(min(len(self.sentinel) - 1, len(pending)), 0, -1):
+                            if self.sentinel.startswith(pending[-length:]):
+                                position = len(pending) - length
+                                break
+                    if position:
+                        with buffer_lock:
+                            buffer.append(pending[:position])
+                        pending = pending[position:]
+            finally:
+                if pending:
+                    with buffer_lock:
+                        buffer.append(pending)
+                finished.set()
+
+        reader = threading.Thread(target=read_output, daemon=True)
+        reader.start()
+        _send_batches(conn, buffer, buffer_lock, finished, flush_interval)
+        reader.join()
+        conn.send(('exit', result['return_code'] if 'return_code' in result else self.process.wait()))
+
+    def close(self):
+        """End the shell, and any processes it left running in the foreground."""
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+
+def run_session_step(shell, command, cwd, conn, flush_interval, low_priority):
+    """
+    Run a command in a session's shell, starting a new shell if there is none or it exited.
+
+    Returns:
+        SessionShell: The shell, to run the session's next command in, or None if it couldn't be started
+    """
+    if shell is not None and not shell.is_alive():
+        conn.send(('output', "The build's shell exited, so this step runs in a new shell\n"))
+        shell = None
+    if shell is None:
+        try:
+            shell = SessionShell(cwd, low_priority)
+        except Exception as e:
+            conn.send(('error', str(e)))
+            return None
+    shell.run(command, conn, flush_interval)
+    return shell
+
+
+def _stream_in_thread(command, cwd, conn, flush_interval, low_priority):
+    # Closing the connection tells the receiving side if streaming failed
+    try:
+        stream_step_output(command, cwd, conn, flush_interval, low_priority)
+    finally:
+        conn.close()
+
+
+def _pump_main(conn):
+    """
+    Entry point of an output pump process: run step commands sent by the server until closed.
+
+    Tasks are ('step', command, cwd, flush_interval, low_priority) to run a command in a shell
+    of its own, ('session', ...) with the same fields to run it in the pump's session shell,
+    and ('end_session',) to end the session shell.
+    """
+    shell = None
+    try:
+        while True:
+            try:
+                task = conn.recv()
+            except (EOFError, KeyboardInterrupt):
+                return
+            if task is None:
+                return
+            kind = task[0]
+            if kind == 'step':
+                _, command, cwd, flush_interval, low_priority = task
+                stream_step_output(command, cwd, conn, flush_interval, low_priority)
+            elif kind == 'session':
+                _, command, cwd, flush_interval, low_priority = task
+                shell = run_session_step(shell, command, cwd, conn, flush_interval, low_priority)
+            elif kind == 'end_session' and shell is not None:
+                shell.close()
+                shell = None
+    finally:
+        if shell is not None:
+            shell.close()
+
+
+class OutputPump:
+    """A process that runs one step command at a time and streams its output back."""
+
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_pump_main, args=(child_conn,), name='cicd-output-pump', daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def close(self):
+        try:
+            self.conn.close()
+        finally:
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process.join(timeout=1.0)
+
+
+class OutputPumpPool:
+    """Keeps idle output pump processes for reuse by later steps."""
+
+    def __init__(self):
+        self._context = multiprocessing.get_context('spawn')
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            while self._idle:
+                pump = self._idle.pop()
+                if pump.is_alive():
+                    return pump
+                pump.close()
+        return OutputPump(self._context)
+
+    def release(self, pump, reusable=True):
+        """Return a pump to the pool, or close it if it may still be busy with a step."""
+        if reusable and pump.is_alive():
+            with self._lock:
+                self._idle.append(pump)
+        else:
+            pump.close()
+
+
+pump_pool = OutputPumpPool()
+
+
+def _receive_output(conn, on_output, command):
+    """
+    Pass the output a pump sends for a command to a callback until the command exits.
+
+    Returns:
+        int: The command's return code
+
+    Raises:
+        OSError: If the command could not be started, or the pump exited
+    """
+    try:
+        while True:
+            kind, value = conn.recv()
+            if kind == 'output':
+                parts = [value]
+                while conn.poll():
+                    kind, value = conn.recv()
+                    if kind != 'output':
+                        break
+                    parts.append(value)
+                on_output(''.join(parts))
+            if kind == 'exit':
+                return value
+            if kind == 'error':
+                raise OSError(value)
+    except EOFError:
+        logger.error(f"Output pump for '{command}' exited unexpectedly")
+        raise OSError('Output pump exited unexpectedly')
+
+
+def run_step(command, cwd, on_output, flush_interval=OUTPUT_FLUSH_INTERVAL, low_priority=False):
+    """
+    Run a build step command, passing its output to a callback in batches.
+
+    When the callback is slower than the command's output, every batch waiting at the time
+    is joined into one call, so the callback runs at most once per batch interval.
+
+    Args:
+        command (str): The shell command to run
+        cwd (str): The directory to run it in
+        on_output (callable): Called with each batch of decoded output
+        flush_interval (float): Seconds between batches
+        low_priority (bool): Run the command with low CPU and I/O priority, where supported
+
+    Returns:
+        int: The command's return code
+
+    Raises:
+        OSError: If the command could not be started
+    """
+    pump = None
+    thread = None
+    if app.config.get('STEP_OUTPUT_PROCESSES', True):
+        pump = pump_pool.acquire()
+        conn = pump.conn
+        conn.send(('step', command, cwd, flush_interval, low_priority))
+    else:
+        conn, child_conn = multiprocessing.Pipe(duplex=False)
+        thread = threading.Thread(target=_stream_in_thread, args=(command, cwd, child_conn, flush_interval,
+                                                                  low_priority),
+                                  daemon=True)
+        thread.start()
+
+    completed = False
+    try:
+        return_code = _receive_output(conn, on_output, command)
+        completed = True
+        return return_code
+    except OSError:
+        # A pump that sent an error is still usable, one that exited isn't
+        completed = pump is not None and pump.is_alive()
+        raise
+    finally:
+        if pump is not None:
+            pump_pool.release(pump, reusable=completed)
+        if thread is not None:
+            thread.join(timeout=1.0)
+
+
+class ShellSession:
+    """
+    Runs a build's steps one after another in the same shell, see the module docstring.
+
+    A step that ends the shell, e.g. with exit, ends the session, and the next step runs
+    in a new shell.
+    """
+
+    def __init__(self, cwd, low_priority=False):
+        """
+        Args:
+            cwd (str): The directory the shell starts in
+            low_priority (bool): Run the shell with low CPU and I/O priority, where supported
+        """
+        self.cwd = cwd
+        self.low_priority = low_priority
+        self._pump = None  # Output pump process holding the shell, if output is pumped in processes
+        self._shell = None  # The shell, if output is pumped from threads
+
+    def run(self, command, on_output, flush_interval=OUTPUT_FLUSH_INTERVAL):
+        """
+        Run a build step command in the session's shell, like run_step().
+
+        Returns:
+            int: The command's return code
+
+        Raises:
+            OSError: If the shell could not be started
+        """
+        if app.config.get('STEP_OUTPUT_PROCESSES', True):
+            if self._pump is None:
+                self._pump = pump_pool.acquire()
+            self._pump.conn.send(('session', command, self.cwd, flush_interval, self.low_priority))
+            completed = False
+            try:
+                return_code = _receive_output(self._pump.conn, on_output, command)
+                completed = True
+                return return_code
+            except OSError:
+                completed = self._pump.is_alive()
+                raise
+            finally:
+                if not completed:
+                    # The pump may still be busy with the step, so it can't run the next one
+                    self._close_pump(reusable=False)
+
+        conn, child_conn = multiprocessing.Pipe(duplex=False)
+
+        def run_in_thread():
+            try:
+                self._shell = run_session_step(self._shell, command, self.cwd, child_conn, flush_interval,
+                                               self.low_priority)
+            finally:
+                child_conn.close()
+
+        thread = threading.Thread(target=run_in_thread, daemon=True)
+        thread.start()
+        try:
+            return _receive_output(conn, on_output, command)
+        finally:
+            thread.join(timeout=1.0)
+
+    def _close_pump(self, reusable=True):
+        pump, self._pump = self._pump, None
+        if reusable:
+            try:
+                pump.conn.send(('end_session',))
+            except OSError:
+                reusable = False
+        pump_pool.release(pump, reusable=reusable)
+
+    def close(self):
+        """End the session's shell."""
+        if self._pump is not None:
+            self._close_pump()
+        if self._shell is not None:
+            self._shell.close()
+            self._shell = None
@@ -0,0 +1,296 @@
+﻿"""
+Build Workers
+
+This module lets builds run in worker processes outside the web server. Workers claim queued
+builds from the shared database with a compare-and-set update, and hold a lease on each claimed
+build that a heartbeat thread renews while the build runs. A build whose lease expires, because
+its worker died or stalled, is failed by the next worker that notices.
+
+Workers write progress and logs to the database as in-process builds do, and the server relays
+them to Socket.IO clients with monitor_worker_builds.
+"""
+
+import datetime
+import os
+import socket
+import threading
+
+from cicd_server import app, db, logger
+from cicd_server.models import Build, Config, ACTIVE_STATUSES
+from cicd_server.services.analytics import invalidate_analytics
+from cicd_server.services.build_service import run_build, emit_event, calculate_build_progress, \
+    get_most_recent_similar_build
+from cicd_server.services.config_stats import record_build_dequeued, record_build_completed
+from cicd_server.services.live_builds import LiveBuild, live_builds
+from cicd_server.services.log_search import index_build_log
+from cicd_server.utils.helpers import prepare_progress_update_data
+from cicd_server.utils.metrics import QUEUE_WAIT_SECONDS
+
+LEASE_SECONDS = 30
+
+
+def default_worker_id():
+    """Get a worker ID that is unique across processes and machines sharing the database."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class BuildLease:
+    """A worker's claim on a build, renewed by a heartbeat thread until it is released."""
+
+    def __init__(self, build_id, worker_id, lease_seconds=LEASE_SECONDS):
+        self.build_id = build_id
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.lost = threading.Event()  # Set when the lease could not be renewed
+        self._released = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._thread.start()
+
+    def _heartbeat(self):
+        # Renew well before expiry, so one slow renewal doesn't lose the lease
+        while not self._released.wait(self.lease_seconds / 3):
+            try:
+                renewed = self.renew()
+            except Exception:
+                logger.exception(f"Error renewing lease on build #{self.build_id}")
+                continue
+            if not renewed and not self._released.is_set():
+                logger.error(f"Worker {self.worker_id} lost its lease on build #{self.build_id}")
+                self.lost.set()
+                return
+
+    def renew(self):
+        """Extend the lease, returning False if this worker no longer holds it."""
+        with app.app_context():
+            now = datetime.datetime.utcnow()
+            renewed = Build.query.filter(
+                Build.id == self.build_id,
+                Build.worker_id == self.worker_id,
+                Build.status.in_(ACTIVE_STATUSES)
+            ).update({
+                'heartbeat_at': now,
+                'lease_expires_at': now + datetime.timedelta(seconds=self.lease_seconds)
+            }, synchronize_session=False)
+            db.session.commit()
+            return renewed == 1
+
+    def release(self):
+        """Stop renewing the lease. The build's worker_id is kept as a record of where it ran."""
+        self._released.set()
+        if self._thread:
+            self._thread.join(timeout=5.0)
+        with app.app_context():
+            Build.query.filter(Build.id == self.build_id, Build.worker_id == self.worker_id) \
+                .update({'lease_expires_at': None}, synchronize_session=False)
+            db.session.commit()
+
+
+def claim_next_build(worker_id, lease_seconds=LEASE_SECONDS):
+    """
+    Claim the queued build with the lowest queue position.
+
+    Several workers may pick the same candidate, so the claim only succeeds if the build is
+    still queued when it is updated, and the next candidate is tried otherwise.
+
+    Returns:
+        Build or None: The claimed build, or None if the queue is empty
+    """
+    with app.app_context():
+        while True:
+            candidate = db.session.query(Build.id, Build.config_id).filter_by(status='queued') \
+                .order_by(Build.queue_position).first()
+            if candidate is None:
+                return None
+
+            now = datetime.datetime.utcnow()
+            claimed = Build.query.filter(Build.id == candidate.id, Build.status == 'queued').update({
+                'status': 'pending',
+                # Resumed builds keep the start time of their first run
+                'started_at': db.case((Build.resume_step.isnot(None), Build.started_at), else_=now),
+                'queue_position': None,
+                'worker_id': worker_id,
+                'heartbeat_at': now,
+                'lease_expires_at': now + datetime.timedelta(seconds=lease_seconds)
+            }, synchronize_session=False)
+            if claimed != 1:
+                db.session.rollback()
+                continue
+
+            record_build_dequeued(candidate.config_id)
+            db.session.commit()
+
+            build = db.session.get(Build, candidate.id)
+            if build.queued_at and build.resume_step is None:
+                QUEUE_WAIT_SECONDS.observe((build.started_at - build.queued_at).total_seconds(),
+                                           config=build.config.name)
+            logger.info(f"Worker {worker_id} claimed build #{build.id}")
+            return build
+
+
+def reap_expired_leases():
+    """
+    Fail builds whose worker stopped renewing its lease.
+
+    Returns:
+        int: The number of builds failed
+    """
+    with app.app_context():
+        now = datetime.datetime.utcnow()
+        expired = Build.query.filter(Build.status.in_(ACTIVE_STATUSES),
+                                     Build.worker_id.isnot(None),
+                                     Build.lease_expires_at < now).all()
+        reaped = 0
+        for build in expired:
+            # Another worker may reap the same build, so only one update may win
+            failed = Build.query.filter(Build.id == build.id,
+                                        Build.status.in_(ACTIVE_STATUSES),
+                                        Build.lease_expires_at == build.lease_expires_at).update({
+                'status': 'failed-permanently',
+                'completed_at': now,
+                'lease_expires_at': None
+            }, synchronize_session=False)
+            if failed != 1:
+                db.session.rollback()
+                continue
+
+            db.session.refresh(build)
+            build.log = (build.log or '') + \
+                f"\nBuild marked as FAILED PERMANENTLY because worker {build.worker_id} stopped responding at {now}\n"
+            index_build_log(build.id)
+            record_build_completed(build)
+            db.session.commit()
+            invalidate_analytics(build.config_id)
+            logger.warning(f"Failed build #{build.id} after the lease of worker {build.worker_id} expired")
+            reaped += 1
+        return reaped
+
+
+def run_worker(worker_id=None, poll_interval=1.0, lease_seconds=LEASE_SECONDS, max_builds=None, stop_event=None):
+    """
+    Claim and run queued builds until stopped.
+
+    Args:
+        worker_id (str, optional): The worker's ID, defaults to the host name and process ID
+        poll_interval (float): Seconds to wait between polls of an empty queue
+        lease_seconds (int): How long a claim lasts without a heartbeat
+        max_builds (int, optional): Exit after running this many builds
+        stop_event (threading.Event, optional): Exit once this is set and the current build finishes
+
+    Returns:
+        int: The number of builds run
+    """
+    worker_id = worker_id or default_worker_id()
+    stop_event = stop_event or threading.Event()
+    app.config['WORKER_ID'] = worker_id
+    logger.info(f"Worker {worker_id} started")
+
+    builds_run = 0
+    while not stop_event.is_set() and (max_builds is None or builds_run < max_builds):
+        try:
+            reap_expired_leases()
+            build = claim_next_build(worker_id, lease_seconds)
+        except Exception:
+            logger.exception(f"Worker {worker_id} failed to claim a build")
+            build = None
+
+        if build is None:
+            stop_event.wait(poll_interval)
+            continue
+
+        lease = BuildLease(build.id, worker_id, lease_seconds)
+        lease.start()
+        try:
+            with app.app_context():
+                config = db.session.get(Config, build.config_id)
+                build_steps = config.build_steps
+            run_build(build.id, build.branch, build.project_path, build_steps, lease=lease)
+        finally:
+            lease.release()
+        builds_run += 1
+
+    logger.info(f"Worker {worker_id} stopped after {builds_run} builds")
+    return builds_run
+
+
+def monitor_worker_builds(interval=1.0, stop_event=None):
+    """
+    Relay the progress of builds run by workers to Socket.IO clients.
+
+    This runs in the server process in worker mode, and emits the same events as run_build
+    does for in-process builds, by polling the database for changes. It also publishes the
+    builds' live state, which the server's pages and API read.
+    """
+    stop_event = stop_event or threading.Event()
+    tracked = {}  # Dictionary of build_id -> (status, log length, similar build)
+
+    while not stop_event.is_set():
+        try:
+            with app.app_context():
+                active = db.session.query(Build.id, Build.status, db.func.length(Build.log)).filter(
+                    Build.status.in_(ACTIVE_STATUSES), Build.worker_id.isnot(None)).all()
+                active_ids = {build_id for build_id, _, _ in active}
+
+                for build_id, status, log_length in active:
+                    previous = tracked.get(build_id)
+                    build = db.session.get(Build, build_id)
+                    if previous is None:
+                        similar_build = get_most_recent_similar_build(build_id)
+                    else:
+                        similar_build = previous[2]
+                    # Readers in the server get the build's state from memory, as for builds run by the server
+                    live = live_builds.publish(LiveBuild.from_build(build, log_length, similar_build))
+
+                    if previous is None or previous[0] != status:
+                        emit_event('build_status_update', {
+                            'build_id': build.id,
+                            'status': build.status,
+                            'config_id': build.config_id,
+                            'config_name': build.config.name,
+                            'triggered_by': build.triggered_by,
+                            'branch': build.branch,
+                            'started_at': build.started_at.isoformat() if build.started_at else None
+                        })
+                    if build.total_steps and build.current_step > 0:
+                        emit_event('build_progress_update', prepare_progress_update_data(live, live.progress()))
+                    if previous is None or previous[1] != log_length:
+                        emit_event('build_log_update', {
+                            'build_id': build.id,
+                            'log_length': log_length,
+                            'status': build.status
+                        })
+                    tracked[build_id] = (status, log_length, similar_build)
+
+                # Builds that are no longer active have finished, or been failed by a reaper
+                for build_id in [build_id for build_id in tracked if build_id not in active_ids]:
+                    del tracked[build_id]
+                    live_builds.remove(build_id)
+                    build = db.session.get(Build, build_id)
+                    if build is None:
+                        continue
+                    invalidate_analytics(build.config_id)
+                    emit_event('build_status_update', {
+                        'build_id': build.id,
+                        'status': build.status,
+                        'config_id': build.config_id,
+                        'config_name': build.config.name,
+                        'triggered_by': build.triggered_by,
+                        'branch': build.branch,
+                        'completed_at': build.completed_at.isoformat() if build.completed_at else None
+                    })
+                    progress_data = calculate_build_progress(build)
+                    progress_data['estimated_remaining'] = 0
+                    emit_event('build_progress_update', prepare_progress_update_data(build, progress_data,
+                                                                                     force_percent=100))
+                    emit_event('build_log_update', {
+                        'build_id': build.id,
+                        'log_length': db.session.query(db.func.length(Build.log)).filter(
+                            Build.id == build.id).scalar(),
+                        'status': build.status
+                    })
+        except Exception:
+            logger.exception("Error relaying worker build progress")
+
+        stop_event.wait(interval)
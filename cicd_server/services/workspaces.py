@@ -0,0 +1,338 @@
+﻿"""
+Build Workspaces
+
+This module gives builds of configurations with isolated workspaces a directory of their
+own, so several builds of one configuration can run at the same time, e.g. on several
+workers, without changing each other's files. Workspaces are git worktrees of the
+configuration's project path, which must be a git repository, with the build's commit or
+branch checked out.
+
+Each configuration has a pool of worktrees under WORKSPACE_ROOT that are kept between
+builds, so files ignored by git, such as dependencies and build output, are still there
+for the next build. A build leases a free worktree by locking its lock file, which the
+operating system releases if the process dies. Worktrees beyond WORKSPACE_POOL_SIZE, and
+the least recently used ones while the pool uses more than WORKSPACE_MAX_BYTES, are removed
+when builds release them.
+"""
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import time
+
+from cicd_server import app, logger
+from cicd_server.services.step_runner import low_priority_prefix
+
+# Full or abbreviated commit hashes, the only revisions accepted from payloads, so they can't be git options
+COMMIT_HASH_PATTERN = re.compile(r'[0-9a-fA-F]{7,40}')
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+GIT_TIMEOUT_SECONDS = 600
+
+
+class WorkspaceError(RuntimeError):
+    """Raised when a build's workspace can't be prepared."""
+
+
+class Workspace:
+    """A worktree leased by a build until it is released."""
+
+    def __init__(self, config_id, slot, path, lock_file):
+        self.config_id = config_id
+        self.slot = slot
+        self.path = path
+        self.lock_file = lock_file
+        self.created = False  # True if the worktree was created for this build rather than reused
+        self.revision = None
+
+
+def _lock(lock_file):
+    """Take an exclusive lock on an open file without waiting, returning False if it is taken."""
+    try:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+def _unlock(lock_file):
+    if fcntl:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def git(cwd, *args, check=True, low_priority=False):
+    """
+    Run a git command.
+
+    Args:
+        cwd (str): The repository or worktree to run it in
+        check (bool): Raise an error if the command fails
+        low_priority (bool): Run it with low CPU and I/O priority, where supported
+
+    Returns:
+        subprocess.CompletedProcess: The result, with text output
+
+    Raises:
+        WorkspaceError: If check is set and the command fails
+    """
+    try:
+        prefix = low_priority_prefix() if low_priority else []
+        result = subprocess.run([*prefix, 'git', *args], cwd=cwd, capture_output=True, text=True,
+                                timeout=GIT_TIMEOUT_SECONDS)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise WorkspaceError(f"git {args[0]} failed: {e}")
+    if check and result.returncode != 0:
+        raise WorkspaceError(f"git {' '.join(args)} failed: {(result.stderr or result.stdout).strip()}")
+    return result
+
+
+def pool_path(config_id):
+    return os.path.join(app.config['WORKSPACE_ROOT'], str(config_id))
+
+
+def _read_metadata(slot_path):
+    try:
+        with open(slot_path + '.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_metadata(slot_path, metadata):
+    with open(slot_path + '.json', 'w') as f:
+        json.dump(metadata, f)
+
+
+def _slots(config_id):
+    """Get the names of a configuration's worktrees."""
+    try:
+        return sorted(name for name in os.listdir(pool_path(config_id))
+                      if os.path.isdir(os.path.join(pool_path(config_id), name)))
+    except FileNotFoundError:
+        return []
+
+
+def _try_lease(config_id, slot):
+    """Lock a worktree, returning a Workspace, or None if another build holds it."""
+    path = os.path.join(pool_path(config_id), slot)
+    lock_file = open(path + '.lock', 'a+')
+    if not _lock(lock_file):
+        lock_file.close()
+        return None
+    return Workspace(config_id, slot, path, lock_file)
+
+
+def resolve_revision(repository, branch, commit=None, low_priority=False):
+    """
+    Find the commit to build, fetching it first if the repository has an origin remote.
+
+    Args:
+        repository (str): The configuration's project path
+        branch (str): The branch being built
+        commit (str, optional): The commit being built, from the payload
+        low_priority (bool): Fetch with low CPU and I/O priority
+
+    Returns:
+        str: The commit's hash
+    """
+    has_origin = git(repository, 'remote', 'get-url', 'origin', check=False).returncode == 0
+    if commit:
+        if git(repository, 'cat-file', '-e', '--end-of-options', f'{commit}^{{commit}}',
+               check=False).returncode != 0 and has_origin:
+            git(repository, 'fetch', '--quiet', '--end-of-options', 'origin', commit,
+                check=False, low_priority=low_priority)
+        result = git(repository, 'rev-parse', '--verify', '--quiet', '--end-of-options', f'{commit}^{{commit}}',
+                     check=False)
+        if result.returncode == 0:
+            return result.stdout.strip()
+
+    if has_origin:
+        # Update the remote-tracking branch rather than FETCH_HEAD, which concurrent fetches share
+        fetched = git(repository, 'fetch', '--quiet', '--end-of-options', 'origin',
+                      f'+refs/heads/{branch}:refs/remotes/origin/{branch}', check=False, low_priority=low_priority)
+        if fetched.returncode != 0:
+            logger.warning(f"Could not fetch {branch} in {repository}: {fetched.stderr.strip()}")
+    for ref in (f'refs/remotes/origin/{branch}', f'refs/heads/{branch}', branch):
+        result = git(repository, 'rev-parse', '--verify', '--quiet', '--end-of-options', f'{ref}^{{commit}}',
+                     check=False)
+        if result.returncode == 0:
+            return result.stdout.strip()
+    raise WorkspaceError(f"Neither commit {commit} nor branch {branch} was found in {repository}" if commit
+                         else f"Branch {branch} was not found in {repository}")
+
+
+def acquire_workspace(config, branch, commit=None, previous_path=None, low_priority=False):
+    """
+    Lease a worktree for a build and check out the build's commit.
+
+    A free worktree that last built the same branch is preferred, since it has the most
+    up-to-date ignored files, then the one used most recently.
+
+    Args:
+        config (Config): The build's configuration
+        branch (str): The branch being built
+        commit (str, optional): The commit being built, from the payload
+        previous_path (str, optional): The worktree a resumed build ran in before. It is
+            leased again without checking anything out, if it still exists and is free.
+        low_priority (bool): Fetch and check out with low CPU and I/O priority, e.g. while
+            another build is running
+
+    Returns:
+        Workspace: The leased worktree, to be released with release_workspace()
+    """
+    repository = config.project_path
+    if git(repository, 'rev-parse', '--git-dir', check=False).returncode != 0:
+        raise WorkspaceError(f"Project path {repository} is not a git repository")
+    os.makedirs(pool_path(config.id), exist_ok=True)
+
+    if previous_path and os.path.dirname(os.path.abspath(previous_path)) == os.path.abspath(pool_path(config.id)) \
+            and os.path.isdir(previous_path):
+        workspace = _try_lease(config.id, os.path.basename(previous_path))
+        if workspace is not None:
+            workspace.revision = _read_metadata(workspace.path).get('revision')
+            return workspace
+
+    revision = resolve_revision(repository, branch, commit, low_priority)
+
+    slots = _slots(config.id)
+    metadata = {slot: _read_metadata(os.path.join(pool_path(config.id), slot)) for slot in slots}
+    slots.sort(key=lambda slot: (metadata[slot].get('branch') != branch, -metadata[slot].get('last_used', 0)))
+    workspace = None
+    for slot in slots:
+        workspace = _try_lease(config.id, slot)
+        if workspace is not None:
+            break
+
+    if workspace is None:
+        # Every worktree is in use, so add one, which is removed again on release if the pool is full
+        number = 0
+        while workspace is None:
+            number += 1
+            if not os.path.exists(os.path.join(pool_path(config.id), f'w{number}')):
+                # Another build may be creating the same worktree, in which case its lock is taken
+                workspace = _try_lease(config.id, f'w{number}')
+        try:
+            git(repository, 'worktree', 'prune')
+            git(repository, 'worktree', 'add', '--detach', '--end-of-options', workspace.path, revision,
+                low_priority=low_priority)
+        except WorkspaceError:
+            workspace.lock_file.close()
+            raise
+        workspace.created = True
+    else:
+        try:
+            # Tracked files are reset and untracked ones removed, but ignored files are kept warm.
+            # checkout doesn't accept --end-of-options, but the revision is a hash from rev-parse
+            git(workspace.path, 'checkout', '--detach', '--force', revision, low_priority=low_priority)
+            git(workspace.path, 'clean', '-ffd', low_priority=low_priority)
+        except WorkspaceError:
+            release_workspace(workspace, config, remove=True)
+            raise
+
+    workspace.revision = revision
+    _write_metadata(workspace.path, {'branch': branch, 'revision': revision, 'last_used': time.time(),
+                                     'bytes': metadata.get(workspace.slot, {}).get('bytes', 0)})
+    return workspace
+
+
+def directory_size(path):
+    """Get the total size of the files in a directory tree, without following links."""
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    total += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _remove_slot(config, slot):
+    path = os.path.join(pool_path(config.id), slot)
+    git(config.project_path, 'worktree', 'remove', '--force', path, check=False)
+    shutil.rmtree(path, ignore_errors=True)
+    git(config.project_path, 'worktree', 'prune', check=False)
+    for suffix in ('.json', '.lock'):
+        try:
+            os.remove(path + suffix)
+        except OSError:
+            pass
+
+
+def release_workspace(workspace, config=None, remove=False):
+    """
+    Give a leased worktree back to the pool, and shrink the pool if it is over its limits.
+
+    Args:
+        workspace (Workspace): The leased worktree
+        config (Config, optional): Its configuration, needed to remove worktrees
+        remove (bool): Remove the worktree rather than keeping it, e.g. because it is broken
+    """
+    metadata = _read_metadata(workspace.path)
+    metadata['bytes'] = directory_size(workspace.path)
+    metadata['last_used'] = time.time()
+    _write_metadata(workspace.path, metadata)
+    _unlock(workspace.lock_file)
+    workspace.lock_file.close()
+
+    if config is None:
+        return
+    if remove:
+        leased = _try_lease(config.id, workspace.slot)
+        if leased is not None:
+            _remove_slot(config, workspace.slot)
+            leased.lock_file.close()
+        return
+
+    # Remove the least recently used free worktrees while the pool is too big
+    slots = _slots(config.id)
+    metadata = {slot: _read_metadata(os.path.join(pool_path(config.id), slot)) for slot in slots}
+    slots.sort(key=lambda slot: metadata[slot].get('last_used', 0))
+    count = len(slots)
+    total_bytes = sum(metadata[slot].get('bytes', 0) for slot in slots)
+    for slot in slots:
+        if count <= app.config['WORKSPACE_POOL_SIZE'] and total_bytes <= app.config['WORKSPACE_MAX_BYTES']:
+            break
+        leased = _try_lease(config.id, slot)
+        if leased is None:
+            continue
+        _remove_slot(config, slot)
+        leased.lock_file.close()
+        logger.info(f"Removed workspace {leased.path} to keep the pool within its limits")
+        count -= 1
+        total_bytes -= metadata[slot].get('bytes', 0)
+
+
+def payload_commit(payload):
+    """Get the commit a payload asks to build, e.g. GitHub's 'after' for push events."""
+    for key in ('commit', 'sha', 'after'):
+        value = payload.get(key)
+        if is_commit_hash(value) and value.strip('0'):
+            return value
+    return None
+
+
+def is_commit_hash(value):
+    """Check that a value from a payload is a commit hash, and not e.g. an option git would run."""
+    return isinstance(value, str) and COMMIT_HASH_PATTERN.fullmatch(value) is not None
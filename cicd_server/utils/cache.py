@@ -0,0 +1,60 @@
+﻿"""
+In-Memory Cache
+
+This module contains a small thread-safe cache whose entries expire after a time to live,
+and which drops its least recently used entries when it is full.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """A least-recently-used cache whose entries expire a fixed time after they were set."""
+
+    def __init__(self, ttl, max_size=1024):
+        """
+        Args:
+            ttl (float): Seconds an entry is kept, or None to keep entries until they are evicted
+            max_size (int): Entries kept before the least recently used one is dropped
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # Dictionary of key -> (expires, value), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get a value, or default if it isn't cached or has expired."""
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires, value = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl if self.ttl is not None else None, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Drop a key's entry, e.g. because the value it was computed from changed."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
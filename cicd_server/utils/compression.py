@@ -0,0 +1,44 @@
+﻿"""
+Response Compression
+
+This module gzips HTML responses for clients that accept it. Build pages repeat the same
+markup for every row, so they compress to a fraction of their size.
+"""
+
+import gzip
+
+from flask import request
+
+COMPRESSIBLE_MIMETYPES = ('text/html',)
+MIN_COMPRESS_BYTES = 1024  # Smaller responses aren't worth the CPU time and gzip header
+COMPRESS_LEVEL = 6
+
+
+def init_compression(app):
+    """
+    Gzip HTML responses when the GZIP_RESPONSES setting is on.
+
+    Streamed and file responses, responses that are already encoded and responses with an
+    ETag, which would no longer match the body, are sent as they are.
+
+    Args:
+        app (Flask): The Flask application
+    """
+    @app.after_request
+    def compress_response(response):
+        if not app.config['GZIP_RESPONSES'] or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+        # Caches must keep compressed and uncompressed copies apart
+        response.vary.add('Accept-Encoding')
+
+        if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+                or 'Content-Encoding' in response.headers or 'ETag' in response.headers \
+                or not request.accept_encodings['gzip']:
+            return response
+        data = response.get_data()
+        if len(data) < MIN_COMPRESS_BYTES:
+            return response
+
+        response.set_data(gzip.compress(data, compresslevel=COMPRESS_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+        return response
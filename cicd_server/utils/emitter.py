@@ -0,0 +1,112 @@
+﻿"""
+Socket.IO Emitter
+
+This module contains the emitter that all server-side Socket.IO events go through. Events
+are queued and sent as frames at a bounded rate. Progress and log events are coalesced:
+a newer event for the same build replaces one that hasn't been sent yet, since clients only
+need the latest state. Clients whose outgoing queue is already long are skipped for
+coalesced events and catch up with the next frame. Other events, such as status changes,
+are always delivered, in order.
+"""
+
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from cicd_server.utils.metrics import SOCKETIO_EMITS, SOCKETIO_BYTES, SOCKETIO_COALESCED, SOCKETIO_DROPPED
+
+DEFAULT_MAX_RATE = 10.0  # Frames per second
+DEFAULT_MAX_CLIENT_QUEUE = 50  # Packets waiting for a client before coalesced events skip it
+
+COALESCED_EVENTS = frozenset(['build_progress_update', 'build_log_update'])
+
+logger = logging.getLogger('cicd_server')
+
+
+def estimate_payload_size(data):
+    """Estimate the JSON size of an event payload without encoding large strings such as logs."""
+    size = 2
+    for key, value in data.items():
+        size += len(key) + 4
+        size += len(value) + 2 if isinstance(value, str) else len(json.dumps(value, default=str))
+    return size
+
+
+class CoalescingEmitter:
+    """Queues Socket.IO events and sends them from a background thread at a bounded rate."""
+
+    def __init__(self, socketio, max_rate=DEFAULT_MAX_RATE, max_client_queue=DEFAULT_MAX_CLIENT_QUEUE,
+                 coalesced_events=COALESCED_EVENTS):
+        self.socketio = socketio
+        self.max_rate = max_rate
+        self.max_client_queue = max_client_queue
+        self.coalesced_events = coalesced_events
+        self._pending = OrderedDict()  # Dictionary of key -> (event, data, room), in send order
+        self._sequence = itertools.count()  # Unique keys for events that are never coalesced
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def emit(self, event, data, room=None):
+        """Queue an event for all clients, or the clients in a room."""
+        if event in self.coalesced_events:
+            key = (room, event, data.get('build_id'))
+        else:
+            key = (room, event, next(self._sequence))
+
+        with self._lock:
+            # Re-inserting moves the event behind anything queued since the event it replaces
+            if self._pending.pop(key, None) is not None:
+                SOCKETIO_COALESCED.inc(event=event)
+            self._pending[key] = (event, data, room)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='socketio-emitter', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # Keep the emitter alive; the next frame carries the latest state anyway
+                logger.exception("Error emitting Socket.IO events")
+            # Events arriving until the next frame are coalesced
+            time.sleep(1.0 / self.max_rate)
+
+    def flush(self):
+        """Send every queued event now."""
+        with self._lock:
+            frames = list(self._pending.values())
+            self._pending.clear()
+        if not frames:
+            return
+
+        slow_clients = None
+        for event, data, room in frames:
+            skip_sid = None
+            if event in self.coalesced_events:
+                if slow_clients is None:
+                    slow_clients = self._slow_clients()
+                if slow_clients:
+                    skip_sid = slow_clients
+                    SOCKETIO_DROPPED.inc(len(slow_clients), event=event)
+            SOCKETIO_EMITS.inc(event=event)
+            SOCKETIO_BYTES.inc(estimate_payload_size(data), event=event)
+            self.socketio.emit(event, data, to=room, skip_sid=skip_sid)
+
+    def _slow_clients(self):
+        """Get the session IDs of clients with more than max_client_queue packets waiting."""
+        try:
+            server = self.socketio.server
+            return [sid for sid, eio_sid in server.manager.get_participants('/', None)
+                    if eio_sid in server.eio.sockets
+                    and server.eio.sockets[eio_sid].queue.qsize() > self.max_client_queue]
+        except (AttributeError, KeyError):
+            # Queue sizes are not available from every python-socketio version or async mode
+            return []
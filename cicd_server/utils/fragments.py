@@ -0,0 +1,78 @@
+﻿"""
+Fragment Cache
+
+This module caches the rendered HTML of finished builds' page fragments, their dashboard
+rows and build information, which are macros in templates/build_fragments.html. A finished
+build's fragment is rendered once and reused until it is evicted as least recently used.
+Queued and running builds are always rendered live.
+
+Fragments are keyed by the build's id, status, completion time and version, which is bumped
+by changes such as renaming its configuration, and by the version of the template, so
+editing the template invalidates them when it is reloaded.
+"""
+
+import hashlib
+import threading
+
+from markupsafe import Markup
+
+from cicd_server import app
+from cicd_server.models import UNFINISHED_STATUSES
+from cicd_server.utils.cache import TTLCache
+from cicd_server.utils.metrics import FRAGMENT_CACHE_LOOKUPS
+from cicd_server.utils.versions import build_versions
+
+
+class FragmentCache:
+    """Rendered macros of a template for finished builds, in a bounded LRU cache."""
+
+    def __init__(self, template_name, max_size):
+        self.template_name = template_name
+        self._cache = TTLCache(None, max_size)
+        self._lock = threading.Lock()
+        self._template = None
+        self._version = None
+
+    def _load(self):
+        """Get the template, and a hash of its source, which changes when Jinja reloads it after an edit."""
+        template = app.jinja_env.get_template(self.template_name)
+        with self._lock:
+            if template is not self._template:
+                source, _, _ = app.jinja_env.loader.get_source(app.jinja_env, self.template_name)
+                self._template = template
+                self._version = hashlib.sha1(source.encode('utf-8')).hexdigest()[:12]
+            return template, self._version
+
+    def render(self, macro_name, build, context=None):
+        """
+        Render a macro for a build, from the cache if the build has finished.
+
+        Args:
+            macro_name (str): The macro, which is called with the build and the context
+            build (Build): The build
+            context (callable, optional): Returns a dict of the macro's other arguments. It is only
+                called when the macro is rendered, so work the cached HTML doesn't need is skipped.
+
+        Returns:
+            Markup: The rendered HTML
+        """
+        template, version = self._load()
+        macro = getattr(template.module, macro_name)
+        if build.status in UNFINISHED_STATUSES:
+            return Markup(macro(build, **(context() if context else {})))
+
+        key = (macro_name, build.id, build.status, build.completed_at, build_versions.current(build.id), version)
+        html = self._cache.get(key)
+        if html is None:
+            FRAGMENT_CACHE_LOOKUPS.inc(fragment=macro_name, result='miss')
+            html = Markup(macro(build, **(context() if context else {})))
+            self._cache.set(key, html)
+        else:
+            FRAGMENT_CACHE_LOOKUPS.inc(fragment=macro_name, result='hit')
+        return html
+
+    def clear(self):
+        self._cache.clear()
+
+
+build_fragments = FragmentCache('build_fragments.html', app.config['FRAGMENT_CACHE_SIZE'])
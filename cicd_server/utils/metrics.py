@@ -0,0 +1,270 @@
+﻿"""
+Metrics
+
+This module contains a small in-process metrics registry with counters, gauges and
+fixed-bucket histograms, rendered in the Prometheus text exposition format.
+"""
+
+import math
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DURATION_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+
+def _format_value(value):
+    """Format a sample value the way Prometheus expects."""
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(label_names, label_values, extra=None):
+    """Format a label set as {name="value",...}."""
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+class Metric:
+    """Base class for a metric family with an optional set of label names."""
+
+    metric_type = 'untyped'
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"Metric {self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def clear(self):
+        """Remove all label sets."""
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """Yield (suffix, label_string, value) tuples."""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield '_total', _format_labels(self.label_names, key), value
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield '', _format_labels(self.label_names, key), value
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, plus count and sum
+                state = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += 1
+            state[2] += value
+
+    def get_count(self, **labels):
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return state[1] if state else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, (list(state[0]), state[1], state[2])) for key, state in self._values.items())
+        for key, (bucket_counts, count, total) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                yield '_bucket', _format_labels(self.label_names, key, ('le', _format_value(bound))), cumulative
+            yield '_bucket', _format_labels(self.label_names, key, ('le', '+Inf')), count
+            yield '_count', _format_labels(self.label_names, key), count
+            yield '_sum', _format_labels(self.label_names, key), total
+
+
+class Registry:
+    """A collection of metrics plus callbacks that refresh gauges just before rendering."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                return self._metrics[metric.name]
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self._register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def add_collector(self, collector):
+        """Register a function that is called before each render to update metrics."""
+        with self._lock:
+            self._collectors.append(collector)
+        return collector
+
+    def render(self):
+        """Render all metrics in the text exposition format."""
+        with self._lock:
+            collectors = list(self._collectors)
+            metrics = list(self._metrics.values())
+        for collector in collectors:
+            collector()
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = Registry()
+
+# Scheduler
+QUEUE_LENGTH = registry.gauge('cicd_queue_length', 'Number of queued builds', ('config',))
+QUEUE_WAIT_SECONDS = registry.histogram('cicd_queue_wait_seconds', 'Time builds spent queued before starting',
+                                        ('config',), DURATION_BUCKETS)
+BUILDS_IN_PROGRESS = registry.gauge('cicd_builds_in_progress', 'Number of builds currently executing')
+BUILDS_TRIGGERED = registry.counter('cicd_builds_triggered', 'Build trigger requests by result', ('config', 'result'))
+
+# Builds
+BUILD_DURATION_SECONDS = registry.histogram('cicd_build_duration_seconds', 'Build duration from start to completion',
+                                            ('config', 'status'), DURATION_BUCKETS)
+STEP_DURATION_SECONDS = registry.histogram('cicd_step_duration_seconds', 'Build step duration',
+                                           ('config', 'result'), DURATION_BUCKETS)
+WORKSPACE_PREFETCHES = registry.counter('cicd_workspace_prefetches', 'Builds with isolated workspaces by whether '
+                                        'their workspace was prefetched (hit or miss), and prefetched workspaces '
+                                        'never used (discarded)', ('config', 'result'))
+
+# I/O
+DB_COMMIT_SECONDS = registry.histogram('cicd_db_commit_seconds', 'Database session commit latency')
+SOCKETIO_EMITS = registry.counter('cicd_socketio_emits', 'Socket.IO events emitted', ('event',))
+SOCKETIO_BYTES = registry.counter('cicd_socketio_bytes', 'Approximate JSON payload bytes emitted over Socket.IO',
+                                  ('event',))
+SOCKETIO_COALESCED = registry.counter('cicd_socketio_coalesced', 'Socket.IO events replaced by a newer event before '
+                                      'being sent', ('event',))
+SOCKETIO_DROPPED = registry.counter('cicd_socketio_dropped', 'Socket.IO events not sent to a client because its '
+                                    'queue was full', ('event',))
+WEBHOOK_SECONDS = registry.histogram('cicd_webhook_seconds', 'Webhook request handling latency', ('status',))
+LOG_STREAMS_OPEN = registry.gauge('cicd_log_streams_open', 'Number of clients following a build log stream')
+
+# Requests
+REQUEST_SECONDS = registry.histogram('cicd_request_seconds', 'HTTP request latency', ('endpoint', 'method'))
+REQUEST_SQL_STATEMENTS = registry.histogram('cicd_request_sql_statements', 'SQL statements executed per HTTP request',
+                                            ('endpoint',), (0, 1, 2, 3, 5, 10, 20, 50, 100))
+REQUEST_SQL_SECONDS = registry.histogram('cicd_request_sql_seconds', 'Time spent executing SQL per HTTP request',
+                                         ('endpoint',))
+QUERY_BUDGET_EXCEEDED = registry.counter('cicd_query_budget_exceeded', 'HTTP requests that executed more SQL '
+                                         'statements than their endpoint\'s query budget', ('endpoint',))
+FRAGMENT_CACHE_LOOKUPS = registry.counter('cicd_fragment_cache_lookups', 'Lookups of finished builds\' rendered '
+                                          'page fragments by result', ('fragment', 'result'))
+LOCK_WAIT_SECONDS = registry.histogram('cicd_lock_wait_seconds', 'Time spent waiting to acquire a lock', ('lock',))
+
+# Process
+ACTIVE_THREADS = registry.gauge('cicd_active_threads', 'Number of live threads in the server process')
+
+
+@registry.add_collector
+def _collect_threads():
+    ACTIVE_THREADS.set(threading.active_count())
+
+
+def _before_commit(session):
+    session.info['commit_started'] = time.perf_counter()
+
+
+def _after_commit(session):
+    started = session.info.pop('commit_started', None)
+    if started is not None:
+        DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+
+def _after_rollback(session):
+    session.info.pop('commit_started', None)
+
+
+# Time every ORM commit, regardless of which session or thread issues it
+event.listen(Session, 'before_commit', _before_commit)
+event.listen(Session, 'after_commit', _after_commit)
+event.listen(Session, 'after_rollback', _after_rollback)
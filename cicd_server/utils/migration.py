@@ -6,8 +6,95 @@ This module contains utility functions for migrating data between versions of th
 
 import json
 import datetime
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import load_only
 from cicd_server import app, db
-from cicd_server.models import Config, Build
+from cicd_server.models import Config, Build, BuildStep
+
+MIGRATION_BATCH_SIZE = 1000
+
+def migrate_add_missing_columns():
+    """
+    Add columns that exist on the models but not yet in the database.
+
+    db.create_all() creates missing tables but never alters existing ones, so columns
+    added to existing models must be added here before any query selects them.
+    """
+    with app.app_context():
+        inspector = inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                default_sql = ''
+                if column.default is not None and column.default.is_scalar:
+                    value = column.default.arg
+                    if isinstance(value, bool):
+                        value = int(value)
+                    if isinstance(value, str):
+                        value = "'" + value.replace("'", "''") + "'"
+                    default_sql = f' DEFAULT {value}'
+
+                db.session.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}{default_sql}'))
+                print(f"Added column {table.name}.{column.name}")
+        db.session.commit()
+
+def migrate_add_missing_indexes():
+    """
+    Create indexes that exist on the models but not yet in the database.
+
+    Like columns, indexes added to existing tables are not created by db.create_all().
+    """
+    with app.app_context():
+        inspector = inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(db.engine)
+                    print(f"Created index {index.name} on {table.name}")
+
+def migrate_add_log_search_index():
+    """
+    Create the full-text search index over build log chunks.
+
+    build_log_fts is an FTS5 table that indexes the content of build_log_chunk without storing
+    a second copy of it, and is kept up to date by triggers. db.create_all() can't create
+    virtual tables or triggers, so they are created here. Log search is unavailable on
+    databases other than SQLite, or if SQLite was built without FTS5.
+    """
+    with app.app_context():
+        if db.engine.dialect.name != 'sqlite':
+            return
+        if inspect(db.engine).has_table('build_log_fts'):
+            return
+        try:
+            db.session.execute(text(
+                "CREATE VIRTUAL TABLE build_log_fts USING fts5(content, content='build_log_chunk', content_rowid='id')"))
+        except OperationalError as e:
+            db.session.rollback()
+            print(f"Log search is unavailable: {e}")
+            return
+        db.session.execute(text(
+            "CREATE TRIGGER build_log_chunk_ai AFTER INSERT ON build_log_chunk BEGIN "
+            "INSERT INTO build_log_fts(rowid, content) VALUES (new.id, new.content); END"))
+        db.session.execute(text(
+            "CREATE TRIGGER build_log_chunk_ad AFTER DELETE ON build_log_chunk BEGIN "
+            "INSERT INTO build_log_fts(build_log_fts, rowid, content) VALUES ('delete', old.id, old.content); END"))
+        # Index chunks that were written before the index existed
+        db.session.execute(text("INSERT INTO build_log_fts(build_log_fts) VALUES ('rebuild')"))
+        db.session.commit()
+        print("Created the build log search index")
 
 def migrate_to_multiple_configs():
     """
@@ -71,8 +158,10 @@ def migrate_step_times_format():
     3. Removes step_estimates data (no longer used)
     """
     with app.app_context():
-        # Get all builds with step_times data
-        builds = Build.query.filter(Build.step_times != '{}').all()
+        # Only builds still in the old format contain 'start' keys, so skip everything else
+        # without loading the build logs
+        builds = Build.query.options(load_only(Build.id, Build.started_at, Build._step_times)) \
+            .filter(Build.step_times.like('%"start"%')).all()
         updated_count = 0
 
         for build in builds:
@@ -112,3 +201,69 @@ def migrate_step_times_format():
         if updated_count > 0:
             db.session.commit()
             print(f"Updated step_times format for {updated_count} builds")
+
+def migrate_step_times_to_build_steps():
+    """
+    Backfill BuildStep rows for builds that only have the legacy step_times JSON.
+
+    This function:
+    1. Finds builds with step_times data but no BuildStep rows, in batches
+    2. Creates a BuildStep for each step, starting at the recorded offset from the build start
+       and finishing when the next step started (or when the build completed, for the last step)
+    3. Leaves the step_times column in place so the data can still be read by older versions
+    """
+    with app.app_context():
+        last_id = 0
+        created_count = 0
+
+        while True:
+            builds = Build.query.options(load_only(Build.id, Build.config_id, Build.status, Build.started_at,
+                                                   Build.completed_at, Build._step_times)) \
+                .filter(Build.id > last_id,
+                        Build.step_times != '{}',
+                        Build.started_at.isnot(None),
+                        ~Build.id.in_(db.session.query(BuildStep.build_id))) \
+                .order_by(Build.id).limit(MIGRATION_BATCH_SIZE).all()
+            if not builds:
+                break
+            last_id = builds[-1].id
+
+            rows = []
+            for build in builds:
+                try:
+                    offsets = sorted((int(idx), float(seconds))
+                                     for idx, seconds in json.loads(build._step_times).items()
+                                     if isinstance(seconds, (int, float)))
+                except (json.JSONDecodeError, ValueError, AttributeError):
+                    # Skip builds with invalid data
+                    continue
+
+                for position, (step_idx, seconds) in enumerate(offsets):
+                    is_last = position == len(offsets) - 1
+                    started_at = build.started_at + datetime.timedelta(seconds=seconds)
+                    if not is_last:
+                        finished_at = build.started_at + datetime.timedelta(seconds=offsets[position + 1][1])
+                        exit_code = 0
+                    else:
+                        finished_at = build.completed_at
+                        exit_code = 0 if build.status == 'success' else None
+                    rows.append({
+                        'build_id': build.id,
+                        'config_id': build.config_id,
+                        'step_index': step_idx,
+                        'started_at': started_at,
+                        'finished_at': finished_at,
+                        'exit_code': exit_code,
+                        'cached': False
+                    })
+
+            if rows:
+                db.session.execute(BuildStep.__table__.insert(), rows)
+                db.session.commit()
+                created_count += len(rows)
+
+            # Don't keep the whole history in the identity map
+            db.session.expunge_all()
+
+        if created_count > 0:
+            print(f"Created {created_count} build steps from legacy step_times data")
@@ -0,0 +1,205 @@
+﻿"""
+Profiling Utilities
+
+This module contains request timing middleware, SQL statement accounting and query budgets,
+an instrumented lock and a sampling profiler that covers every thread in the server.
+"""
+
+import logging
+import marshal
+import sys
+import threading
+import time
+
+from flask import g, has_request_context, request
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from cicd_server.utils.metrics import REQUEST_SECONDS, REQUEST_SQL_STATEMENTS, REQUEST_SQL_SECONDS, \
+    LOCK_WAIT_SECONDS, QUERY_BUDGET_EXCEEDED
+
+logger = logging.getLogger('cicd_server')
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """Raised when a request executes more SQL statements than its endpoint's query budget."""
+
+
+def query_budget(max_statements):
+    """
+    Declare the most SQL statements a view may execute per request.
+
+    The budget includes loading the logged-in user, and must not depend on the number of
+    builds or configurations, so that N+1 queries exceed it. Requests over budget are logged
+    and counted by the cicd_query_budget_exceeded metric, or fail if ENFORCE_QUERY_BUDGETS
+    is set or the app is testing. Apply it below @login_required, whose wrapper copies it.
+
+    Args:
+        max_statements (int): The budget
+    """
+    def decorator(view):
+        view.query_budget = max_statements
+        return view
+    return decorator
+
+
+class TimedLock:
+    """A threading.Lock that records how long callers wait to acquire it."""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        started = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        waited = time.perf_counter() - started
+        LOCK_WAIT_SECONDS.observe(waited, lock=self.name)
+        if has_request_context():
+            g.lock_wait_time = g.get('lock_wait_time', 0.0) + waited
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.sql_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_started' in g:
+        g.sql_count = g.get('sql_count', 0) + 1
+        g.sql_time = g.get('sql_time', 0.0) + time.perf_counter() - g.pop('sql_started')
+
+
+def _before_render_template(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+
+def _template_rendered(sender, template, context, **extra):
+    if 'render_started' in g:
+        g.render_time = g.get('render_time', 0.0) + time.perf_counter() - g.pop('render_started')
+
+
+def init_request_timing(app):
+    """
+    Record per-endpoint latency and SQL statement counts, and add a Server-Timing header to every response.
+
+    Args:
+        app (Flask): The Flask application
+    """
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_timing(response):
+        if 'request_started' not in g:
+            return response
+
+        total = time.perf_counter() - g.request_started
+        endpoint = request.endpoint or 'unknown'
+        sql_count = g.get('sql_count', 0)
+        sql_time = g.get('sql_time', 0.0)
+
+        REQUEST_SECONDS.observe(total, endpoint=endpoint, method=request.method)
+        REQUEST_SQL_STATEMENTS.observe(sql_count, endpoint=endpoint)
+        REQUEST_SQL_SECONDS.observe(sql_time, endpoint=endpoint)
+
+        budget = getattr(app.view_functions.get(request.endpoint), 'query_budget', None)
+        if budget is not None and sql_count > budget:
+            QUERY_BUDGET_EXCEEDED.inc(endpoint=endpoint)
+            message = f"{request.method} {request.path} executed {sql_count} SQL statements, " \
+                      f"over the {endpoint} endpoint's budget of {budget}"
+            if app.config.get('ENFORCE_QUERY_BUDGETS') or app.testing:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+
+        timings = [f'app;dur={total * 1000:.1f}', f'db;dur={sql_time * 1000:.1f};desc="{sql_count} queries"']
+        if 'render_time' in g:
+            timings.append(f'render;dur={g.render_time * 1000:.1f}')
+        if 'lock_wait_time' in g:
+            timings.append(f'lock;dur={g.lock_wait_time * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+        return response
+
+
+def _frame_key(frame):
+    code = frame.f_code
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+def sample_profile(seconds, interval=0.005):
+    """
+    Sample the stacks of all threads for a period of time.
+
+    Unlike cProfile, which only sees the thread it was enabled in, this covers
+    request handlers, build threads and progress threads alike.
+
+    Args:
+        seconds (float): How long to sample for
+        interval (float): The time between samples in seconds
+
+    Returns:
+        bytes: The samples in the marshalled pstats format, loadable with pstats.Stats
+    """
+    # func -> [primitive calls, total calls, self time, cumulative time, {caller: [cc, nc, tt, ct]}]
+    stats = {}
+    own_thread = threading.get_ident()
+    deadline = time.perf_counter() + seconds
+
+    while time.perf_counter() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+
+            # Build the stack from the root down to the currently executing frame
+            stack = []
+            while frame is not None:
+                stack.append(_frame_key(frame))
+                frame = frame.f_back
+            stack.reverse()
+
+            seen = set()
+            caller = None
+            for func in stack:
+                entry = stats.setdefault(func, [0, 0, 0.0, 0.0, {}])
+                if func not in seen:
+                    # Count recursive functions once per sample for cumulative time
+                    seen.add(func)
+                    entry[0] += 1
+                    entry[1] += 1
+                    entry[3] += interval
+                if caller is not None:
+                    caller_entry = entry[4].setdefault(caller, [0, 0, 0.0, 0.0])
+                    caller_entry[0] += 1
+                    caller_entry[1] += 1
+                    caller_entry[3] += interval
+                caller = func
+            if stack:
+                stats[stack[-1]][2] += interval
+
+        time.sleep(interval)
+
+    return marshal.dumps({
+        func: (cc, nc, tt, ct, {caller: tuple(values) for caller, values in callers.items()})
+        for func, (cc, nc, tt, ct, callers) in stats.items()
+    })
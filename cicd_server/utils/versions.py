@@ -0,0 +1,68 @@
+﻿"""
+Version Counters
+
+This module contains an in-memory version counter used to answer "has anything changed?"
+without querying the database: every change to a build bumps its version, and readers can
+compare versions, build ETags from them, or wait for the next change.
+"""
+
+import threading
+import uuid
+
+LATEST_BUILD_KEY = 'builds'  # Bumped when a build is created or changes status
+
+
+class VersionCounter:
+    """Monotonic versions per key, with waiting for changes."""
+
+    def __init__(self):
+        # ETags from before a restart must not match, since versions start again from zero
+        self.epoch = uuid.uuid4().hex[:8]
+        self._condition = threading.Condition()
+        self._sequence = 0
+        self._floor = 0  # Versions of every key are at least this, see bump_all()
+        self._versions = {}  # Dictionary of key -> version
+
+    def current(self, key):
+        with self._condition:
+            return max(self._versions.get(key, 0), self._floor)
+
+    def bump(self, *keys):
+        """Record a change to each key and wake anything waiting for them."""
+        with self._condition:
+            self._sequence += 1
+            for key in keys:
+                self._versions[key] = self._sequence
+            self._condition.notify_all()
+
+    def bump_all(self):
+        """Record a change to every key, e.g. after a change that affects all builds."""
+        with self._condition:
+            self._sequence += 1
+            self._floor = self._sequence
+            self._versions.clear()
+            self._condition.notify_all()
+
+    def wait(self, key, since, timeout):
+        """
+        Wait until the version of a key differs from `since`.
+
+        Returns:
+            int: The version when the wait ended, which equals `since` if it timed out
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: max(self._versions.get(key, 0), self._floor) != since, timeout)
+            return max(self._versions.get(key, 0), self._floor)
+
+    def etag(self, version):
+        return f'{self.epoch}-{version}'
+
+    def version_from_etag(self, etag):
+        """Get the version from an ETag made by this counter, or None if it is from another epoch."""
+        epoch, _, version = (etag or '').partition('-')
+        if epoch != self.epoch or not version.isdigit():
+            return None
+        return int(version)
+
+
+build_versions = VersionCounter()
@@ -0,0 +1,42 @@
+﻿"""
+CICD Build Worker
+
+Runs builds outside the web server. Start the server with --build-execution worker (or
+CICD_BUILD_EXECUTION=worker) and run one or more of these against the same database.
+"""
+
+import os
+import argparse
+import signal
+import threading
+
+from cicd_server import app
+from cicd_server.services.worker import run_worker, default_worker_id, LEASE_SECONDS
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='CICD Build Worker')
+    parser.add_argument('--worker-id', help='Unique name of this worker (default: host name and process ID)')
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between polls of an empty queue')
+    parser.add_argument('--lease-seconds', type=int, default=LEASE_SECONDS,
+                        help='Seconds a claimed build stays claimed without a heartbeat')
+    parser.add_argument('--max-builds', type=int, help='Exit after running this many builds')
+    args = parser.parse_args()
+
+    # Get the worker ID from command line argument, environment variable, or default
+    worker_id = args.worker_id or os.environ.get('CICD_WORKER_ID') or default_worker_id()
+    app.config['BUILD_EXECUTION'] = 'worker'
+
+    # Finish the current build before exiting on SIGTERM or Ctrl+C
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        print(f"Worker {worker_id} stopping after the current build")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    print(f"Starting CICD worker {worker_id}")
+    run_worker(worker_id, poll_interval=args.poll_interval, lease_seconds=args.lease_seconds,
+               max_builds=args.max_builds, stop_event=stop_event)